@@ -1,24 +1,108 @@
-# Standard library imports
+# Async server backend. It is chosen before anything else is imported so
+# that eventlet or gevent can monkey-patch the standard library.
 import os
+import sys
+
+SERVER_MODES = ('auto', 'threading', 'eventlet', 'gevent')
+
+def requested_server_mode(argv, default):
+    """Return the ``--server`` mode from the command line or LOCALSHARE_SERVER."""
+    for index, arg in enumerate(argv):
+        if arg == '--server' and index + 1 < len(argv):
+            return argv[index + 1]
+        if arg.startswith('--server='):
+            return arg.split('=', 1)[1]
+    return os.environ.get('LOCALSHARE_SERVER', default)
+
+# Imported modules (tests, tools) stay on plain threads unless asked otherwise
+if __name__ == '__main__':
+    ASYNC_MODE = requested_server_mode(sys.argv[1:], 'auto')
+else:
+    ASYNC_MODE = requested_server_mode([], 'threading')
+
+if ASYNC_MODE == 'auto':
+    ASYNC_MODE = 'threading'
+    for candidate in ('eventlet', 'gevent'):
+        try:
+            __import__(candidate)
+        except ImportError:
+            continue
+        ASYNC_MODE = candidate
+        break
+
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    import eventlet.tpool
+    import eventlet.wsgi
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    import gevent
+    from gevent import monkey
+    monkey.patch_all()
+
+# Standard library imports
 import json
 import logging
 import tempfile
 import shutil
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
 import qrcode
 import base64
 from io import BytesIO
 import socket
-from contextlib import closing
+from collections import deque
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import zipfile
+import unicodedata
+import mimetypes
+import argparse
+import time
+import hashlib
+import zlib
+import gzip
+import bisect
+import sqlite3
+import pickle
+import signal
+import subprocess
+from functools import partial
+from urllib.parse import quote, urlencode
 from flask import current_app
 
+try:
+    import fcntl
+    import resource
+except ImportError:  # Windows
+    fcntl = None
+    resource = None
+
 # Third-party imports
-from flask import Flask, render_template, request, send_file, jsonify
+from flask import Flask, Response, after_this_request, g, render_template, request, jsonify
 from flask_socketio import SocketIO, emit
+from socketio import PubSubManager
 import netifaces
+
+try:
+    import magic
+except ImportError:  # python-magic or the libmagic library is missing
+    magic = None
+
+try:
+    import zstandard
+except ImportError:  # Optional, gzip is used without it
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # Optional, static assets are served gzip-compressed without it
+    brotli = None
+from werkzeug.datastructures import ContentRange
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator, get_input_stream
 
 # Configure logging
 logging.basicConfig(
@@ -28,22 +112,1688 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Flask application setup
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)  # static/ is served from memory by static_asset
 app.config.update(
     SECRET_KEY='your-secret-key-here',
     MAX_CONTENT_LENGTH=1024 * 1024 * 1024,  # 1GB max file size
-    UPLOAD_FOLDER=tempfile.mkdtemp()  # Temporary folder for file transfers
+    # Temporary folder for file transfers; worker processes inherit their parent's
+    UPLOAD_FOLDER=os.environ.get('LOCALSHARE_UPLOAD_FOLDER') or tempfile.mkdtemp(),
+    UPLOAD_CHUNK_SIZE=8 * 1024 * 1024,  # Size of each chunk in chunked uploads
+    UPLOAD_PARALLEL_CHUNKS=4,  # Chunks a client may have in flight at once
+    BATCH_FILE_LIMIT=1024 * 1024,  # Files below this size are sent in batches
+    BATCH_MAX_BYTES=16 * 1024 * 1024,  # Payload size of one batch request
+    BATCH_MAX_FILES=1000,  # Number of files in one batch request
+    DELIVERY_COPY_WORKERS=4,  # Threads copying files across filesystems on delivery
+    RELAY_BUFFER_SIZE=8 * 1024 * 1024,  # Bytes buffered between relay sender and recipient
+    RELAY_TIMEOUT=60,  # Seconds either relay side may stall before the relay is aborted
+    NETWORK_SNAPSHOT_TTL=30,  # Seconds a cached interface walk stays valid
+    NETWORK_REFRESH_INTERVAL=10,  # Seconds between background address checks, 0 disables
+    TRANSFER_TTLS={  # Seconds a transfer may sit idle in each state before it is purged
+        'pending': 10 * 60,
+        'accepted': 60 * 60,
+        'ready_for_download': 6 * 60 * 60
+    },
+    STAGING_QUOTA_BYTES=None,  # Bytes that may be staged at once; None: 90% of free space at startup
+    DISCONNECT_GRACE=60,  # Seconds a transfer survives its sender or recipient disconnecting
+    REAPER_INTERVAL=30,  # Seconds between cleanup sweeps
+    BLOB_CACHE_TTL=60 * 60,  # Seconds an unreferenced deduplicated file is kept for later transfers
+    COMPRESSION_PROBE_SIZE=64 * 1024,  # Leading bytes of a file sniffed and trial-compressed
+    COMPRESSION_MIN_SIZE=4096,  # Files smaller than this are never compressed
+    COMPRESSION_MIN_RATIO=0.9,  # Compress only if the probe shrinks to less than this fraction
+    COMPRESSION_LEVELS={'zstd': 3, 'gzip': 1},  # Fast levels keep up with a LAN link
+    STAGED_ANNOUNCE_INTERVAL=0.5,  # Seconds newly staged directory files are collected before recipients hear of them
+    UPLOAD_PREALLOCATE=True,  # Reserve the disk space of an upload up front with fallocate
+    RAW_UPLOAD_BLOCK_SIZE=4 * 1024 * 1024,  # Bytes gathered per disk write by raw streaming uploads
+    MESSAGE_POLL_INTERVAL=0.02,  # Seconds between checks for Socket.IO events from other workers
+    MESSAGE_RETENTION=60,  # Seconds Socket.IO events stay in the shared database
+    MAX_ACTIVE_REQUESTS=32,  # Upload and download requests moving data at once, None: no cap
+    MAX_DEVICE_REQUESTS=8,  # Such requests per device at once, None: no cap
+    RATE_LIMIT_BYTES=None,  # Bytes per second for all transfers together, None: unlimited
+    DEVICE_RATE_LIMIT_BYTES=None,  # Bytes per second per device, None: unlimited
+    PRIORITY_TRANSFER_BYTES=16 * 1024 * 1024,  # Transfers up to this size jump the queue, None: no priority lane
+    PRIORITY_SLOTS=4,  # Extra concurrent requests only priority transfers may use
+    PRIORITY_WEIGHT=4,  # Share of the rate limits a priority transfer gets relative to others
+    SCHEDULER_QUEUE_TIMEOUT=300,  # Seconds a request may wait for a slot before it is refused
+    STATIC_ASSET_MAX_AGE=365 * 24 * 60 * 60  # Seconds browsers keep static assets requested by content hash
 )
 
 # Socket.IO setup
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60)
+class LocalShareSocketIO(SocketIO):
+    """SocketIO that counts emitted events for /metrics."""
+
+    def emit(self, event, *args, **kwargs):
+        metrics.count_emit(event)
+        return super().emit(event, *args, **kwargs)
+
+socketio = LocalShareSocketIO(app, cors_allowed_origins="*", ping_timeout=60, async_mode=ASYNC_MODE)
+
+FICLONE = 0x40049409  # Linux ioctl to reflink one file into another
+
+# Content hashes are SHA-256 over the SHA-256 digests of chunks of this size
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# File types that are already compressed; deflating them again wastes CPU
+PRECOMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif',
+    '.mp4', '.mov', '.m4v', '.mkv', '.avi', '.webm',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst',
+    '.apk', '.ipa', '.jar', '.docx', '.xlsx', '.pptx', '.pdf'
+}
+
+# Sniffed MIME types that are compressed already, besides most image, audio and video
+PRECOMPRESSED_MIME_TYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/zstd', 'application/x-7z-compressed', 'application/x-rar',
+    'application/vnd.rar', 'application/java-archive', 'application/pdf',
+    'application/vnd.android.package-archive'
+}
+UNCOMPRESSED_MEDIA_TYPES = {'image/svg+xml', 'image/bmp', 'image/x-ms-bmp', 'image/tiff',
+                            'audio/x-wav', 'audio/wav'}
+
+# Content codings in order of preference; zstd needs the zstandard package
+CONTENT_ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+# Codings static assets are precompressed with, in order of preference
+STATIC_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+class DeviceRegistry:
+    """Connected devices keyed by Socket.IO sid, with an IP -> sid index.
+
+    Every change bumps ``version``. Clients apply the delta events in version
+    order and ask for a full snapshot when they notice a gap.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._devices = {}
+        self._by_ip = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, sid):
+        return sid in self._devices
+
+    def __getitem__(self, sid):
+        return self._devices[sid]
+
+    def __len__(self):
+        return len(self._devices)
+
+    def get(self, sid, default=None):
+        return self._devices.get(sid, default)
+
+    def add(self, sid, name, ip):
+        """Register a device, evicting an older session from the same IP.
+
+        Returns ``(evicted, version)`` where ``evicted`` is ``(device, version)``
+        for the removed session or ``None``.
+        """
+        with self._lock:
+            evicted = None
+            old_sid = self._by_ip.get(ip)
+            if old_sid is not None and old_sid != sid:
+                evicted = (self._remove(old_sid), self.version)
+            self._devices[sid] = {'id': sid, 'name': name, 'ip': ip}
+            self._by_ip[ip] = sid
+            self.version += 1
+            return evicted, self.version
+
+    def remove(self, sid):
+        """Remove a device and return ``(device, version)``, or ``(None, version)``."""
+        with self._lock:
+            if sid not in self._devices:
+                return None, self.version
+            return self._remove(sid), self.version
+
+    def rename(self, sid, name):
+        """Rename a device and return the new version, or ``None`` if unknown."""
+        with self._lock:
+            if sid not in self._devices:
+                return None
+            self._devices[sid]['name'] = name
+            self.version += 1
+            return self.version
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'version': self.version,
+                'devices': {sid: dict(device) for sid, device in self._devices.items()}
+            }
+
+    def _remove(self, sid):
+        device = self._devices.pop(sid)
+        if self._by_ip.get(device['ip']) == sid:
+            del self._by_ip[device['ip']]
+        self.version += 1
+        return device
+
+class ReceivedFile:
+    """Byte ranges received so far for one file of a transfer.
+
+    ``leaves`` maps the indexes of ``HASH_CHUNK_SIZE`` blocks that were
+    hashed while they streamed in to their SHA-256 digests.
+    """
+
+    __slots__ = ('path', 'size', 'received', 'complete', 'leaves')
+
+    def __init__(self, path, size, received=None, complete=False, leaves=None):
+        self.path = path
+        self.size = size
+        self.received = received if received is not None else []
+        self.complete = complete
+        self.leaves = leaves if leaves is not None else {}
+
+    def to_dict(self):
+        return {
+            'size': self.size,
+            'received': self.received,
+            'missing': missing_ranges(self.received, self.size),
+            'complete': self.complete
+        }
+
+class CompressionStats:
+    """Bytes before and after compression in one direction, and the CPU time spent."""
+
+    __slots__ = ('raw_bytes', 'wire_bytes', 'cpu_seconds', 'lock')
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, raw_bytes, wire_bytes, cpu_seconds):
+        with self.lock:
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_seconds += cpu_seconds
+
+    def to_dict(self):
+        return {
+            'raw_bytes': self.raw_bytes,
+            'wire_bytes': self.wire_bytes,
+            'saved_bytes': self.raw_bytes - self.wire_bytes,
+            'cpu_seconds': round(self.cpu_seconds, 3)
+        }
+
+class RateMeter:
+    """Byte total with the current and peak rate, measured over one-second windows."""
+
+    __slots__ = ('total', 'peak', '_rate', '_window_start', '_window_bytes', 'lock')
+
+    WINDOW = 1.0
+
+    def __init__(self):
+        self.total = 0
+        self.peak = 0.0
+        self._rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        now = time.monotonic()
+        with self.lock:
+            self.total += nbytes
+            elapsed = now - self._window_start
+            if elapsed > 2 * self.WINDOW:
+                # Traffic resumes after a pause; the pause is not part of any window
+                self._rate = 0.0
+                self._window_start = now
+                self._window_bytes = nbytes
+                return
+            self._window_bytes += nbytes
+            if elapsed >= self.WINDOW:
+                self._rate = self._window_bytes / elapsed
+                self.peak = max(self.peak, self._rate)
+                self._window_start = now
+                self._window_bytes = 0
+
+    def rate(self):
+        """Bytes per second in the last window; 0 once traffic has stopped."""
+        elapsed = time.monotonic() - self._window_start
+        if elapsed > 2 * self.WINDOW:
+            return 0.0
+        if self._rate == 0.0 and elapsed > 0:
+            # No window completed since traffic started, use the open one
+            return self._window_bytes / elapsed
+        return self._rate
+
+    def to_dict(self):
+        rate = self.rate()
+        return {
+            'bytes': self.total,
+            'current_mbps': round(rate / 1e6, 3),
+            'peak_mbps': round(max(self.peak, rate) / 1e6, 3)
+        }
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yield ``(upper_bound, count)`` pairs, ending with ``('+Inf', count)``."""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+class Metrics:
+    """Process-wide byte counters, Socket.IO emit counts and request latencies."""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self):
+        self.bytes = {'received': 0, 'sent': 0}
+        self.emits = {}
+        self.latency = {}
+        self._lock = threading.Lock()
+
+    def add_bytes(self, direction, nbytes):
+        with self._lock:
+            self.bytes[direction] += nbytes
+
+    def count_emit(self, event):
+        with self._lock:
+            self.emits[event] = self.emits.get(event, 0) + 1
+
+    def observe_latency(self, endpoint, started):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = Histogram(self.LATENCY_BUCKETS)
+            histogram.observe(elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'bytes': dict(self.bytes),
+                'emits': dict(self.emits),
+                'latency': {
+                    endpoint: {
+                        'buckets': list(histogram.cumulative()),
+                        'count': histogram.count,
+                        'sum': histogram.sum
+                    }
+                    for endpoint, histogram in self.latency.items()
+                }
+            }
+
+class Recipient:
+    """One recipient of a transfer and how far it has got."""
+
+    __slots__ = ('name', 'status', 'notified', 'orphaned_since', 'target_dir', 'delivered')
+
+    # A recipient in one of these states may still download the staged files
+    ACTIVE = ('pending', 'accepted', 'downloading')
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'pending'
+        self.notified = False  # file_ready_for_download was sent
+        self.orphaned_since = None
+        self.target_dir = None  # Directory that desktop delivery writes into
+        self.delivered = set()  # Relative paths already delivered into target_dir
+
+    @property
+    def active(self):
+        return self.status in self.ACTIVE
+
+    def to_dict(self):
+        return {'name': self.name, 'status': self.status}
+
+class ExpectedHashes(dict):
+    """``relative_path -> content hash`` announced in a manifest and not received yet."""
+
+    def take(self, relative_path, received_files):
+        """Remove ``relative_path`` and the unreceived paths with the same content.
+
+        Returns ``(digest, duplicates)``; ``digest`` is None if the path was
+        not announced.
+        """
+        digest = self.pop(relative_path, None)
+        duplicates = [path for path, expected in self.items()
+                      if expected == digest and path not in received_files]
+        for path in duplicates:
+            del self[path]
+        return digest, duplicates
+
+class Transfer:
+    """State of one transfer.
+
+    A transfer is uploaded and staged once for one or more ``recipients``
+    (sid -> ``Recipient``), each of which accepts and downloads on its own.
+    ``lock`` guards the upload bookkeeping (``received_files``, ``files``,
+    ``uploaded_files`` and ``unannounced``) against parallel upload requests,
+    and the recipient states. Status changes go through ``TransferStore`` so its per-status
+    counts stay correct.
+    """
+
+    __slots__ = ('transfer_id', 'sender', 'recipients', 'filename', 'filesize', 'status',
+                 'is_directory', 'relay', 'total_files', 'uploaded_files', 'files',
+                 'received_files', 'base_path', 'created_at', 'accepted_at', 'uploaded_at',
+                 'staged_bytes', 'last_touched', 'orphaned_since', 'expected_hashes', 'blobs',
+                 'unannounced', 'compression', 'throughput', 'lock')
+
+    def __init__(self, transfer_id, sender, recipients, filename, filesize,
+                 is_directory=False, relay=False, total_files=1):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.recipients = {sid: Recipient(name) for sid, name in recipients}
+        self.filename = filename
+        self.filesize = filesize
+        self.status = 'pending'
+        self.is_directory = is_directory
+        self.relay = relay
+        self.total_files = total_files
+        self.uploaded_files = 0
+        self.files = []
+        self.received_files = {}  # relative_path -> ReceivedFile
+        self.base_path = None
+        self.created_at = datetime.now().isoformat()
+        self.accepted_at = None
+        self.uploaded_at = None
+        self.staged_bytes = 0
+        self.last_touched = time.monotonic()
+        self.orphaned_since = None
+        self.expected_hashes = ExpectedHashes()  # relative_path -> content hash announced in the manifest
+        self.blobs = []  # content hashes of blob store files this transfer references
+        self.unannounced = []  # staged directory files recipients have not been told about yet
+        self.compression = {'upload': CompressionStats(), 'download': CompressionStats()}
+        self.throughput = {'received': RateMeter(), 'sent': RateMeter()}
+        self.lock = threading.Lock()
+
+    def touch(self):
+        self.last_touched = time.monotonic()
+
+    def compression_stats(self):
+        return {direction: stats.to_dict() for direction, stats in self.compression.items()}
+
+    def active_recipients(self):
+        """Sids of recipients that may still download the staged files."""
+        with self.lock:
+            return [sid for sid, recipient in self.recipients.items() if recipient.active]
+
+    def summary(self):
+        """One-line description for logging, independent of the number of files."""
+        kind = 'directory' if self.is_directory else 'file'
+        return (f'{self.transfer_id[:8]} {kind} {self.filename!r} {self.status} '
+                f'{self.uploaded_files}/{self.total_files} files, {len(self.recipients)} recipients')
+
+    def to_dict(self):
+        return {
+            'transfer_id': self.transfer_id,
+            'sender': self.sender,
+            'recipients': {sid: recipient.to_dict() for sid, recipient in self.recipients.items()},
+            'filename': self.filename,
+            'filesize': self.filesize,
+            'status': self.status,
+            'is_directory': self.is_directory,
+            'relay': self.relay,
+            'total_files': self.total_files,
+            'uploaded_files': self.uploaded_files,
+            'staged_bytes': self.staged_bytes,
+            'compression': self.compression_stats(),
+            'throughput': {direction: meter.to_dict() for direction, meter in self.throughput.items()},
+            'created_at': self.created_at,
+            'accepted_at': self.accepted_at,
+            'uploaded_at': self.uploaded_at
+        }
+
+class StagingQuotaExceeded(Exception):
+    """Raised when an upload does not fit into the staging quota."""
+
+class TransferStore:
+    """Active transfers by ID with O(1) lookups and running per-status counts.
+
+    Also keeps the total number of bytes staged on disk for all transfers.
+    """
+
+    def __init__(self):
+        self.staged_bytes = 0
+        self.peak_staged_bytes = 0
+        self._transfers = {}
+        self._status_counts = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, transfer_id):
+        return transfer_id in self._transfers
+
+    def __len__(self):
+        return len(self._transfers)
+
+    def get(self, transfer_id):
+        return self._transfers.get(transfer_id)
+
+    def values(self):
+        with self._lock:
+            return list(self._transfers.values())
+
+    def create(self, **fields):
+        transfer = Transfer(os.urandom(16).hex(), **fields)
+        with self._lock:
+            self._transfers[transfer.transfer_id] = transfer
+            self._count(transfer.status, 1)
+        return transfer
+
+    def pop(self, transfer_id):
+        with self._lock:
+            transfer = self._transfers.pop(transfer_id, None)
+            if transfer is not None:
+                self._count(transfer.status, -1)
+                self.staged_bytes -= transfer.staged_bytes
+        return transfer
+
+    def set_status(self, transfer, status):
+        with self._lock:
+            if transfer.status == status:
+                return
+            if transfer.transfer_id in self._transfers:
+                self._count(transfer.status, -1)
+                self._count(status, 1)
+            transfer.status = status
+            transfer.touch()
+
+    def try_reserve(self, transfer, nbytes, quota):
+        """Account for ``nbytes`` about to be staged; False if that would exceed ``quota``."""
+        with self._lock:
+            if nbytes > 0 and self.staged_bytes + nbytes > quota:
+                return False
+            self.staged_bytes += nbytes
+            self.peak_staged_bytes = max(self.peak_staged_bytes, self.staged_bytes)
+            transfer.staged_bytes += nbytes
+            transfer.touch()
+            return True
+
+    def least_recently_touched(self, status, exclude=None):
+        with self._lock:
+            candidates = [t for t in self._transfers.values() if t.status == status and t is not exclude]
+        return min(candidates, key=lambda t: t.last_touched, default=None)
+
+    def record_file(self, transfer, file_path, relative_path, size, digest):
+        """Add a fully received file and its content hash.
+
+        Returns True for the file that completes the upload.
+        """
+        with transfer.lock:
+            transfer.files.append({
+                'path': str(file_path),
+                'relative_path': relative_path,
+                'size': size,
+                'hash': digest
+            })
+            transfer.uploaded_files += 1
+            if transfer.uploaded_files < transfer.total_files or transfer.status != 'accepted':
+                return False
+            transfer.base_path = str(Path(app.config['UPLOAD_FOLDER']) / transfer.transfer_id)
+            transfer.uploaded_at = datetime.now().isoformat()
+            self.set_status(transfer, 'ready_for_download')
+            return True
+
+    def status_counts(self):
+        with self._lock:
+            return {status: count for status, count in self._status_counts.items() if count}
+
+    def summary(self):
+        """Transfer counts per status for logging; cost does not grow with transfers."""
+        with self._lock:
+            counts = ', '.join(f'{status}={count}' for status, count in sorted(self._status_counts.items()) if count)
+            return f'{len(self._transfers)} transfers ({counts or "none"}), {self.staged_bytes} bytes staged'
+
+    def _count(self, status, delta):
+        self._status_counts[status] = self._status_counts.get(status, 0) + delta
+
+class BlobStore:
+    """Content-addressed files shared between transfers.
+
+    Blobs are hard-linked into transfer folders and reference counted per
+    linking transfer. Unreferenced blobs are kept as a cache for repeat
+    transfers until they expire or their space is needed.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.unreferenced_bytes = 0
+        self._blobs = {}  # content hash -> [references, size, last released]
+        self._lock = threading.Lock()
+
+    def __contains__(self, digest):
+        return digest in self._blobs
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def _path(self, digest):
+        return self.root / digest
+
+    def _acquire(self, digest, entry):
+        entry[0] += 1
+        if entry[0] == 1:
+            self.unreferenced_bytes -= entry[1]
+
+    def link(self, digest, target_path):
+        """Hard-link a stored blob to ``target_path`` and take a reference; False if unknown."""
+        with self._lock:
+            entry = self._blobs.get(digest)
+            if entry is None:
+                return False
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = target_path.with_name(f'.{target_path.name}.link')
+            os.link(self._path(digest), temp_path)
+            os.replace(temp_path, target_path)
+            self._acquire(digest, entry)
+            return True
+
+    def add(self, digest, file_path, size):
+        """Store a received file under ``digest`` and take a reference.
+
+        If the blob already exists, ``file_path`` is replaced by a link to it
+        so the bytes are kept only once.
+        """
+        with self._lock:
+            entry = self._blobs.get(digest)
+            if entry is None:
+                self.root.mkdir(exist_ok=True)
+                os.link(file_path, self._path(digest))
+                self._blobs[digest] = [1, size, None]
+                return
+        if not self.link(digest, Path(file_path)):
+            self.add(digest, file_path, size)
+
+    def release(self, digests):
+        """Drop one reference to each of ``digests``."""
+        now = time.monotonic()
+        with self._lock:
+            for digest in digests:
+                entry = self._blobs.get(digest)
+                if entry is None:
+                    continue
+                entry[0] -= 1
+                if entry[0] == 0:
+                    entry[2] = now
+                    self.unreferenced_bytes += entry[1]
+
+    def evict(self, max_idle=None):
+        """Delete unreferenced blobs idle for more than ``max_idle`` seconds.
+
+        Without ``max_idle`` only the least recently used unreferenced blob is
+        deleted. Returns the number of bytes freed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = sorted((entry[2], digest) for digest, entry in self._blobs.items() if entry[0] == 0)
+            if max_idle is None:
+                victims = [digest for _, digest in idle[:1]]
+            else:
+                victims = [digest for released, digest in idle if now - released > max_idle]
+            freed = 0
+            for digest in victims:
+                size = self._blobs.pop(digest)[1]
+                self.unreferenced_bytes -= size
+                freed += size
+                try:
+                    os.unlink(self._path(digest))
+                except FileNotFoundError:
+                    pass
+        return freed
+
+# Scheduling of upload and download requests
+class SchedulerBusy(Exception):
+    """Raised when a request waited too long for a transfer slot."""
+
+    def __init__(self, message, position):
+        super().__init__(message)
+        self.position = position
+
+class TokenBucket:
+    """Bytes per second allowance that may briefly go into debt.
+
+    Bytes are paid for after they were moved, so the bucket can be overdrawn
+    by one payment; nothing else is let through until the debt is refilled.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate / 4, 64 * 1024)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until the bucket is out of debt."""
+        return max(0.0, -self.tokens / self.rate)
+
+class Slot:
+    """A request admitted by ``TransferScheduler``, released when its response closes."""
+
+    __slots__ = ('scheduler', 'transfer_id', 'device', 'priority', 'weight', 'seq', 'released')
+
+    def __init__(self, scheduler, transfer_id, device, priority, weight, seq):
+        self.scheduler = scheduler
+        self.transfer_id = transfer_id
+        self.device = device
+        self.priority = priority
+        self.weight = weight
+        self.seq = seq
+        self.released = False
+
+    def throttle(self, nbytes):
+        self.scheduler.throttle(self, nbytes)
+
+    def release(self):
+        self.scheduler.release(self)
+
+class TransferScheduler:
+    """Concurrency caps, rate limits and fair sharing for transfer requests.
+
+    Upload and download requests ``admit`` a slot before they move data. At
+    most ``MAX_ACTIVE_REQUESTS`` run at once and ``MAX_DEVICE_REQUESTS`` per
+    device; the rest wait in arrival order, except that transfers of up to
+    ``PRIORITY_TRANSFER_BYTES`` go first and may use ``PRIORITY_SLOTS``
+    extra slots. Bytes moved are taken from a global and a per-device token
+    bucket. When several requests wait for tokens, the one whose transfer has
+    been served the fewest bytes per unit of weight goes next (weighted fair
+    queueing), so one large transfer cannot starve the others.
+
+    Limits are per process; with several workers each enforces its own.
+    """
+
+    QUANTUM = 64 * 1024  # Bytes paid for at a time by one request
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._seq = 0
+        self._waiting = []  # slots waiting to be admitted, priority first
+        self._active = 0
+        self._priority_active = 0
+        self._devices = {}  # device -> number of admitted slots
+        self._served = {}  # transfer_id -> [virtual time, number of admitted slots]
+        self._clock = 0.0  # virtual time of the last bytes let through
+        self._throttling = []  # admitted slots waiting for tokens
+        self._bucket = None
+        self._device_buckets = {}
+
+    def _fits(self, slot, active, priority_active, device_active):
+        max_active = app.config['MAX_ACTIVE_REQUESTS']
+        max_device = app.config['MAX_DEVICE_REQUESTS']
+        if max_active is not None:
+            # Priority requests fill their own slots first, then the shared ones
+            if slot.priority:
+                max_active += app.config['PRIORITY_SLOTS']
+            else:
+                active -= min(priority_active, app.config['PRIORITY_SLOTS'])
+        return ((max_active is None or active < max_active)
+                and (max_device is None or device_active < max_device))
+
+    def _position(self, slot):
+        """Return 0 if ``slot`` may start now, else its place in the queue.
+
+        Waiting slots are granted in order; one held back by its device's cap
+        does not hold back the slots of other devices behind it.
+        """
+        active = self._active
+        priority_active = self._priority_active
+        devices = dict(self._devices)
+        for position, waiting in enumerate(self._waiting, 1):
+            fits = self._fits(waiting, active, priority_active, devices.get(waiting.device, 0))
+            if waiting is slot:
+                return 0 if fits else position
+            if fits:
+                active += 1
+                priority_active += waiting.priority
+                devices[waiting.device] = devices.get(waiting.device, 0) + 1
+        return len(self._waiting)
+
+    def admit(self, transfer_id, device, size=None, notify=None):
+        """Wait for a free slot for a request of ``transfer_id`` and return it.
+
+        ``notify`` is called with the queue position whenever it changes and
+        with 0 when a request that had to wait is admitted. Raises
+        ``SchedulerBusy`` after ``SCHEDULER_QUEUE_TIMEOUT`` seconds.
+        """
+        priority_bytes = app.config['PRIORITY_TRANSFER_BYTES']
+        priority = priority_bytes is not None and size is not None and size <= priority_bytes
+        weight = app.config['PRIORITY_WEIGHT'] if priority else 1
+        deadline = time.monotonic() + app.config['SCHEDULER_QUEUE_TIMEOUT']
+        with self._condition:
+            self._seq += 1
+            slot = Slot(self, transfer_id, device, priority, weight, self._seq)
+            self._waiting.append(slot)
+            self._waiting.sort(key=lambda waiting: (not waiting.priority, waiting.seq))
+        
+        reported = 0
+        try:
+            while True:
+                with self._condition:
+                    position = self._position(slot)
+                    if position == 0:
+                        self._waiting.remove(slot)
+                        self._grant(slot)
+                        break
+                    if position == reported:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise SchedulerBusy(f'Server busy, queue position {position}', position)
+                        self._condition.wait(remaining)
+                        continue
+                reported = position
+                if notify is not None:
+                    notify(position)
+        except BaseException:
+            with self._condition:
+                if slot in self._waiting:
+                    self._waiting.remove(slot)
+                    self._condition.notify_all()
+            raise
+        
+        if reported and notify is not None:
+            notify(0)
+        return slot
+
+    def _grant(self, slot):
+        self._active += 1
+        self._priority_active += slot.priority
+        self._devices[slot.device] = self._devices.get(slot.device, 0) + 1
+        entry = self._served.setdefault(slot.transfer_id, [self._clock, 0])
+        entry[1] += 1
+
+    def release(self, slot):
+        """Give back the slot; calling it again does nothing."""
+        with self._condition:
+            if slot.released:
+                return
+            slot.released = True
+            self._active -= 1
+            self._priority_active -= slot.priority
+            remaining = self._devices[slot.device] - 1
+            if remaining:
+                self._devices[slot.device] = remaining
+            else:
+                del self._devices[slot.device]
+                self._device_buckets.pop(slot.device, None)
+            entry = self._served[slot.transfer_id]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._served[slot.transfer_id]
+            self._condition.notify_all()
+
+    def _buckets(self, slot, rate, device_rate):
+        buckets = []
+        if rate:
+            if self._bucket is None or self._bucket.rate != rate:
+                self._bucket = TokenBucket(rate)
+            buckets.append(self._bucket)
+        if device_rate:
+            bucket = self._device_buckets.get(slot.device)
+            if bucket is None or bucket.rate != device_rate:
+                bucket = self._device_buckets[slot.device] = TokenBucket(device_rate)
+            buckets.append(bucket)
+        return buckets
+
+    def throttle(self, slot, nbytes):
+        """Take ``nbytes`` moved by ``slot`` from the rate limits.
+
+        The bytes are paid for in ``QUANTUM`` sized parts. Each part waits
+        until this slot's transfer is the most underserved one among those
+        whose buckets are out of debt, so a large read is spread out instead
+        of overdrawing the buckets at once.
+        """
+        rate = app.config['RATE_LIMIT_BYTES']
+        device_rate = app.config['DEVICE_RATE_LIMIT_BYTES']
+        if not nbytes or slot.released or not (rate or device_rate):
+            return
+        with self._condition:
+            # A transfer that was idle starts at the current virtual time, not behind it
+            entry = self._served[slot.transfer_id]
+            entry[0] = max(entry[0], self._clock)
+            self._throttling.append(slot)
+            try:
+                while nbytes:
+                    now = time.monotonic()
+                    ready = []
+                    delay = None
+                    for waiting in self._throttling:
+                        buckets = self._buckets(waiting, rate, device_rate)
+                        for bucket in buckets:
+                            bucket.refill(now)
+                        waiting_delay = max(bucket.delay() for bucket in buckets)
+                        if waiting_delay:
+                            delay = waiting_delay if delay is None else min(delay, waiting_delay)
+                        else:
+                            ready.append(waiting)
+                    turn = min(ready, key=lambda waiting: (self._served[waiting.transfer_id][0], waiting.seq),
+                               default=None)
+                    if turn is not slot:
+                        self._condition.wait(delay)
+                        continue
+                    part = min(nbytes, self.QUANTUM)
+                    for bucket in self._buckets(slot, rate, device_rate):
+                        bucket.tokens -= part
+                    self._clock = entry[0]
+                    entry[0] += part / slot.weight
+                    nbytes -= part
+                    self._condition.notify_all()
+            finally:
+                self._throttling.remove(slot)
+                self._condition.notify_all()
+
+    def snapshot(self):
+        with self._condition:
+            return {'active': self._active, 'queued': len(self._waiting), 'throttled': len(self._throttling)}
+
+# Shared state for several worker processes
+class SharedState:
+    """SQLite database holding the state that worker processes share.
+
+    Every process opens its own connection. Writes happen in transactions
+    that take the database write lock (``BEGIN IMMEDIATE``), so workers
+    take turns; within a process, transactions nest and are serialized by
+    a lock.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS devices (
+            sid TEXT PRIMARY KEY, name TEXT NOT NULL, ip TEXT NOT NULL, pid INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS devices_ip ON devices (ip);
+        CREATE TABLE IF NOT EXISTS transfers (
+            transfer_id TEXT PRIMARY KEY, status TEXT NOT NULL, last_touched REAL NOT NULL,
+            staged_bytes INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS transfer_files (
+            transfer_id TEXT NOT NULL, relative_path TEXT NOT NULL, path TEXT, size INTEGER,
+            received TEXT, complete INTEGER NOT NULL DEFAULT 0, leaves TEXT, staged_seq INTEGER,
+            content_hash TEXT, expected_hash TEXT, PRIMARY KEY (transfer_id, relative_path));
+        CREATE INDEX IF NOT EXISTS transfer_files_staged ON transfer_files (transfer_id, staged_seq);
+        CREATE INDEX IF NOT EXISTS transfer_files_hash ON transfer_files (transfer_id, expected_hash);
+        CREATE TABLE IF NOT EXISTS transfer_blobs (transfer_id TEXT NOT NULL, digest TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS transfer_blobs_transfer ON transfer_blobs (transfer_id);
+        CREATE TABLE IF NOT EXISTS transfer_announcements (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, transfer_id TEXT NOT NULL,
+            relative_path TEXT NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS transfer_announcements_transfer ON transfer_announcements (transfer_id);
+        CREATE TABLE IF NOT EXISTS transfer_delivered (
+            transfer_id TEXT NOT NULL, sid TEXT NOT NULL, relative_path TEXT NOT NULL,
+            PRIMARY KEY (transfer_id, sid, relative_path));
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY, refs INTEGER NOT NULL, size INTEGER NOT NULL, released REAL);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, created REAL NOT NULL,
+            data BLOB NOT NULL);
+    '''
+    TABLES = ('meta', 'devices', 'transfers', 'transfer_files', 'transfer_blobs',
+              'transfer_announcements', 'transfer_delivered', 'blobs', 'messages')
+    VERSION = 2  # Stored as user_version; bump when SCHEMA changes
+
+    def __init__(self, path, timeout=30):
+        self.path = str(path)
+        self.timeout = timeout
+        self._pid = None
+        connection = self._connect()
+        if connection.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            # The state only lives as long as the server, so an older layout is dropped, not migrated
+            connection.executescript(''.join(f'DROP TABLE IF EXISTS {table};' for table in self.TABLES))
+            connection.execute(f'PRAGMA user_version = {self.VERSION}')
+        connection.executescript(self.SCHEMA)
+
+    def _connect(self):
+        # Connections must not cross into another process
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection = connection
+            self._lock = threading.RLock()
+            self._depth = 0
+            self._pid = os.getpid()
+        return self._connection
+
+    def begin(self):
+        connection = self._connect()
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                # Waiting for another worker's write lock must not block the event loop
+                run_blocking(connection.execute, 'BEGIN IMMEDIATE')
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def end(self, exc=None):
+        """Leave a transaction; the outermost one rolls back if ``exc`` is passing through."""
+        try:
+            self._depth -= 1
+            if self._depth == 0 and self._connection.in_transaction:
+                self._connection.execute('ROLLBACK' if exc is not None else 'COMMIT')
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self._connection
+        except BaseException as e:
+            self.end(e)
+            raise
+        self.end()
+
+    def query(self, sql, params=()):
+        connection = self._connect()
+        with self._lock:
+            return connection.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.transaction() as connection:
+            return connection.execute(sql, params).rowcount
+
+    def executemany(self, sql, rows):
+        with self.transaction() as connection:
+            connection.executemany(sql, rows)
+
+    def reset(self):
+        """Forget everything left over from an earlier run."""
+        with self.transaction() as connection:
+            for table in self.TABLES:
+                connection.execute(f'DELETE FROM {table}')
+
+class SharedReceivedFiles:
+    """``received_files`` of a shared transfer, one row per file."""
+
+    def __init__(self, state, transfer_id):
+        self._state = state
+        self._transfer_id = transfer_id
+
+    def _rows(self, where='', params=()):
+        return self._state.query(
+            'SELECT relative_path, path, size, received, complete, leaves FROM transfer_files '
+            f'WHERE transfer_id = ? AND received IS NOT NULL {where}', (self._transfer_id, *params))
+
+    @staticmethod
+    def _received_file(path, size, received, complete, leaves):
+        leaves = {int(index): digest for index, digest in json.loads(leaves or '{}').items()}
+        return ReceivedFile(path, size, json.loads(received), bool(complete), leaves)
+
+    def get(self, relative_path, default=None):
+        rows = self._rows('AND relative_path = ?', (relative_path,))
+        if not rows:
+            return default
+        return self._received_file(*rows[0][1:])
+
+    def __getitem__(self, relative_path):
+        received_file = self.get(relative_path)
+        if received_file is None:
+            raise KeyError(relative_path)
+        return received_file
+
+    def __contains__(self, relative_path):
+        return self.get(relative_path) is not None
+
+    def __setitem__(self, relative_path, received_file):
+        self._state.execute(
+            'INSERT INTO transfer_files (transfer_id, relative_path, path, size, received, complete, leaves) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (transfer_id, relative_path) DO UPDATE SET '
+            'path = excluded.path, size = excluded.size, received = excluded.received, '
+            'complete = excluded.complete, leaves = excluded.leaves',
+            (self._transfer_id, relative_path, received_file.path, received_file.size,
+             json.dumps(received_file.received), int(received_file.complete),
+             json.dumps(received_file.leaves) if received_file.leaves else None))
+
+    def items(self):
+        return [(row[0], self._received_file(*row[1:])) for row in self._rows()]
+
+class SharedStagedFiles:
+    """``files`` of a shared transfer: the fully received files in arrival order."""
+
+    def __init__(self, state, transfer_id):
+        self._state = state
+        self._transfer_id = transfer_id
+
+    def append(self, file_info):
+        self._state.execute(
+            'INSERT INTO transfer_files (transfer_id, relative_path, path, size, content_hash, staged_seq) '
+            'VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(staged_seq), 0) + 1 FROM transfer_files '
+            'WHERE transfer_id = ?)) ON CONFLICT (transfer_id, relative_path) DO UPDATE SET '
+            'path = excluded.path, size = excluded.size, content_hash = excluded.content_hash, '
+            'staged_seq = excluded.staged_seq',
+            (self._transfer_id, file_info['relative_path'], file_info['path'], file_info['size'],
+             file_info['hash'], self._transfer_id))
+
+    def __iter__(self):
+        rows = self._state.query(
+            'SELECT relative_path, path, size, content_hash FROM transfer_files '
+            'WHERE transfer_id = ? AND staged_seq IS NOT NULL ORDER BY staged_seq', (self._transfer_id,))
+        return iter([{'path': path, 'relative_path': relative_path, 'size': size, 'hash': digest}
+                     for relative_path, path, size, digest in rows])
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def __len__(self):
+        return self._state.query(
+            'SELECT COUNT(*) FROM transfer_files WHERE transfer_id = ? AND staged_seq IS NOT NULL',
+            (self._transfer_id,))[0][0]
+
+class SharedExpectedHashes:
+    """``expected_hashes`` of a shared transfer, stored with the file rows."""
+
+    def __init__(self, state, transfer_id):
+        self._state = state
+        self._transfer_id = transfer_id
+
+    def get(self, relative_path, default=None):
+        rows = self._state.query(
+            'SELECT expected_hash FROM transfer_files WHERE transfer_id = ? AND relative_path = ? '
+            'AND expected_hash IS NOT NULL', (self._transfer_id, relative_path))
+        return rows[0][0] if rows else default
+
+    def __setitem__(self, relative_path, digest):
+        self._state.execute(
+            'INSERT INTO transfer_files (transfer_id, relative_path, expected_hash) VALUES (?, ?, ?) '
+            'ON CONFLICT (transfer_id, relative_path) DO UPDATE SET expected_hash = excluded.expected_hash',
+            (self._transfer_id, relative_path, digest))
+
+    def items(self):
+        return self._state.query(
+            'SELECT relative_path, expected_hash FROM transfer_files '
+            'WHERE transfer_id = ? AND expected_hash IS NOT NULL', (self._transfer_id,))
+
+    def take(self, relative_path, received_files):
+        """Like ``ExpectedHashes.take``, looking duplicates up by hash instead of scanning."""
+        with self._state.transaction() as connection:
+            digest = self.get(relative_path)
+            if digest is None:
+                return None, []
+            duplicates = [path for path, in connection.execute(
+                'SELECT relative_path FROM transfer_files WHERE transfer_id = ? AND expected_hash = ? '
+                'AND relative_path != ? AND received IS NULL', (self._transfer_id, digest, relative_path))]
+            connection.execute(
+                'UPDATE transfer_files SET expected_hash = NULL WHERE transfer_id = ? AND expected_hash = ? '
+                'AND (relative_path = ? OR received IS NULL)', (self._transfer_id, digest, relative_path))
+        return digest, duplicates
+
+class SharedRows:
+    """A list-like column of a shared transfer: ``blobs`` or ``unannounced``."""
+
+    def __init__(self, state, transfer_id, table, columns):
+        self._state = state
+        self._transfer_id = transfer_id
+        self._table = table
+        self._columns = columns
+
+    def append(self, item):
+        values = [item] if len(self._columns) == 1 else [item[column] for column in self._columns]
+        self._state.execute(
+            f'INSERT INTO {self._table} (transfer_id, {", ".join(self._columns)}) '
+            f'VALUES (?{", ?" * len(self._columns)})', (self._transfer_id, *values))
+
+    def __iter__(self):
+        order = ' ORDER BY seq' if self._table == 'transfer_announcements' else ''
+        rows = self._state.query(
+            f'SELECT {", ".join(self._columns)} FROM {self._table} WHERE transfer_id = ?{order}',
+            (self._transfer_id,))
+        if len(self._columns) == 1:
+            return iter([row[0] for row in rows])
+        return iter([dict(zip(self._columns, row)) for row in rows])
+
+    def __len__(self):
+        return self._state.query(f'SELECT COUNT(*) FROM {self._table} WHERE transfer_id = ?',
+                                 (self._transfer_id,))[0][0]
+
+    def clear(self):
+        self._state.execute(f'DELETE FROM {self._table} WHERE transfer_id = ?', (self._transfer_id,))
+
+class SharedDeliveredFiles:
+    """``Recipient.delivered`` of a shared transfer."""
+
+    def __init__(self, state, transfer_id, sid):
+        self._state = state
+        self._key = (transfer_id, sid)
+
+    def __contains__(self, relative_path):
+        return bool(self._state.query(
+            'SELECT 1 FROM transfer_delivered WHERE transfer_id = ? AND sid = ? AND relative_path = ?',
+            (*self._key, relative_path)))
+
+    def __iter__(self):
+        return iter([path for path, in self._state.query(
+            'SELECT relative_path FROM transfer_delivered WHERE transfer_id = ? AND sid = ?', self._key)])
+
+    def __len__(self):
+        return self._state.query(
+            'SELECT COUNT(*) FROM transfer_delivered WHERE transfer_id = ? AND sid = ?', self._key)[0][0]
+
+    def update(self, relative_paths):
+        self._state.executemany(
+            'INSERT OR IGNORE INTO transfer_delivered (transfer_id, sid, relative_path) VALUES (?, ?, ?)',
+            [(*self._key, relative_path) for relative_path in relative_paths])
+
+class SharedTransferLock:
+    """``lock`` of a shared transfer: a database transaction.
+
+    The outermost acquisition reloads the transfer, which other workers may
+    have changed, and the matching release writes it back.
+    """
+
+    def __init__(self, transfer):
+        self._transfer = transfer
+        self._depth = 0
+
+    @property
+    def held(self):
+        return self._depth > 0
+
+    def __enter__(self):
+        state = self._transfer._state
+        state.begin()
+        self._depth += 1
+        if self._depth == 1:
+            try:
+                self._transfer.reload()
+            except BaseException as e:
+                self._depth -= 1
+                state.end(e)
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A block that raised leaves nothing behind; the next acquisition reloads
+        try:
+            self._depth -= 1
+            if self._depth == 0 and exc_type is None:
+                self._transfer.save()
+        except BaseException as e:
+            self._transfer._state.end(e)
+            raise
+        self._transfer._state.end(exc)
+
+class SharedTransfer(Transfer):
+    """``Transfer`` whose state lives in the shared database.
+
+    Scalar fields and recipient states are kept as JSON in the transfer row
+    and refreshed whenever ``lock`` is taken; per-file bookkeeping lives in
+    tables of its own. Compression and throughput figures stay per process.
+    """
+
+    __slots__ = ('_state',)
+
+    FIELDS = ('sender', 'filename', 'filesize', 'is_directory', 'relay', 'total_files',
+              'uploaded_files', 'base_path', 'created_at', 'accepted_at', 'uploaded_at', 'orphaned_since')
+    RECIPIENT_FIELDS = ('name', 'status', 'notified', 'orphaned_since', 'target_dir')
+
+    def __init__(self, state, transfer_id, sender, recipients, filename, filesize, **fields):
+        super().__init__(transfer_id, sender, recipients, filename, filesize, **fields)
+        self._state = state
+        self.lock = SharedTransferLock(self)
+        self.files = SharedStagedFiles(state, transfer_id)
+        self.received_files = SharedReceivedFiles(state, transfer_id)
+        self.expected_hashes = SharedExpectedHashes(state, transfer_id)
+        self.blobs = SharedRows(state, transfer_id, 'transfer_blobs', ('digest',))
+        self.unannounced = SharedRows(state, transfer_id, 'transfer_announcements', ('relative_path', 'size', 'hash'))
+        for sid, recipient in self.recipients.items():
+            recipient.delivered = SharedDeliveredFiles(state, transfer_id, sid)
+
+    def dump(self):
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data['recipients'] = {
+            sid: {name: getattr(recipient, name) for name in self.RECIPIENT_FIELDS}
+            for sid, recipient in self.recipients.items()
+        }
+        return json.dumps(data)
+
+    def apply(self, status, last_touched, staged_bytes, state):
+        self.status = status
+        self.last_touched = last_touched
+        self.staged_bytes = staged_bytes
+        data = json.loads(state)
+        for name in self.FIELDS:
+            setattr(self, name, data[name])
+        # Recipient objects are updated in place; callers hold on to them
+        for sid, fields in data['recipients'].items():
+            recipient = self.recipients.get(sid)
+            if recipient is None:
+                recipient = self.recipients[sid] = Recipient(fields['name'])
+                recipient.delivered = SharedDeliveredFiles(self._state, self.transfer_id, sid)
+            for name in self.RECIPIENT_FIELDS:
+                setattr(recipient, name, fields[name])
+
+    def reload(self):
+        rows = self._state.query(
+            'SELECT status, last_touched, staged_bytes, state FROM transfers WHERE transfer_id = ?',
+            (self.transfer_id,))
+        if rows:
+            self.apply(*rows[0])
+        elif isinstance(self.lock, SharedTransferLock):
+            # Dropped by another worker; finish the current operation in memory
+            self.detach()
+
+    def save(self):
+        self._state.execute('UPDATE transfers SET state = ? WHERE transfer_id = ?',
+                            (self.dump(), self.transfer_id))
+
+    def touch(self):
+        super().touch()
+        self._state.execute('UPDATE transfers SET last_touched = ? WHERE transfer_id = ?',
+                            (self.last_touched, self.transfer_id))
+
+    def detach(self):
+        """Copy the per-file state into memory before the transfer's rows are deleted."""
+        self.files = list(self.files)
+        self.received_files = dict(self.received_files.items())
+        self.expected_hashes = ExpectedHashes(self.expected_hashes.items())
+        self.blobs = list(self.blobs)
+        self.unannounced = list(self.unannounced)
+        for recipient in self.recipients.values():
+            recipient.delivered = set(recipient.delivered)
+        self.lock = threading.Lock()
+
+class SharedTransferStore(TransferStore):
+    """``TransferStore`` keeping transfers in the shared database.
+
+    Each process caches the ``SharedTransfer`` objects it has loaded, so
+    requests in one worker see the same object as they would in memory.
+    """
+
+    def __init__(self, state):
+        self._state = state
+        self._cache = {}
+        self._pruned_at = time.monotonic()
+        state.executemany('INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)',
+                          [('staged_bytes',), ('peak_staged_bytes',)])
+
+    def _meta(self, key):
+        return self._state.query('SELECT value FROM meta WHERE key = ?', (key,))[0][0]
+
+    @property
+    def staged_bytes(self):
+        return self._meta('staged_bytes')
+
+    @property
+    def peak_staged_bytes(self):
+        return self._meta('peak_staged_bytes')
+
+    def __contains__(self, transfer_id):
+        return bool(self._state.query('SELECT 1 FROM transfers WHERE transfer_id = ?', (transfer_id,)))
+
+    def __len__(self):
+        return self._state.query('SELECT COUNT(*) FROM transfers')[0][0]
+
+    def _load(self, row):
+        transfer_id, *fields = row
+        transfer = self._cache.get(transfer_id)
+        if transfer is None:
+            data = json.loads(fields[-1])
+            transfer = self._cache[transfer_id] = SharedTransfer(
+                self._state, transfer_id, data['sender'], [], data['filename'], data['filesize'])
+        elif transfer.lock.held:
+            # Whoever holds the lock has the latest state, possibly unsaved
+            return transfer
+        transfer.apply(*fields)
+        return transfer
+
+    def get(self, transfer_id):
+        rows = self._state.query(
+            'SELECT transfer_id, status, last_touched, staged_bytes, state FROM transfers '
+            'WHERE transfer_id = ?', (transfer_id,))
+        if not rows:
+            self._cache.pop(transfer_id, None)
+            return None
+        return self._load(rows[0])
+
+    def values(self):
+        rows = self._state.query(
+            'SELECT transfer_id, status, last_touched, staged_bytes, state FROM transfers')
+        transfers = [self._load(row) for row in rows]
+        # Forget transfers other workers have dropped
+        self._cache = {transfer.transfer_id: transfer for transfer in transfers}
+        self._pruned_at = time.monotonic()
+        return transfers
+
+    def create(self, **fields):
+        transfer = SharedTransfer(self._state, os.urandom(16).hex(), **fields)
+        self._state.execute(
+            'INSERT INTO transfers (transfer_id, status, last_touched, state) VALUES (?, ?, ?, ?)',
+            (transfer.transfer_id, transfer.status, transfer.last_touched, transfer.dump()))
+        if time.monotonic() - self._pruned_at > app.config['REAPER_INTERVAL']:
+            self.values()
+        self._cache[transfer.transfer_id] = transfer
+        return transfer
+
+    def pop(self, transfer_id):
+        with self._state.transaction() as connection:
+            transfer = self.get(transfer_id)
+            if transfer is None:
+                return None
+            self._cache.pop(transfer_id, None)
+            transfer.detach()
+            for table in ('transfer_files', 'transfer_blobs', 'transfer_announcements',
+                          'transfer_delivered', 'transfers'):
+                connection.execute(f'DELETE FROM {table} WHERE transfer_id = ?', (transfer_id,))
+            connection.execute("UPDATE meta SET value = value - ? WHERE key = 'staged_bytes'",
+                               (transfer.staged_bytes,))
+        return transfer
+
+    def set_status(self, transfer, status):
+        if transfer.status == status:
+            return
+        self._state.execute('UPDATE transfers SET status = ? WHERE transfer_id = ?',
+                            (status, transfer.transfer_id))
+        transfer.status = status
+        transfer.touch()
+
+    def try_reserve(self, transfer, nbytes, quota):
+        with self._state.transaction() as connection:
+            staged_bytes = self.staged_bytes
+            if nbytes > 0 and staged_bytes + nbytes > quota:
+                return False
+            connection.execute("UPDATE meta SET value = ? WHERE key = 'staged_bytes'", (staged_bytes + nbytes,))
+            connection.execute("UPDATE meta SET value = MAX(value, ?) WHERE key = 'peak_staged_bytes'",
+                               (staged_bytes + nbytes,))
+            connection.execute('UPDATE transfers SET staged_bytes = staged_bytes + ? WHERE transfer_id = ?',
+                               (nbytes, transfer.transfer_id))
+            transfer.staged_bytes += nbytes
+            transfer.touch()
+            return True
+
+    def least_recently_touched(self, status, exclude=None):
+        rows = self._state.query(
+            'SELECT transfer_id FROM transfers WHERE status = ? AND transfer_id != ? '
+            'ORDER BY last_touched LIMIT 1', (status, exclude.transfer_id if exclude is not None else ''))
+        return self.get(rows[0][0]) if rows else None
+
+    def status_counts(self):
+        return dict(self._state.query('SELECT status, COUNT(*) FROM transfers GROUP BY status'))
+
+    def summary(self):
+        counts = ', '.join(f'{status}={count}' for status, count in sorted(self.status_counts().items()))
+        return f'{len(self)} transfers ({counts or "none"}), {self.staged_bytes} bytes staged'
+
+class SharedDeviceRegistry(DeviceRegistry):
+    """``DeviceRegistry`` in the shared database; devices remember their worker's pid."""
+
+    def __init__(self, state):
+        self._state = state
+        state.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('device_version', 0)")
+
+    @property
+    def version(self):
+        return self._state.query("SELECT value FROM meta WHERE key = 'device_version'")[0][0]
+
+    def __contains__(self, sid):
+        return self.get(sid) is not None
+
+    def __getitem__(self, sid):
+        device = self.get(sid)
+        if device is None:
+            raise KeyError(sid)
+        return device
+
+    def __len__(self):
+        return self._state.query('SELECT COUNT(*) FROM devices')[0][0]
+
+    def get(self, sid, default=None):
+        rows = self._state.query('SELECT sid, name, ip FROM devices WHERE sid = ?', (sid,))
+        if not rows:
+            return default
+        return dict(zip(('id', 'name', 'ip'), rows[0]))
+
+    def add(self, sid, name, ip):
+        with self._state.transaction() as connection:
+            evicted = None
+            rows = connection.execute('SELECT sid FROM devices WHERE ip = ? AND sid != ?', (ip, sid)).fetchall()
+            if rows:
+                evicted = (self._remove(rows[0][0]), self.version)
+            connection.execute('INSERT OR REPLACE INTO devices (sid, name, ip, pid) VALUES (?, ?, ?, ?)',
+                               (sid, name, ip, os.getpid()))
+            return evicted, self._bump()
+
+    def remove(self, sid):
+        with self._state.transaction():
+            if sid not in self:
+                return None, self.version
+            return self._remove(sid), self.version
+
+    def rename(self, sid, name):
+        with self._state.transaction() as connection:
+            if not connection.execute('UPDATE devices SET name = ? WHERE sid = ?', (name, sid)).rowcount:
+                return None
+            return self._bump()
+
+    def snapshot(self):
+        with self._state.transaction() as connection:
+            rows = connection.execute('SELECT sid, name, ip FROM devices').fetchall()
+            return {
+                'version': self.version,
+                'devices': {sid: {'id': sid, 'name': name, 'ip': ip} for sid, name, ip in rows}
+            }
+
+    def remove_worker(self, pid):
+        """Drop the devices of a worker that died; returns ``[(device, version)]``."""
+        with self._state.transaction():
+            sids = [sid for sid, in self._state.query('SELECT sid FROM devices WHERE pid = ?', (pid,))]
+            return [(self._remove(sid), self.version) for sid in sids]
+
+    def _remove(self, sid):
+        device = self.get(sid)
+        self._state.execute('DELETE FROM devices WHERE sid = ?', (sid,))
+        self._bump()
+        return device
+
+    def _bump(self):
+        self._state.execute("UPDATE meta SET value = value + 1 WHERE key = 'device_version'")
+        return self.version
+
+class SharedBlobStore(BlobStore):
+    """``BlobStore`` whose reference counts live in the shared database."""
+
+    def __init__(self, state, root):
+        self.root = Path(root)
+        self._state = state
+
+    @property
+    def unreferenced_bytes(self):
+        return self._state.query('SELECT COALESCE(SUM(size), 0) FROM blobs WHERE refs = 0')[0][0]
+
+    def __contains__(self, digest):
+        return bool(self._state.query('SELECT 1 FROM blobs WHERE digest = ?', (digest,)))
+
+    def __len__(self):
+        return self._state.query('SELECT COUNT(*) FROM blobs')[0][0]
+
+    def link(self, digest, target_path):
+        with self._state.transaction() as connection:
+            if digest not in self:
+                return False
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = target_path.with_name(f'.{target_path.name}.link')
+            os.link(self._path(digest), temp_path)
+            os.replace(temp_path, target_path)
+            connection.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?', (digest,))
+            return True
+
+    def add(self, digest, file_path, size):
+        with self._state.transaction() as connection:
+            if digest not in self:
+                self.root.mkdir(exist_ok=True)
+                os.link(file_path, self._path(digest))
+                connection.execute('INSERT INTO blobs (digest, refs, size) VALUES (?, 1, ?)', (digest, size))
+                return
+        if not self.link(digest, Path(file_path)):
+            self.add(digest, file_path, size)
+
+    def release(self, digests):
+        self._state.executemany(
+            'UPDATE blobs SET refs = refs - 1, released = CASE WHEN refs = 1 THEN ? ELSE released END '
+            'WHERE digest = ? AND refs > 0', [(time.monotonic(), digest) for digest in digests])
+
+    def evict(self, max_idle=None):
+        with self._state.transaction() as connection:
+            if max_idle is None:
+                victims = connection.execute(
+                    'SELECT digest, size FROM blobs WHERE refs = 0 ORDER BY released LIMIT 1').fetchall()
+            else:
+                victims = connection.execute(
+                    'SELECT digest, size FROM blobs WHERE refs = 0 AND released < ?',
+                    (time.monotonic() - max_idle,)).fetchall()
+            for digest, _ in victims:
+                connection.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                try:
+                    os.unlink(self._path(digest))
+                except FileNotFoundError:
+                    pass
+        return sum(size for _, size in victims)
+
+class SQLiteQueueManager(PubSubManager):
+    """Socket.IO client manager passing events between workers through ``SharedState``.
+
+    Stands in for a Redis or RabbitMQ message queue when none is configured:
+    published events are rows of the ``messages`` table that every worker
+    polls for.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, state, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._state = state
+
+    def _publish(self, data):
+        self._state.execute('INSERT INTO messages (channel, created, data) VALUES (?, ?, ?)',
+                            (self.channel, time.time(), pickle.dumps(data)))
+
+    def _listen(self):
+        last_id = self._state.query('SELECT COALESCE(MAX(id), 0) FROM messages')[0][0]
+        pruned_at = time.monotonic()
+        while True:
+            rows = self._state.query('SELECT id, data FROM messages WHERE id > ? AND channel = ? ORDER BY id',
+                                     (last_id, self.channel))
+            for message_id, data in rows:
+                last_id = message_id
+                yield data
+            if time.monotonic() - pruned_at > app.config['MESSAGE_RETENTION']:
+                self._state.execute('DELETE FROM messages WHERE created < ?',
+                                    (time.time() - app.config['MESSAGE_RETENTION'],))
+                pruned_at = time.monotonic()
+            if not rows:
+                self.server.sleep(app.config['MESSAGE_POLL_INTERVAL'])
+
+# Static assets
+class StaticAsset:
+    """A file served from memory, compressed once with every coding that shrinks it."""
+
+    __slots__ = ('mimetype', 'etag', 'variants')
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:16]
+        self.variants = {None: data}  # content coding -> body
+        for encoding in STATIC_ENCODINGS:
+            if encoding == 'br':
+                body = brotli.compress(data, quality=11)
+            else:
+                body = gzip.compress(data, 9, mtime=0)
+            if len(body) < len(data):
+                self.variants[encoding] = body
+
+def load_static_assets(folder):
+    """Read and precompress every file under ``folder``, keyed by its path relative to it."""
+    assets = {}
+    for path in sorted(Path(folder).rglob('*')):
+        if path.is_file():
+            mimetype = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+            assets[path.relative_to(folder).as_posix()] = StaticAsset(path.read_bytes(), mimetype)
+    logger.info(f'Loaded {len(assets)} static assets from {folder}')
+    return assets
+
+def send_asset(asset, immutable=False):
+    """Answer with the smallest variant of ``asset`` the client accepts.
+
+    ``immutable`` assets may be cached for ``STATIC_ASSET_MAX_AGE`` without
+    asking again; the rest are revalidated with their ETag on every use.
+    """
+    encoding = next((encoding for encoding in STATIC_ENCODINGS
+                     if encoding in asset.variants and request.accept_encodings[encoding]), None)
+    etag = f'{asset.etag}-{encoding}' if encoding else asset.etag
+    response = Response(mimetype=asset.mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_ASSET_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+    
+    response.set_data(asset.variants[encoding])
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+@app.template_global()
+def asset_url(filename):
+    """URL of a static asset that names its content hash, so browsers can keep it for good."""
+    return f'/static/{filename}?{urlencode({"v": static_assets[filename].etag})}'
 
 # Global state
-connected_devices = {}  # Store connected devices with additional metadata
-active_transfers = {}   # Store ongoing transfers
+connected_devices = DeviceRegistry()  # Store connected devices with additional metadata
+active_transfers = TransferStore()   # Store ongoing transfers
+relay_buffers = {}  # transfer_id -> RelayBuffer for live relay transfers
+metrics = Metrics()  # Counters and histograms served on /metrics
+blob_store = BlobStore(Path(app.config['UPLOAD_FOLDER']) / 'blobs')  # Deduplicated file contents
+shared_state = None  # SharedState when worker processes share devices and transfers
+scheduler = TransferScheduler()  # Concurrency caps and rate limits for uploads and downloads
+server_info_cache = {'url': None, 'qr_code': None}  # QR code for the current server URL
+index_page_cache = {'url': None, 'page': None}  # Index page rendered for the current server URL
+static_assets = load_static_assets(os.path.join(app.root_path, 'static'))  # Precompressed files of static/
+server_info_lock = threading.Lock()
 server_port = None  # Global variable to store the port
 
 # Utility functions
+def run_blocking(func, *args, **kwargs):
+    """Run blocking file I/O in a native thread under eventlet or gevent.
+
+    Disk reads and writes are not cooperative, so without this one large file
+    operation would stall every other connection on the event loop.
+    """
+    if ASYNC_MODE == 'eventlet':
+        return eventlet.tpool.execute(func, *args, **kwargs)
+    if ASYNC_MODE == 'gevent':
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+def count_bytes(transfer, direction, nbytes, slot=None):
+    """Add bytes received from or sent to a client to the transfer and global counters.
+
+    With a scheduler ``slot`` the bytes are also taken from the rate limits,
+    which may block until it is the transfer's turn.
+    """
+    if transfer is not None:
+        transfer.throughput[direction].add(nbytes)
+    metrics.add_bytes(direction, nbytes)
+    if slot is not None:
+        slot.throttle(nbytes)
+
 def get_ip_addresses():
     """Get all non-loopback IPv4 addresses for this machine."""
     ip_addresses = []
@@ -57,6 +1807,43 @@ def get_ip_addresses():
     
     return [ip for ip in ip_addresses if not ip.startswith('127.')]
 
+class NetworkSnapshot:
+    """Cached result of ``get_ip_addresses()``.
+
+    Walking every interface is slow on hosts with many docker/veth
+    interfaces, so the result is reused until it is older than ``ttl``.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._addresses = []
+        self._taken_at = None
+        self._lock = threading.Lock()
+
+    def addresses(self):
+        with self._lock:
+            fresh = self._taken_at is not None and time.monotonic() - self._taken_at < self.ttl
+        if not fresh:
+            self.refresh()
+        return self._addresses
+
+    def primary(self):
+        addresses = self.addresses()
+        return addresses[0] if addresses else None
+
+    def refresh(self):
+        """Walk the interfaces again and return whether the addresses changed."""
+        addresses = get_ip_addresses()
+        with self._lock:
+            changed = addresses != self._addresses
+            self._addresses = addresses
+            self._taken_at = time.monotonic()
+        if changed:
+            logger.info(f'Network addresses: {addresses}')
+        return changed
+
+network_snapshot = NetworkSnapshot(app.config['NETWORK_SNAPSHOT_TTL'])
+
 def get_device_ip(request):
     """Get the actual IP address of a connecting device."""
     if request.environ.get('HTTP_X_FORWARDED_FOR'):
@@ -66,67 +1853,1331 @@ def get_device_ip(request):
     
     # If it's localhost/127.0.0.1, get the actual network IP
     if device_ip in ['127.0.0.1', 'localhost']:
-        network_ips = get_ip_addresses()
+        network_ips = network_snapshot.addresses()
         if network_ips:
             device_ip = network_ips[0]  # Use the first non-loopback IP
     
     return device_ip
 
+def merge_range(ranges, start, end):
+    """Add the half-open byte range [start, end) to a sorted list of ranges."""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start = min(start, range_start)
+            end = max(end, range_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+def missing_ranges(ranges, size):
+    """Return the byte ranges of [0, size) not covered by the given ranges."""
+    missing = []
+    position = 0
+    for range_start, range_end in ranges:
+        if range_start > position:
+            missing.append([position, range_start])
+        position = max(position, range_end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+def staged_path(transfer, relative_path):
+    """Return where a file of ``transfer`` is staged, or None for an unsafe path."""
+    transfer_path = str(Path(app.config['UPLOAD_FOLDER']) / transfer.transfer_id)
+    if not relative_path:
+        return None
+    if transfer.is_directory:
+        file_path = safe_join(transfer_path, relative_path)
+    else:
+        file_path = safe_join(transfer_path, secure_filename(relative_path))
+    return Path(file_path) if file_path else None
+
+def preallocate(f, size):
+    """Extend an open file to ``size`` bytes, reserving the blocks where supported.
+
+    ``fallocate`` lets the filesystem lay the file out in few extents and
+    fails early when the disk is full instead of halfway through the upload.
+    """
+    if size and app.config['UPLOAD_PREALLOCATE'] and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            logger.debug(f'fallocate failed for {f.name}, truncating instead: {str(e)}')
+    f.truncate(size)
+
+def create_staged_file(file_path, size):
+    """Create ``file_path`` with ``size`` preallocated bytes, making its parent directories."""
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(file_path, 'wb') as f:
+        preallocate(f, size)
+
+def open_received_file(transfer, relative_path, file_path, filesize):
+    """Return the ``ReceivedFile`` of an upload, preallocating the file on first use.
+
+    The file is created under a temporary name outside ``transfer.lock``, which
+    with shared state is a database transaction, and moved into place by the
+    request that registers it; a request that loses that race drops its copy.
+    Raises ValueError if ``filesize`` differs from the size declared before.
+    """
+    with transfer.lock:
+        received_file = transfer.received_files.get(relative_path)
+    if received_file is None:
+        reserve_staging(transfer, filesize)
+        temp_path = file_path.with_name(f'.{file_path.name}.{os.urandom(8).hex()}')
+        try:
+            run_blocking(create_staged_file, temp_path, filesize)
+            with transfer.lock:
+                received_file = transfer.received_files.get(relative_path)
+                if received_file is None:
+                    os.replace(temp_path, file_path)
+                    received_file = transfer.received_files[relative_path] = ReceivedFile(str(file_path), filesize)
+                    return received_file
+        except BaseException:
+            release_staging(transfer, filesize)
+            temp_path.unlink(missing_ok=True)
+            raise
+        logger.info(f'{relative_path} was opened by a concurrent upload, dropping {temp_path}')
+        release_staging(transfer, filesize)
+        run_blocking(temp_path.unlink)
+    if received_file.size != filesize:
+        raise ValueError(f'File size changed for {relative_path}: {received_file.size} != {filesize}')
+    return received_file
+
+def add_received_range(transfer, relative_path, offset, written, leaves=None):
+    """Mark ``written`` bytes at ``offset`` of an opened upload as received.
+
+    ``leaves`` are the block digests a ``BlockHasher`` took of those bytes.
+    Returns the ranges still missing and whether this call completed the file.
+    """
+    transfer.touch()
+    with transfer.lock:
+        # Re-read under the lock; with shared state another worker may have added ranges
+        received_file = transfer.received_files[relative_path]
+        if written:
+            received_file.received = merge_range(received_file.received, offset, offset + written)
+        if leaves:
+            received_file.leaves.update(leaves)
+        missing = missing_ranges(received_file.received, received_file.size)
+        file_complete = not missing and not received_file.complete
+        if file_complete:
+            received_file.complete = True
+        transfer.received_files[relative_path] = received_file
+    return missing, file_complete
+
+def content_hash(file_path, chunk_size=HASH_CHUNK_SIZE):
+    """Hash a file the way clients do: SHA-256 over the SHA-256 of each chunk.
+
+    Hashing chunk by chunk lets browsers, which can only digest whole
+    buffers, hash large files without holding them in memory.
+    """
+    tree = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            tree.update(hashlib.sha256(data).digest())
+    return tree.hexdigest()
+
+class BlockHasher:
+    """Hash the ``HASH_CHUNK_SIZE`` blocks of a file while a write streams through.
+
+    A write starting at ``offset`` hashes every block it covers from the
+    block's start up to the block's end or the end of the file at
+    ``filesize``. ``leaves`` maps block indexes to their digests; blocks a
+    write covers only in part are read back from disk by ``tree_hash``.
+    """
+
+    def __init__(self, offset=0, filesize=None):
+        self.position = offset
+        self.filesize = filesize
+        self.leaves = {}
+        self._block = None
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            index, within = divmod(self.position, HASH_CHUNK_SIZE)
+            if within == 0:
+                self._block = hashlib.sha256()
+            size = min(len(view), HASH_CHUNK_SIZE - within)
+            if self._block is not None:
+                self._block.update(view[:size])
+            self.position += size
+            view = view[size:]
+            if within + size == HASH_CHUNK_SIZE or self.position == self.filesize:
+                self._finish(index)
+
+    def write(self, f, data):
+        """Write ``data`` to ``f`` and hash it, in one ``run_blocking`` call."""
+        f.write(data)
+        self.update(data)
+
+    def close(self):
+        """End the write; without a ``filesize`` it is taken to end the file."""
+        if self.filesize is None and self.position % HASH_CHUNK_SIZE:
+            self._finish(self.position // HASH_CHUNK_SIZE)
+
+    def _finish(self, index):
+        if self._block is not None:
+            self.leaves[index] = self._block.hexdigest()
+            self._block = None
+
+def tree_hash(file_path, size, leaves):
+    """Return the ``content_hash`` of a file from the digests of its blocks.
+
+    Blocks missing from ``leaves`` are read from disk, so a file hashed
+    entirely while it was received is never read again.
+    """
+    tree = hashlib.sha256()
+    f = None
+    try:
+        for index in range(-(-size // HASH_CHUNK_SIZE)):
+            leaf = leaves.get(index)
+            if leaf is None:
+                if f is None:
+                    f = open(file_path, 'rb')
+                f.seek(index * HASH_CHUNK_SIZE)
+                leaf = hashlib.sha256(f.read(HASH_CHUNK_SIZE)).hexdigest()
+            tree.update(bytes.fromhex(leaf))
+    finally:
+        if f is not None:
+            f.close()
+    return tree.hexdigest()
+
+def save_hashed(stream, file_path, block_size=1024 * 1024):
+    """Copy ``stream`` to ``file_path`` and return the content hash of the copy."""
+    hasher = BlockHasher()
+    with open(file_path, 'wb') as f:
+        while True:
+            data = stream.read(block_size)
+            if not data:
+                break
+            hasher.write(f, data)
+    hasher.close()
+    return tree_hash(file_path, hasher.position, hasher.leaves)
+
+def is_content_hash(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def staging_quota():
+    """Return the staging quota in bytes, defaulting to 90% of the free space at startup."""
+    if app.config['STAGING_QUOTA_BYTES'] is None:
+        free = shutil.disk_usage(app.config['UPLOAD_FOLDER']).free
+        app.config['STAGING_QUOTA_BYTES'] = int(free * 0.9)
+    return app.config['STAGING_QUOTA_BYTES']
+
+def reserve_staging(transfer, nbytes):
+    """Account for bytes about to be staged, evicting old ready transfers if needed.
+
+    Cached blobs go first, then ready transfers, least recently used first. Raises
+    ``StagingQuotaExceeded`` if the bytes still do not fit.
+    """
+    quota = staging_quota()
+    while not active_transfers.try_reserve(transfer, nbytes, quota - blob_store.unreferenced_bytes):
+        if blob_store.evict():
+            continue
+        victim = active_transfers.least_recently_touched('ready_for_download', exclude=transfer)
+        if victim is None:
+            raise StagingQuotaExceeded(
+                f'Server staging area is full: {active_transfers.staged_bytes} of {quota} bytes in use, '
+                f'{nbytes} more needed. Try again after pending transfers finish.')
+        purge_transfer(victim.transfer_id, 'Evicted to free staging space')
+
+def release_staging(transfer, nbytes):
+    """Give back bytes reserved with ``reserve_staging`` that were not staged after all."""
+    active_transfers.try_reserve(transfer, -nbytes, staging_quota())
+
+def discard_transfer(transfer_id):
+    """Forget a transfer and delete its staged files; returns the transfer or None."""
+    transfer = active_transfers.pop(transfer_id)
+    transfer_path = Path(app.config['UPLOAD_FOLDER']) / transfer_id
+    if transfer_path.exists():
+        shutil.rmtree(transfer_path, ignore_errors=True)
+    if transfer is not None:
+        # Deduplicated contents stay cached in the blob store
+        blob_store.release(transfer.blobs)
+    return transfer
+
+def purge_transfer(transfer_id, reason):
+    """Drop a transfer, delete its staged files and tell everyone involved why."""
+    relay = relay_buffers.pop(transfer_id, None)
+    if relay is not None:
+        relay.abort(reason)
+    transfer = discard_transfer(transfer_id)
+    if transfer is None:
+        return
+    
+    logger.info(f'Purged transfer {transfer.summary()}: {reason}')
+    for sid in [transfer.sender] + transfer.active_recipients():
+        if sid in connected_devices:
+            socketio.emit('transfer_expired', {
+                'transfer_id': transfer_id,
+                'filename': transfer.filename,
+                'reason': reason
+            }, room=sid)
+
+def update_recipient(transfer, sid, status):
+    """Move one recipient to ``status`` and tell the sender.
+
+    Once no recipient needs the staged files any more the transfer is
+    finished. Returns False if ``sid`` is not a recipient of the transfer.
+    """
+    with transfer.lock:
+        recipient = transfer.recipients.get(sid)
+        if recipient is None:
+            return False
+        recipient.status = status
+        statuses = {recipient.status for recipient in transfer.recipients.values()}
+    transfer.touch()
+    logger.info(f'Recipient {recipient.name} of transfer {transfer.transfer_id} is now {status}')
+    
+    if transfer.sender in connected_devices:
+        socketio.emit('transfer_recipient_status', {
+            'transfer_id': transfer.transfer_id,
+            'recipient': sid,
+            'name': recipient.name,
+            'status': status,
+            'recipient_count': len(transfer.recipients)
+        }, room=transfer.sender)
+    
+    if not statuses.intersection(Recipient.ACTIVE):
+        finish_transfer(transfer, statuses)
+    return True
+
+def finish_transfer(transfer, statuses):
+    """Clean up a transfer none of whose recipients still needs it."""
+    transfer_id = transfer.transfer_id
+    if 'completed' in statuses:
+        if discard_transfer(transfer_id) is not None:
+            logger.info(f'File transfer completed and cleaned up: {transfer_id}, '
+                        f'compression: {transfer.compression_stats()}')
+    elif statuses == {'rejected'}:
+        if discard_transfer(transfer_id) is not None and transfer.sender in connected_devices:
+            socketio.emit('file_transfer_rejected', {'transfer_id': transfer_id}, room=transfer.sender)
+        logger.info(f'Transfer {transfer_id} cleaned up after rejection')
+    else:
+        purge_transfer(transfer_id, 'No recipient is left')
+
 def cleanup_old_transfers():
-    """Remove old transfer data and files."""
-    # TODO: Implement periodic cleanup of old transfers
-    pass
+    """Remove old transfer data and files.
+
+    Purges transfers that sat idle longer than their state's TTL and
+    transfers whose sender has been disconnected for longer than
+    ``DISCONNECT_GRACE`` before the upload finished. Recipients disconnected
+    that long expire; a transfer goes once its last recipient has. Expired
+    cached blobs and staged folders that no longer belong to any transfer
+    are deleted as well.
+    """
+    now = time.monotonic()
+    ttls = app.config['TRANSFER_TTLS']
+    grace = app.config['DISCONNECT_GRACE']
+    
+    for transfer in active_transfers.values():
+        ttl = ttls.get(transfer.status)
+        if ttl is not None and now - transfer.last_touched > ttl:
+            purge_transfer(transfer.transfer_id, f'Expired after {ttl} seconds in state {transfer.status}')
+            continue
+        
+        sender_needed = transfer.status in ('pending', 'accepted')
+        with transfer.lock:
+            if not sender_needed or transfer.sender in connected_devices:
+                transfer.orphaned_since = None
+            elif transfer.orphaned_since is None:
+                transfer.orphaned_since = now
+            sender_gone = transfer.orphaned_since is not None and now - transfer.orphaned_since > grace
+        if sender_gone:
+            purge_transfer(transfer.transfer_id, 'Sender disconnected')
+            continue
+        
+        expired = []
+        with transfer.lock:
+            for sid, recipient in transfer.recipients.items():
+                if not recipient.active or sid in connected_devices:
+                    recipient.orphaned_since = None
+                elif recipient.orphaned_since is None:
+                    recipient.orphaned_since = now
+                elif now - recipient.orphaned_since > grace:
+                    expired.append(sid)
+        for sid in expired:
+            update_recipient(transfer, sid, 'expired')
+    
+    blob_store.evict(app.config['BLOB_CACHE_TTL'])
+    
+    upload_folder = Path(app.config['UPLOAD_FOLDER'])
+    for entry in upload_folder.iterdir():
+        if entry.is_dir() and entry.name not in active_transfers and entry != blob_store.root:
+            logger.info(f'Removing stale staging folder {entry}')
+            shutil.rmtree(entry, ignore_errors=True)
+
+def run_reaper(interval):
+    """Background task running ``cleanup_old_transfers`` every ``interval`` seconds."""
+    while True:
+        socketio.sleep(interval)
+        try:
+            cleanup_old_transfers()
+        except Exception as e:
+            logger.error(f'Error cleaning up transfers: {str(e)}', exc_info=True)
+
+
+def generate_qr_code(url):
+    """Generate QR code for the given URL and return as base64 string."""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+def sniff_mime(sample, filename=None):
+    """Guess a MIME type from file content, falling back to the file name."""
+    if magic is not None and sample:
+        try:
+            return magic.from_buffer(sample, mime=True)
+        except Exception as e:
+            logger.debug(f'MIME sniffing failed: {str(e)}')
+    return mimetypes.guess_type(filename or '')[0] or 'application/octet-stream'
+
+def worth_compressing(sample, filename=None):
+    """Decide from the first block of a file whether compressing it pays off.
+
+    Media and archive types are skipped without trying; anything else has to
+    shrink noticeably when the block is compressed at the fastest level.
+    """
+    if len(sample) < app.config['COMPRESSION_MIN_SIZE']:
+        return False
+    mime = sniff_mime(sample, filename)
+    if mime in PRECOMPRESSED_MIME_TYPES:
+        return False
+    if mime.split('/')[0] in ('image', 'audio', 'video') and mime not in UNCOMPRESSED_MEDIA_TYPES:
+        return False
+    probe = sample[:app.config['COMPRESSION_PROBE_SIZE']]
+    return len(zlib.compress(probe, 1)) < len(probe) * app.config['COMPRESSION_MIN_RATIO']
+
+def choose_encoding(accepted):
+    """Pick the preferred content coding the client accepts, or None."""
+    for encoding in CONTENT_ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+def make_compressor(encoding):
+    level = app.config['COMPRESSION_LEVELS'][encoding]
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+def timed(func, *args):
+    """Call ``func`` and return its result with the CPU time the call took."""
+    started = time.thread_time()
+    result = func(*args)
+    return result, time.thread_time() - started
+
+class WireCounter:
+    """Counts the bytes read from a request body before decoding.
+
+    ``on_read`` is called with the size of every read, e.g. to throttle it.
+    """
+
+    def __init__(self, stream, on_read=None):
+        self.stream = stream
+        self.count = 0
+        self.on_read = on_read
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        if self.on_read is not None:
+            self.on_read(len(data))
+        return data
+
+class DecodedStream:
+    """Read a request body, decoding a gzip or zstd Content-Encoding on the fly.
+
+    Every read returns at most the requested number of decoded bytes, so a
+    small compressed body cannot expand into memory all at once.
+    """
+
+    def __init__(self, stream, encoding=None, block_size=1024 * 1024, on_read=None):
+        self.encoding = encoding
+        self.cpu_seconds = 0.0
+        self._wire = WireCounter(stream, on_read)
+        self._block_size = block_size
+        self._buffer = bytearray()
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(31)
+        elif encoding == 'zstd' and zstandard is not None:
+            self._decoder = zstandard.ZstdDecompressor().stream_reader(self._wire, read_size=block_size)
+        elif encoding:
+            raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+
+    @property
+    def wire_bytes(self):
+        return self._wire.count
+
+    def _decode(self, size):
+        if not self.encoding:
+            return self._wire.read(size)
+        started = time.thread_time()
+        try:
+            if self.encoding == 'zstd':
+                return self._decoder.read(size)
+            while not self._decoder.eof:
+                if self._decoder.unconsumed_tail:
+                    data = self._decoder.decompress(self._decoder.unconsumed_tail, size)
+                else:
+                    raw = self._wire.read(self._block_size)
+                    if not raw:
+                        break
+                    data = self._decoder.decompress(raw, size)
+                if data:
+                    return data
+            return b''
+        finally:
+            self.cpu_seconds += time.thread_time() - started
+
+    def read(self, size):
+        if not self._buffer:
+            return self._decode(size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, limit):
+        while b'\n' not in self._buffer and len(self._buffer) < limit:
+            data = self._decode(limit - len(self._buffer))
+            if not data:
+                break
+            self._buffer += data
+        end = self._buffer.find(b'\n')
+        end = min(limit, len(self._buffer) if end < 0 else end + 1)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return line
+
+def request_body(stream=None, slot=None):
+    """Return the request body as a ``DecodedStream``; ValueError for unknown codings.
+
+    ``stream`` defaults to ``request.stream``, which is capped at
+    ``MAX_CONTENT_LENGTH``. Reads are throttled by the scheduler ``slot``
+    when given.
+    """
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if encoding == 'identity':
+        encoding = ''
+    if encoding and encoding not in CONTENT_ENCODINGS:
+        raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+    return DecodedStream(request.stream if stream is None else stream, encoding,
+                         on_read=slot.throttle if slot is not None else None)
+
+def schedule_request(transfer, sid=None):
+    """Admit the current request into the scheduler and return its slot.
+
+    While the request waits, its queue position is sent to ``sid`` in
+    ``transfer_queue`` events. The slot is released when the response has
+    been sent. Raises ``SchedulerBusy`` if the request waited too long.
+    """
+    def notify(position):
+        if sid:
+            socketio.emit('transfer_queue', {'transfer_id': transfer.transfer_id, 'position': position},
+                          room=sid)
+    
+    try:
+        size = int(transfer.filesize)
+    except (TypeError, ValueError):
+        size = None
+    slot = scheduler.admit(transfer.transfer_id, get_device_ip(request), size, notify)
+    
+    @after_this_request
+    def release_slot(response):
+        if response.direct_passthrough:
+            response.response = ClosingIterator(response.response, slot.release)
+        else:
+            response.call_on_close(slot.release)
+        return response
+    
+    return slot
+
+def compress_file(file_path, encoding, stats, on_sent, block_size=1024 * 1024):
+    """Yield a file compressed with ``encoding`` and record the savings in ``stats``.
+
+    ``on_sent`` is called with the size of every piece after it was sent.
+    """
+    compressor = make_compressor(encoding)
+    raw_bytes = wire_bytes = 0
+    cpu_seconds = 0.0
+    with open(file_path, 'rb') as f:
+        while True:
+            block = run_blocking(f.read, block_size)
+            if not block:
+                break
+            data, cpu = run_blocking(timed, compressor.compress, block)
+            raw_bytes += len(block)
+            wire_bytes += len(data)
+            cpu_seconds += cpu
+            if data:
+                yield data
+                on_sent(len(data))
+    data = compressor.flush()
+    wire_bytes += len(data)
+    stats.add(raw_bytes, wire_bytes, cpu_seconds)
+    yield data
+    on_sent(len(data))
+
+class ZipStreamBuffer:
+    """Write-only file object that collects zipfile output between yields.
+
+    ``zipfile.ZipFile`` treats it as unseekable, so every entry is written
+    with a local header up front and a data descriptor after its data.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(entries, block_size=1024 * 1024, transfer=None, slot=None):
+    """Yield a ZIP archive of ``(src_path, arcname)`` entries piece by piece.
+
+    Only one block of file data is held in memory at a time. Files are
+    DEFLATED only if ``worth_compressing`` their first block, the rest are
+    STORED. Savings and bytes sent are recorded on ``transfer`` when given,
+    and throttled by the scheduler ``slot``.
+    """
+    buffer = ZipStreamBuffer()
+    raw_bytes = wire_bytes = 0
+    cpu_seconds = 0.0
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True,
+                         compresslevel=app.config['COMPRESSION_LEVELS']['gzip']) as zf:
+        for src_path, arcname in entries:
+            if not os.path.exists(src_path):
+                logger.error(f'Skipping missing file in zip stream: {src_path}')
+                continue
+            
+            zinfo = zipfile.ZipInfo.from_file(src_path, arcname)
+            with open(src_path, 'rb') as src:
+                block = run_blocking(src.read, block_size)
+                if (os.path.splitext(src_path)[1].lower() not in PRECOMPRESSED_EXTENSIONS
+                        and worth_compressing(block, src_path)):
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                
+                logger.info(f'Streaming into zip: {src_path} as {arcname}')
+                with zf.open(zinfo, 'w') as dest:
+                    while block:
+                        _, cpu = run_blocking(timed, dest.write, block)
+                        raw_bytes += len(block)
+                        cpu_seconds += cpu
+                        data = buffer.drain()
+                        wire_bytes += len(data)
+                        if data:
+                            yield data
+                            count_bytes(transfer, 'sent', len(data), slot)
+                        block = run_blocking(src.read, block_size)
+            data = buffer.drain()
+            wire_bytes += len(data)
+            yield data
+            count_bytes(transfer, 'sent', len(data), slot)
+    # Central directory is written when the archive is closed
+    data = buffer.drain()
+    wire_bytes += len(data)
+    if transfer is not None:
+        transfer.compression['download'].add(raw_bytes, wire_bytes, cpu_seconds)
+    yield data
+    count_bytes(transfer, 'sent', len(data), slot)
+
+def set_attachment_header(response, download_name):
+    """Set Content-Disposition the same way send_file does for non-ASCII names."""
+    simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+    if simple == download_name:
+        response.headers.set('Content-Disposition', 'attachment', filename=simple)
+    else:
+        response.headers.set('Content-Disposition', 'attachment', filename=simple,
+                             **{'filename*': f"UTF-8''{quote(download_name)}"})
+
+def reflink_file(src_path, target_path):
+    """Clone a file with a copy-on-write reflink. Returns False if unsupported."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(src_path, 'rb') as src, open(target_path, 'wb') as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        try:
+            os.unlink(target_path)
+        except OSError:
+            pass
+        return False
+
+def copy_file(src_path, target_path):
+    """Copy a staged file, preferring a reflink over a byte copy.
+
+    ``shutil.copyfile`` already uses the kernel fast path (sendfile on Linux,
+    fcopyfile on macOS) and 1 MB buffers elsewhere.
+    """
+    if reflink_file(src_path, target_path):
+        shutil.copystat(src_path, target_path)
+        return 'reflink'
+    shutil.copy2(src_path, target_path)
+    return 'copy'
+
+def deliver_files(placements, same_filesystem, keep_staged=False):
+    """Move or copy ``(src_path, target_path)`` pairs into place.
+
+    On the same filesystem staged files are renamed, which costs no I/O since
+    the staging copy is deleted after delivery anyway; ``keep_staged`` forces
+    copies while other recipients still need the staged files. Files that
+    cannot be renamed are copied in a bounded thread pool. Returns the number of files
+    and bytes delivered and the strategy used.
+    """
+    strategies = {}
+    total_bytes = 0
+    to_copy = []
+    
+    for src_path, target_path in placements:
+        stat = os.stat(src_path)
+        size = stat.st_size
+        # A hard-linked file shares its inode with the blob store and must be copied
+        if same_filesystem and stat.st_nlink == 1 and not keep_staged:
+            try:
+                run_blocking(os.replace, src_path, target_path)
+                logger.info(f'Moved file: {src_path} -> {target_path}')
+                strategies['rename'] = strategies.get('rename', 0) + 1
+                total_bytes += size
+                continue
+            except OSError as e:
+                logger.debug(f'Rename failed for {src_path}, copying instead: {str(e)}')
+        to_copy.append((src_path, target_path, size))
+    
+    def copy_one(placement):
+        src_path, target_path, size = placement
+        try:
+            logger.info(f'Copying file: {src_path} -> {target_path}')
+            return run_blocking(copy_file, src_path, target_path), size
+        except Exception as e:
+            logger.error(f'Error copying file {src_path}: {str(e)}')
+            return None, 0
+    
+    if to_copy:
+        with ThreadPoolExecutor(max_workers=app.config['DELIVERY_COPY_WORKERS']) as pool:
+            for strategy, size in pool.map(copy_one, to_copy):
+                if strategy:
+                    strategies[strategy] = strategies.get(strategy, 0) + 1
+                    total_bytes += size
+    
+    if len(strategies) == 1:
+        strategy = next(iter(strategies))
+    else:
+        strategy = 'mixed' if strategies else 'none'
+    return {
+        'files': sum(strategies.values()),
+        'bytes': total_bytes,
+        'strategy': strategy,
+        'strategies': strategies
+    }
+
+class RelayBuffer:
+    """Bounded in-memory pipe from a relay upload to its download.
+
+    ``write`` blocks while the buffer is full, so the sender is slowed down to
+    the recipient's pace. Either side can ``abort`` the relay, which wakes up
+    and fails the other side.
+    """
+
+    def __init__(self, capacity, timeout):
+        self.capacity = capacity
+        self.timeout = timeout
+        self.reader_attached = False
+        self.writer_attached = False
+        self._chunks = deque()
+        self._size = 0
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def write(self, data):
+        view = memoryview(data)
+        with self._condition:
+            while view:
+                if not self._condition.wait_for(lambda: self._error or self._size < self.capacity,
+                                                self.timeout):
+                    raise TimeoutError('Relay recipient stopped reading')
+                if self._error:
+                    raise ConnectionError(self._error)
+                size = min(len(view), self.capacity - self._size)
+                self._chunks.append(bytes(view[:size]))
+                self._size += size
+                view = view[size:]
+                self._condition.notify_all()
+
+    def read(self):
+        """Return the next buffered bytes, or ``b''`` once the sender has finished."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._error or self._chunks or self._closed,
+                                            self.timeout):
+                raise TimeoutError('Relay sender stopped sending')
+            if self._error:
+                raise ConnectionError(self._error)
+            if not self._chunks:
+                return b''
+            data = self._chunks.popleft()
+            self._size -= len(data)
+            self._condition.notify_all()
+            return data
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def abort(self, reason):
+        with self._condition:
+            if not self._error:
+                self._error = reason
+            self._condition.notify_all()
+
+def relay_stream(transfer, relay):
+    """Yield relayed bytes to the recipient and clean up the transfer afterwards."""
+    transfer_id = transfer.transfer_id
+    sent = 0
+    try:
+        while True:
+            data = relay.read()
+            if not data:
+                break
+            sent += len(data)
+            yield data
+            count_bytes(transfer, 'sent', len(data))
+        logger.info(f'Relay {transfer_id} finished after {sent} bytes')
+    except GeneratorExit:
+        logger.error(f'Relay {transfer_id} recipient disconnected after {sent} bytes')
+        relay.abort('Recipient disconnected')
+        raise
+    except (TimeoutError, ConnectionError) as e:
+        # Ending early leaves the response short of its Content-Length,
+        # so the recipient sees the download fail
+        logger.error(f'Relay {transfer_id} aborted after {sent} bytes: {str(e)}')
+        relay.abort(str(e))
+    finally:
+        relay_buffers.pop(transfer_id, None)
+        active_transfers.pop(transfer_id)
+
+class StagedFileBody:
+    """WSGI response body that sends one byte range of a staged file.
+
+    Under the Werkzeug server the bytes go from the page cache straight to the
+    client socket with sendfile; other servers get large blocks read in Python.
+    """
+
+    SENDFILE_SLICE = 16 * 1024 * 1024  # Bytes per sendfile call, so progress can be counted
+
+    def __init__(self, path, offset, length, environ, block_size=1024 * 1024, on_sent=None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.environ = environ
+        self.block_size = block_size
+        self.on_sent = on_sent or (lambda nbytes: None)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            sock = self.environ.get('werkzeug.socket')
+            if sock is not None and self.length:
+                # Yielding nothing first makes the server send and flush the headers
+                yield b''
+                end = self.offset + self.length
+                for offset in range(self.offset, end, self.SENDFILE_SLICE):
+                    count = min(self.SENDFILE_SLICE, end - offset)
+                    sock.sendfile(f, offset, count)
+                    self.on_sent(count)
+                return
+            
+            f.seek(self.offset)
+            remaining = self.length
+            while remaining:
+                block = run_blocking(f.read, min(remaining, self.block_size))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+                self.on_sent(len(block))
+
+def send_staged_file(file_path, download_name, transfer=None, slot=None, digest=None):
+    """Send a staged file with ETag, If-None-Match, Range and If-Range support.
+
+    Whole-file requests are compressed with the client's preferred content
+    coding when the file is worth compressing. Savings and bytes sent are
+    recorded on ``transfer`` when given, and throttled by the scheduler ``slot``.
+    The file's content hash ``digest`` is sent in an ``X-Content-Hash``
+    header, so the recipient can verify what it received.
+    """
+    stats = transfer.compression['download'] if transfer else CompressionStats()
+    on_sent = partial(count_bytes, transfer, 'sent', slot=slot)
+    stat = os.stat(file_path)
+    size = stat.st_size
+    etag = f'{stat.st_ino:x}-{size:x}-{stat.st_mtime_ns:x}'
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    
+    # Ranges always address the identity encoding, so only whole files are compressed
+    encoding = None
+    if request.range is None and size >= app.config['COMPRESSION_MIN_SIZE']:
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding:
+            with open(file_path, 'rb') as f:
+                sample = run_blocking(f.read, app.config['COMPRESSION_PROBE_SIZE'])
+            if worth_compressing(sample, download_name):
+                etag = f'{etag}-{encoding}'
+            else:
+                encoding = None
+    
+    response = Response(mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+    set_attachment_header(response, download_name)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'
+    response.vary.add('Accept-Encoding')
+    if digest:
+        response.headers['X-Content-Hash'] = digest
+    
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+    
+    if encoding:
+        response.content_encoding = encoding
+        if request.method != 'HEAD':
+            response.response = compress_file(file_path, encoding, stats, on_sent)
+        logger.info(f'Sending {file_path} ({size} bytes) with {encoding} encoding')
+        return response
+    
+    # A Range is only honoured if If-Range, when present, still matches the file
+    start, end = 0, size
+    if_range = request.if_range
+    range_valid = (
+        (if_range.etag is None and if_range.date is None)
+        or if_range.etag == etag
+        or (if_range.date is not None and last_modified <= if_range.date)
+    )
+    # Multi-range requests are answered with the whole file
+    if request.range is not None and len(request.range.ranges) == 1 and range_valid:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        start, end = byte_range
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, end, size)
+    
+    response.content_length = end - start
+    if request.method != 'HEAD':
+        response.response = StagedFileBody(file_path, start, end - start, request.environ, on_sent=on_sent)
+        response.direct_passthrough = True
+    logger.info(f'Sending {file_path} bytes {start}-{end} of {size}')
+    return response
+
+def find_available_port(start_port=5000, max_port=5050):
+    """Find first available port in range [start_port, max_port]."""
+    global server_port
+    if server_port:  # If port is already found, return it
+        return server_port
+        
+    for port in range(start_port, max_port + 1):
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+            try:
+                sock.bind(('', port))
+                logger.info(f"Found available port: {port}")
+                server_port = port  # Store the found port
+                return port
+            except socket.error:
+                logger.debug(f"Port {port} is in use, trying next port")
+                continue
+    raise RuntimeError(f"Could not find an open port between {start_port} and {max_port}")
+
+def declare_content_hash(transfer, relative_path, digest):
+    """Record the content hash a client declares for a file it uploads.
+
+    Raises ValueError if ``digest`` is not a content hash or contradicts the
+    one declared before, e.g. in the manifest.
+    """
+    if not is_content_hash(digest):
+        raise ValueError(f'Invalid content hash for {relative_path}')
+    with transfer.lock:
+        declared = transfer.expected_hashes.get(relative_path)
+        if declared is None:
+            transfer.expected_hashes[relative_path] = digest
+    if declared not in (None, digest):
+        raise ValueError(f'Content hash for {relative_path} differs from the one declared before')
+
+def content_hash_mismatch(transfer, relative_path, digest):
+    """Return True if ``digest`` is not the content hash declared for the file."""
+    with transfer.lock:
+        expected = transfer.expected_hashes.get(relative_path)
+    if expected is None or expected == digest:
+        return False
+    logger.error(f'Content hash mismatch for {relative_path}: declared {expected}, received {digest}')
+    return True
+
+def finish_received_file(transfer, relative_path):
+    """Hash a completely received file and check it against its declared content hash.
+
+    Returns the content hash. A file that does not match is discarded, so
+    its client has to send all of it again, and None is returned.
+    """
+    with transfer.lock:
+        received_file = transfer.received_files[relative_path]
+    digest = run_blocking(tree_hash, received_file.path, received_file.size, received_file.leaves)
+    if not content_hash_mismatch(transfer, relative_path, digest):
+        return digest
+    with transfer.lock:
+        received_file = transfer.received_files[relative_path]
+        received_file.received = []
+        received_file.complete = False
+        received_file.leaves = {}
+        transfer.received_files[relative_path] = received_file
+    return None
+
+def store_blob(transfer, file_path, relative_path, size, digest):
+    """Move a received file announced in the manifest into the blob store.
+
+    ``digest`` is the content hash of the file as received. Other files of
+    the transfer with the same content were not uploaded; they are linked to
+    this one and returned as ``(file_path, relative_path)`` pairs so the
+    caller can record them.
+    """
+    with transfer.lock:
+        expected, duplicates = transfer.expected_hashes.take(relative_path, transfer.received_files)
+    if expected is None:
+        return []
+    
+    if digest == expected:
+        blob_store.add(digest, file_path, size)
+        with transfer.lock:
+            transfer.blobs.append(digest)
+    else:
+        # Keep the file as received, but never let it answer for another hash
+        logger.warning(f'Content hash mismatch for {relative_path}: expected {expected}, got {digest}')
+    
+    linked = []
+    for path in duplicates:
+        target_path = staged_path(transfer, path)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        if digest == expected and blob_store.link(digest, target_path):
+            with transfer.lock:
+                transfer.blobs.append(digest)
+        else:
+            shutil.copyfile(file_path, target_path)
+        linked.append((target_path, path))
+    return linked
+
+def staged_manifest(transfer):
+    """Relative path, size and content hash of every staged file."""
+    with transfer.lock:
+        return [{'relative_path': f['relative_path'], 'size': f['size'], 'hash': f['hash']}
+                for f in transfer.files]
+
+def notify_ready(transfer, sid, display_name=None):
+    """Tell one recipient that the staged files can be downloaded.
+
+    For directories the event carries the manifest of every file, so a
+    recipient that fetched files progressively can verify it has them all.
+    """
+    logger.info(f'Notifying recipient {sid} about ready files')
+    data = {
+        'transfer_id': transfer.transfer_id,
+        'filename': display_name or transfer.filename,
+        'download_url': f'/download/{transfer.transfer_id}?{urlencode({"recipient": sid})}',
+        'is_directory': transfer.is_directory
+    }
+    if transfer.is_directory:
+        data['manifest'] = staged_manifest(transfer)
+    socketio.emit('file_ready_for_download', data, room=sid)
+
+def notify_staged(transfer, sid, files):
+    """Tell one recipient which directory files it can fetch before the upload ends."""
+    query = urlencode({'recipient': sid})
+    socketio.emit('files_staged', {
+        'transfer_id': transfer.transfer_id,
+        'files': files,
+        'uploaded_files': transfer.uploaded_files,
+        'total_files': transfer.total_files,
+        'download_url': f'/download/{transfer.transfer_id}?{query}',
+        'file_url': f'/download/{transfer.transfer_id}/file?{query}'
+    }, room=sid)
+
+def announce_staged(transfer):
+    """Send the files staged since the last announcement to accepted recipients."""
+    with transfer.lock:
+        # Once the transfer is ready the final manifest covers the rest
+        if transfer.status != 'accepted':
+            transfer.unannounced.clear()
+            return
+        files = list(transfer.unannounced)
+        transfer.unannounced.clear()
+        sids = [sid for sid, recipient in transfer.recipients.items()
+                if recipient.status in ('accepted', 'downloading')]
+    if files:
+        for sid in sids:
+            notify_staged(transfer, sid, files)
+
+def queue_staged(transfer, relative_path, size, digest):
+    """Queue a staged directory file; files staged close together go out in one event."""
+    with transfer.lock:
+        transfer.unannounced.append({'relative_path': relative_path, 'size': size, 'hash': digest})
+        first = len(transfer.unannounced) == 1
+    if first:
+        def announce_later():
+            socketio.sleep(app.config['STAGED_ANNOUNCE_INTERVAL'])
+            announce_staged(transfer)
+        socketio.start_background_task(announce_later)
+
+def record_uploaded_file(transfer, file_path, relative_path, display_name, size=None, digest=None):
+    """Register a fully received file and notify recipients.
+
+    ``digest`` is the content hash of the file, which is read from disk if
+    it was not taken while the file arrived. Recipients of a directory hear
+    about each staged file so they can fetch it while the rest is uploading,
+    and about the whole transfer once all files are in.
+    """
+    if size is None:
+        size = os.path.getsize(file_path)
+    if digest is None:
+        digest = run_blocking(content_hash, file_path)
+    for duplicate_path, duplicate_relative_path in store_blob(transfer, file_path, relative_path, size, digest):
+        with transfer.lock:
+            transfer.received_files[duplicate_relative_path] = ReceivedFile(
+                str(duplicate_path), size, [[0, size]] if size else [], complete=True)
+        record_uploaded_file(transfer, duplicate_path, duplicate_relative_path,
+                             os.path.basename(duplicate_relative_path), size, digest)
+    ready = active_transfers.record_file(transfer, file_path, relative_path, size, digest)
+    
+    logger.info(f'Uploaded {transfer.uploaded_files} of {transfer.total_files} files')
+    
+    if transfer.is_directory and not ready:
+        queue_staged(transfer, relative_path, size, digest)
+    
+    # If this was the last file, the transfer is now ready for download
+    if ready:
+        logger.info(f'All files uploaded. Updated transfer status: {transfer.summary()}')
+        
+        # Notify the recipients that accepted; the others are told when they do
+        with transfer.lock:
+            transfer.unannounced.clear()
+            accepted = [sid for sid, recipient in transfer.recipients.items()
+                        if recipient.status in ('accepted', 'downloading') and not recipient.notified]
+            for sid in accepted:
+                transfer.recipients[sid].notified = True
+        for sid in accepted:
+            notify_ready(transfer, sid, display_name)
+
+def get_server_info():
+    """Return the server URL and its QR code, rebuilt only when the URL changes."""
+    primary_ip = network_snapshot.primary()
+    if primary_ip is None:
+        return None, None
+    
+    # Get port from environment variable since it's set during startup
+    port = os.environ.get('SERVER_PORT', '5000')
+    url = f"http://{primary_ip}:{port}"
+    with server_info_lock:
+        if server_info_cache['url'] != url:
+            server_info_cache['url'] = url
+            server_info_cache['qr_code'] = generate_qr_code(url)
+        return url, server_info_cache['qr_code']
+
+def watch_network(interval):
+    """Background task that pushes a new server URL when the primary address changes."""
+    primary_ip = network_snapshot.primary()
+    while True:
+        socketio.sleep(interval)
+        try:
+            network_snapshot.refresh()
+            if network_snapshot.primary() == primary_ip:
+                continue
+            primary_ip = network_snapshot.primary()
+            url, qr_code = get_server_info()
+            logger.info(f'Primary address changed, server URL is now {url}')
+            socketio.emit('server_url_changed', {'server_url': url, 'qr_code': qr_code})
+        except Exception as e:
+            logger.error(f'Error refreshing network addresses: {str(e)}', exc_info=True)
+
+# Request endpoints whose latency is recorded for /metrics
+TIMED_ENDPOINTS = {'upload_file', 'upload_chunk', 'upload_raw', 'upload_batch', 'upload_manifest',
+                   'relay_upload', 'download_file', 'download_staged_file'}
+
+def peak_rss_bytes():
+    """Peak resident set size of the server process, or None where unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def collect_metrics():
+    """Gather the current metrics as a JSON-serializable dict."""
+    snapshot = metrics.snapshot()
+    upload_folder = app.config['UPLOAD_FOLDER']
+    transfers = {}
+    for transfer in active_transfers.values():
+        transfers[transfer.transfer_id] = {
+            'status': transfer.status,
+            **{direction: meter.to_dict() for direction, meter in transfer.throughput.items()}
+        }
+    return {
+        'bytes_received': snapshot['bytes']['received'],
+        'bytes_sent': snapshot['bytes']['sent'],
+        'connected_devices': len(connected_devices),
+        'transfers_by_status': active_transfers.status_counts(),
+        'transfers': transfers,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'staging': {
+            'staged_bytes': active_transfers.staged_bytes,
+            'peak_staged_bytes': active_transfers.peak_staged_bytes,
+            'blob_cache_bytes': blob_store.unreferenced_bytes,
+            'quota_bytes': staging_quota(),
+            'disk_free_bytes': shutil.disk_usage(upload_folder).free
+        },
+        'scheduler': scheduler.snapshot(),
+        'socketio_emits': snapshot['emits'],
+        'request_latency_seconds': snapshot['latency']
+    }
 
-def generate_qr_code(url):
-    """Generate QR code for the given URL and return as base64 string."""
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+def prometheus_sample(name, labels, value):
+    label_text = ','.join(
+        '{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, label in labels.items()
     )
-    qr.add_data(url)
-    qr.make(fit=True)
+    return f'localshare_{name}{{{label_text}}} {value}' if label_text else f'localshare_{name} {value}'
 
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
+def format_prometheus(data):
+    """Render ``collect_metrics`` output in the Prometheus text exposition format."""
+    lines = []
+    
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP localshare_{name} {help_text}')
+        lines.append(f'# TYPE localshare_{name} {kind}')
+        for suffix, labels, value in samples:
+            lines.append(prometheus_sample(name + suffix, labels, value))
+    
+    def gauge(name, help_text, samples, kind='gauge'):
+        metric(name, kind, help_text, [('', labels, value) for labels, value in samples])
+    
+    gauge('bytes_received_total', 'Bytes received from senders.', [({}, data['bytes_received'])], 'counter')
+    gauge('bytes_sent_total', 'Bytes sent to recipients.', [({}, data['bytes_sent'])], 'counter')
+    gauge('connected_devices', 'Connected devices.', [({}, data['connected_devices'])])
+    if data['peak_rss_bytes'] is not None:
+        gauge('peak_rss_bytes', 'Peak resident memory of the server process.', [({}, data['peak_rss_bytes'])])
+    gauge('transfers', 'Active transfers by status.',
+          [({'status': status}, count) for status, count in sorted(data['transfers_by_status'].items())])
+    transfers = sorted(data['transfers'].items())
+    for direction in ('received', 'sent'):
+        gauge(f'transfer_bytes_{direction}', f'Bytes {direction} per active transfer.',
+              [({'transfer_id': tid}, t[direction]['bytes']) for tid, t in transfers])
+        gauge(f'transfer_{direction}_megabytes_per_second', f'Current MB/s {direction} per active transfer.',
+              [({'transfer_id': tid}, t[direction]['current_mbps']) for tid, t in transfers])
+        gauge(f'transfer_{direction}_peak_megabytes_per_second', f'Peak MB/s {direction} per active transfer.',
+              [({'transfer_id': tid}, t[direction]['peak_mbps']) for tid, t in transfers])
+    staging = data['staging']
+    gauge('staged_bytes', 'Bytes reserved by staged uploads.', [({}, staging['staged_bytes'])])
+    gauge('peak_staged_bytes', 'Most bytes reserved by staged uploads at once.', [({}, staging['peak_staged_bytes'])])
+    gauge('blob_cache_bytes', 'Bytes of cached deduplicated files no transfer uses.',
+          [({}, staging['blob_cache_bytes'])])
+    gauge('staging_quota_bytes', 'Staging quota.', [({}, staging['quota_bytes'])])
+    gauge('staging_disk_free_bytes', 'Free space on the staging filesystem.', [({}, staging['disk_free_bytes'])])
+    gauge('scheduler_requests', 'Upload and download requests by scheduler state.',
+          [({'state': state}, count) for state, count in sorted(data['scheduler'].items())])
+    gauge('socketio_emits_total', 'Socket.IO events emitted by name.',
+          [({'event': event}, count) for event, count in sorted(data['socketio_emits'].items())], 'counter')
+    
+    samples = []
+    for endpoint, histogram in sorted(data['request_latency_seconds'].items()):
+        for bound, count in histogram['buckets']:
+            samples.append(('_bucket', {'endpoint': endpoint, 'le': bound}, count))
+        samples.append(('_sum', {'endpoint': endpoint}, histogram['sum']))
+        samples.append(('_count', {'endpoint': endpoint}, histogram['count']))
+    metric('request_duration_seconds', 'histogram', 'Upload and download request latency.', samples)
+    return '\n'.join(lines) + '\n'
 
-def find_available_port(start_port=5000, max_port=5050):
-    """Find first available port in range [start_port, max_port]."""
-    global server_port
-    if server_port:  # If port is already found, return it
-        return server_port
-        
-    for port in range(start_port, max_port + 1):
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            try:
-                sock.bind(('', port))
-                logger.info(f"Found available port: {port}")
-                server_port = port  # Store the found port
-                return port
-            except socket.error:
-                logger.debug(f"Port {port} is in use, trying next port")
-                continue
-    raise RuntimeError(f"Could not find an open port between {start_port} and {max_port}")
+@app.before_request
+def start_request_timer():
+    if request.endpoint in TIMED_ENDPOINTS:
+        g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    # Streamed bodies finish after this hook, so the latency is taken on close
+    started = g.get('request_started')
+    if started is not None:
+        observe = partial(metrics.observe_latency, request.endpoint, started)
+        if response.direct_passthrough:
+            # Werkzeug hands passthrough bodies to the server without its own close hook
+            response.response = ClosingIterator(response.response, observe)
+        else:
+            response.call_on_close(observe)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics; ``?format=json`` returns the same data as JSON."""
+    data = collect_metrics()
+    if request.args.get('format') == 'json':
+        return jsonify(data)
+    return Response(format_prometheus(data), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
-    ip_addresses = get_ip_addresses()
-    if ip_addresses:
-        # Get port from environment variable since it's set during startup
-        port = os.environ.get('SERVER_PORT', '5000')
-        url = f"http://{ip_addresses[0]}:{port}"
-        qr_code = generate_qr_code(url)
-        return render_template('index.html', qr_code=qr_code, server_url=url)
-    return render_template('index.html')
+    url, qr_code = get_server_info()
+    # The page only changes with the server URL; debug mode picks up template edits
+    with server_info_lock:
+        if index_page_cache['page'] is None or index_page_cache['url'] != url or app.debug:
+            # Long-polling requests could land on another worker than their session
+            websocket_only = shared_state is not None
+            if url:
+                html = render_template('index.html', qr_code=qr_code, server_url=url,
+                                       websocket_only=websocket_only)
+            else:
+                html = render_template('index.html', websocket_only=websocket_only)
+            index_page_cache['url'] = url
+            index_page_cache['page'] = StaticAsset(html.encode(), 'text/html')
+        page = index_page_cache['page']
+    return send_asset(page)
+
+@app.route('/static/<path:filename>')
+def static_asset(filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        return jsonify({'error': 'Not found'}), 404
+    # Only a URL naming the current content may be cached without revalidation
+    return send_asset(asset, immutable=request.args.get('v') == asset.etag)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
         logger.info(f'Received upload request. Files: {request.files}, Form: {request.form}')
-        logger.info(f'Current active transfers: {json.dumps(active_transfers)}')
+        logger.info(f'Current active transfers: {active_transfers.summary()}')
         
         if 'file' not in request.files:
             logger.error('No file in request')
@@ -141,66 +3192,70 @@ def upload_file():
             logger.error('No transfer_id in upload request')
             return jsonify({'error': 'No transfer ID'}), 400
             
-        if transfer_id not in active_transfers:
-            logger.error(f'Transfer {transfer_id} not found. Active transfers: {list(active_transfers.keys())}')
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
+            logger.error(f'Transfer {transfer_id} not found. Active transfers: {active_transfers.summary()}')
             return jsonify({'error': 'Invalid transfer ID'}), 400
             
-        transfer = active_transfers[transfer_id]
-        logger.info(f'Found transfer data: {json.dumps(transfer)}')
+        logger.info(f'Found transfer data: {transfer.summary()}')
         
-        if transfer['status'] != 'accepted':
-            logger.error(f'Invalid transfer status for upload: {transfer["status"]}')
-            return jsonify({'error': f'Invalid transfer status: {transfer["status"]}'}), 400
+        if transfer.status != 'accepted':
+            logger.error(f'Invalid transfer status for upload: {transfer.status}')
+            return jsonify({'error': f'Invalid transfer status: {transfer.status}'}), 400
         
         if file.filename == '':
             logger.error('No selected file')
             return jsonify({'error': 'No selected file'}), 400
         
-        # Create transfer directory and save file
-        transfer_path = Path(app.config['UPLOAD_FOLDER']) / transfer_id
+        # Directory uploads keep their structure, single files just use the filename
+        declared_path = relative_path if is_directory else file.filename
+        file_path = staged_path(transfer, declared_path)
+        if file_path is None:
+            logger.error(f'Invalid relative path in upload: {declared_path!r}')
+            return jsonify({'error': 'Invalid relative path'}), 400
         
-        if is_directory:
-            # For directory uploads, maintain the directory structure
-            file_path = transfer_path / relative_path
-        else:
-            # For single files, just use the filename
-            file_path = transfer_path / secure_filename(file.filename)
+        # The optional hash form field declares the file's content hash
+        if request.form.get('hash'):
+            try:
+                declare_content_hash(transfer, declared_path, request.form['hash'])
+            except ValueError as e:
+                logger.error(str(e))
+                return jsonify({'error': str(e)}), 400
             
-        # Create all parent directories
-        file_path.parent.mkdir(parents=True, exist_ok=True)
+        # The form parser has already spooled the part, so its size is known
+        filesize = file.stream.seek(0, os.SEEK_END)
+        file.stream.seek(0)
+        if request.form.get('filesize', filesize, type=int) != filesize:
+            logger.error(f'Uploaded {filesize} bytes for {declared_path}, declared {request.form["filesize"]}')
+            return jsonify({'error': 'File size does not match the declared size'}), 400
         
-        logger.info(f'Saving file to {file_path}')
-        file.save(file_path)
-        
-        # Update transfer status and file info
-        active_transfers[transfer_id]['uploaded_files'] += 1
-        active_transfers[transfer_id]['files'].append({
-            'path': str(file_path),
-            'relative_path': relative_path,
-            'size': os.path.getsize(file_path)
-        })
+        slot = schedule_request(transfer, transfer.sender)
         
-        logger.info(f'Uploaded {active_transfers[transfer_id]["uploaded_files"]} of {active_transfers[transfer_id]["total_files"]} files')
+        # Staging space is reserved once per file, so a resent file does not take more
+        try:
+            open_received_file(transfer, declared_path, file_path, filesize)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({'error': 'File size does not match an earlier upload'}), 400
         
-        # If this is the last file, mark as ready for download
-        if active_transfers[transfer_id]['uploaded_files'] >= active_transfers[transfer_id]['total_files']:
-            active_transfers[transfer_id].update({
-                'status': 'ready_for_download',
-                'base_path': str(transfer_path),
-                'uploaded_at': datetime.now().isoformat()
-            })
-            logger.info(f'All files uploaded. Updated transfer status: {json.dumps(active_transfers[transfer_id])}')
-            
-            # Notify recipient
-            recipient_sid = transfer['recipient_sid']
-            logger.info(f'Notifying recipient {recipient_sid} about ready files')
-            
-            socketio.emit('file_ready_for_download', {
+        logger.info(f'Saving file to {file_path}')
+        digest = run_blocking(save_hashed, file.stream, file_path)
+        count_bytes(transfer, 'received', request.content_length or filesize, slot)
+        if content_hash_mismatch(transfer, declared_path, digest):
+            # Like a chunked file, it keeps its space and reservation; the resend overwrites it
+            return jsonify({'error': 'Content hash mismatch, file discarded'}), 422
+        
+        # A file that was already uploaded completely is not announced again
+        if not add_received_range(transfer, declared_path, 0, filesize)[1]:
+            return jsonify({
+                'success': True,
                 'transfer_id': transfer_id,
-                'filename': os.path.basename(relative_path) if is_directory else file.filename,
-                'download_url': f'/download/{transfer_id}',
-                'is_directory': is_directory
-            }, room=recipient_sid)
+                'message': 'File already uploaded'
+            })
+        
+        record_uploaded_file(transfer, file_path, relative_path,
+                             os.path.basename(relative_path) if is_directory else file.filename,
+                             digest=digest)
         
         return jsonify({
             'success': True,
@@ -208,10 +3263,564 @@ def upload_file():
             'message': 'File uploaded successfully'
         })
         
+    except StagingQuotaExceeded as e:
+        logger.error(f'Upload rejected: {str(e)}')
+        return jsonify({'error': str(e)}), 507
+    except SchedulerBusy as e:
+        logger.error(f'Upload refused: {str(e)}')
+        return jsonify({'error': str(e), 'position': e.position}), 503, {'Retry-After': '5'}
     except Exception as e:
         logger.error(f'Upload error: {str(e)}', exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/chunk', methods=['PUT'])
+def upload_chunk():
+    """Receive one chunk of a file as the raw request body.
+
+    Query parameters: ``transfer_id``, ``relative_path``, ``offset``,
+    ``filesize`` (total size of the file the chunk belongs to) and
+    optionally ``hash``, the content hash of the whole file. Chunks may
+    arrive in any order and in parallel; the file is finalized once every
+    byte range has been received. Blocks are hashed as they are written, and
+    a file that does not match its declared hash is discarded with a 422 so
+    the client sends it again.
+    """
+    try:
+        transfer_id = request.args.get('transfer_id')
+        relative_path = request.args.get('relative_path', '')
+        
+        if not transfer_id:
+            logger.error('No transfer_id in chunk upload request')
+            return jsonify({'error': 'No transfer ID'}), 400
+        
+        try:
+            offset = int(request.args.get('offset', 0))
+            filesize = int(request.args['filesize'])
+        except (KeyError, ValueError):
+            logger.error('Missing or invalid offset/filesize in chunk upload request')
+            return jsonify({'error': 'Invalid offset or filesize'}), 400
+        
+        try:
+            body = request_body()
+        except ValueError as e:
+            logger.error(f'Chunk upload with {str(e)}')
+            return jsonify({'error': str(e)}), 415
+        
+        # The length of an encoded chunk is only known once it is decoded
+        chunk_length = 0 if body.encoding else request.content_length or 0
+        if offset < 0 or filesize < 0 or offset + chunk_length > filesize:
+            logger.error(f'Chunk {offset}+{chunk_length} outside of file size {filesize}')
+            return jsonify({'error': 'Chunk outside of file bounds'}), 400
+        
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
+            logger.error(f'Transfer {transfer_id} not found. Active transfers: {active_transfers.summary()}')
+            return jsonify({'error': 'Invalid transfer ID'}), 400
+        
+        if transfer.status != 'accepted':
+            logger.error(f'Invalid transfer status for chunk upload: {transfer.status}')
+            return jsonify({'error': f'Invalid transfer status: {transfer.status}'}), 400
+        
+        # Nothing has been read yet, so the body can still be throttled
+        body = request_body(slot=schedule_request(transfer, transfer.sender))
+        
+        is_directory = transfer.is_directory
+        file_path = staged_path(transfer, relative_path)
+        if file_path is None:
+            logger.error(f'Invalid relative path in chunk upload: {relative_path!r}')
+            return jsonify({'error': 'Invalid relative path'}), 400
+        
+        if request.args.get('hash'):
+            try:
+                declare_content_hash(transfer, relative_path, request.args['hash'])
+            except ValueError as e:
+                logger.error(str(e))
+                return jsonify({'error': str(e)}), 400
+        
+        # Preallocate the file the first time any of its chunks arrives
+        try:
+            open_received_file(transfer, relative_path, file_path, filesize)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({'error': 'File size does not match earlier chunks'}), 400
+        
+        # Write the chunk in place; parallel chunks use separate file handles
+        written = 0
+        hasher = BlockHasher(offset, filesize)
+        with open(file_path, 'r+b') as f:
+            f.seek(offset)
+            while True:
+                data = body.read(min(1024 * 1024, filesize - offset - written + 1))
+                if not data:
+                    break
+                if offset + written + len(data) > filesize:
+                    logger.error(f'Decoded chunk at {offset} runs past file size {filesize}')
+                    return jsonify({'error': 'Chunk outside of file bounds'}), 400
+                run_blocking(hasher.write, f, data)
+                written += len(data)
+        transfer.compression['upload'].add(written, body.wire_bytes, body.cpu_seconds)
+        count_bytes(transfer, 'received', body.wire_bytes)
+        
+        missing, file_complete = add_received_range(transfer, relative_path, offset, written, hasher.leaves)
+        if file_complete:
+            digest = finish_received_file(transfer, relative_path)
+            if digest is None:
+                return jsonify({'error': 'Content hash mismatch, file discarded',
+                                'missing': missing_ranges([], filesize)}), 422
+            logger.info(f'All chunks received for {file_path}')
+            record_uploaded_file(transfer, file_path, relative_path,
+                                 os.path.basename(relative_path) if is_directory else transfer.filename,
+                                 filesize, digest)
+        
+        return jsonify({
+            'success': True,
+            'transfer_id': transfer_id,
+            'received': written,
+            'missing': missing
+        })
+        
+    except StagingQuotaExceeded as e:
+        logger.error(f'Chunk upload rejected: {str(e)}')
+        return jsonify({'error': str(e)}), 507
+    except SchedulerBusy as e:
+        logger.error(f'Chunk upload refused: {str(e)}')
+        return jsonify({'error': str(e), 'position': e.position}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logger.error(f'Chunk upload error: {str(e)}', exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/raw', methods=['PUT'])
+def upload_raw():
+    """Stream a whole file, or its remainder from ``offset``, as the raw request body.
+
+    Takes the same query parameters as ``/upload/chunk``. Nothing is spooled:
+    the body goes straight into the preallocated staged file in large
+    buffered writes. The declared ``filesize``, not ``MAX_CONTENT_LENGTH``,
+    bounds the body, so files of any size can be sent in one request. An
+    interrupted upload keeps what was written and can be resumed from the
+    ranges ``/upload/status`` reports.
+    """
+    try:
+        transfer_id = request.args.get('transfer_id')
+        relative_path = request.args.get('relative_path', '')
+        
+        if not transfer_id:
+            logger.error('No transfer_id in raw upload request')
+            return jsonify({'error': 'No transfer ID'}), 400
+        
+        try:
+            offset = int(request.args.get('offset', 0))
+            filesize = int(request.args['filesize'])
+        except (KeyError, ValueError):
+            logger.error('Missing or invalid offset/filesize in raw upload request')
+            return jsonify({'error': 'Invalid offset or filesize'}), 400
+        
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
+            logger.error(f'Transfer {transfer_id} not found. Active transfers: {active_transfers.summary()}')
+            return jsonify({'error': 'Invalid transfer ID'}), 400
+        
+        if transfer.status != 'accepted':
+            logger.error(f'Invalid transfer status for raw upload: {transfer.status}')
+            return jsonify({'error': f'Invalid transfer status: {transfer.status}'}), 400
+        
+        # Encoded bodies are only bounded by their decoded size
+        encoded = request.headers.get('Content-Encoding', '').strip().lower() not in ('', 'identity')
+        body_length = 0 if encoded else request.content_length or 0
+        if offset < 0 or filesize < 0 or offset + body_length > filesize:
+            logger.error(f'Raw upload {offset}+{body_length} outside of file size {filesize}')
+            return jsonify({'error': 'Upload outside of file bounds'}), 400
+        
+        try:
+            # The write loop enforces the bound; a chunked body is read until it ends
+            chunked = 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+            body = request_body(get_input_stream(request.environ, safe_fallback=not chunked),
+                                schedule_request(transfer, transfer.sender))
+        except ValueError as e:
+            logger.error(f'Raw upload with {str(e)}')
+            return jsonify({'error': str(e)}), 415
+        
+        is_directory = transfer.is_directory
+        file_path = staged_path(transfer, relative_path)
+        if file_path is None:
+            logger.error(f'Invalid relative path in raw upload: {relative_path!r}')
+            return jsonify({'error': 'Invalid relative path'}), 400
+        
+        if request.args.get('hash'):
+            try:
+                declare_content_hash(transfer, relative_path, request.args['hash'])
+            except ValueError as e:
+                logger.error(str(e))
+                return jsonify({'error': str(e)}), 400
+        
+        try:
+            open_received_file(transfer, relative_path, file_path, filesize)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({'error': 'File size does not match earlier uploads'}), 400
+        
+        logger.info(f'Streaming {relative_path} ({filesize} bytes from {offset}) into {file_path}')
+        block_size = app.config['RAW_UPLOAD_BLOCK_SIZE']
+        written = 0
+        hasher = BlockHasher(offset, filesize)
+        try:
+            # The buffer turns the small reads off the socket into large writes
+            with open(file_path, 'r+b', buffering=block_size) as f:
+                f.seek(offset)
+                while True:
+                    data = body.read(min(block_size, filesize - offset - written + 1))
+                    if not data:
+                        break
+                    if offset + written + len(data) > filesize:
+                        logger.error(f'Raw upload at {offset} runs past file size {filesize}')
+                        return jsonify({'error': 'Upload outside of file bounds'}), 400
+                    run_blocking(hasher.write, f, data)
+                    written += len(data)
+        finally:
+            # Whatever reached the disk counts, so a broken upload can resume
+            transfer.compression['upload'].add(written, body.wire_bytes, body.cpu_seconds)
+            count_bytes(transfer, 'received', body.wire_bytes)
+            missing, file_complete = add_received_range(transfer, relative_path, offset, written,
+                                                        hasher.leaves)
+        
+        if file_complete:
+            digest = finish_received_file(transfer, relative_path)
+            if digest is None:
+                return jsonify({'error': 'Content hash mismatch, file discarded',
+                                'missing': missing_ranges([], filesize)}), 422
+            logger.info(f'Raw upload complete for {file_path}')
+            record_uploaded_file(transfer, file_path, relative_path,
+                                 os.path.basename(relative_path) if is_directory else transfer.filename,
+                                 filesize, digest)
+        
+        return jsonify({
+            'success': True,
+            'transfer_id': transfer_id,
+            'received': written,
+            'missing': missing
+        })
+        
+    except StagingQuotaExceeded as e:
+        logger.error(f'Raw upload rejected: {str(e)}')
+        return jsonify({'error': str(e)}), 507
+    except SchedulerBusy as e:
+        logger.error(f'Raw upload refused: {str(e)}')
+        return jsonify({'error': str(e), 'position': e.position}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logger.error(f'Raw upload error: {str(e)}', exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/probe', methods=['POST'])
+def upload_probe():
+    """Tell a sender whether to compress a file, judged by its first block.
+
+    The body is the start of the file (at most ``COMPRESSION_PROBE_SIZE``
+    bytes); ``filename`` and ``encodings``, the content codings the client
+    can produce, are query parameters.
+    """
+    sample = request.stream.read(app.config['COMPRESSION_PROBE_SIZE'])
+    filename = request.args.get('filename')
+    offered = [encoding.strip() for encoding in request.args.get('encodings', 'gzip').split(',')]
+    encoding = choose_encoding(offered) if worth_compressing(sample, filename) else None
+    return jsonify({
+        'encoding': encoding,
+        'mime': sniff_mime(sample, filename)
+    })
+
+@app.route('/upload/manifest', methods=['POST'])
+def upload_manifest():
+    """Link files the server already holds and report which ones to upload.
+
+    The JSON body lists ``{"relative_path": ..., "size": ..., "hash": ...}``
+    for every file of the transfer, hashed with ``content_hash``. Files whose
+    content is in the blob store are staged without being sent; of the rest,
+    one file per distinct hash has to be uploaded and its duplicates are
+    linked to it once it arrives.
+    """
+    try:
+        transfer_id = request.args.get('transfer_id')
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
+            logger.error(f'Manifest for unknown transfer {transfer_id}')
+            return jsonify({'error': 'Invalid transfer ID'}), 400
+        
+        if transfer.status != 'accepted':
+            logger.error(f'Invalid transfer status for manifest: {transfer.status}')
+            return jsonify({'error': f'Invalid transfer status: {transfer.status}'}), 400
+        
+        try:
+            entries = [(entry['relative_path'], int(entry['size']), entry['hash'])
+                       for entry in request.get_json()['files']]
+        except (KeyError, ValueError, TypeError):
+            logger.error('Invalid manifest in dedup request')
+            return jsonify({'error': 'Invalid manifest'}), 400
+        
+        targets = []
+        for relative_path, size, digest in entries:
+            file_path = staged_path(transfer, relative_path)
+            if file_path is None or size < 0 or not is_content_hash(digest):
+                logger.error(f'Invalid manifest entry: {relative_path!r} ({size} bytes, {digest!r})')
+                return jsonify({'error': f'Invalid manifest entry: {relative_path}'}), 400
+            targets.append((file_path, relative_path, size, digest))
+        
+        linked = []
+        upload = {}  # content hash -> relative path the client has to send
+        for file_path, relative_path, size, digest in targets:
+            with transfer.lock:
+                if relative_path in transfer.received_files:
+                    continue
+            if blob_store.link(digest, file_path):
+                with transfer.lock:
+                    transfer.blobs.append(digest)
+                    transfer.received_files[relative_path] = ReceivedFile(
+                        str(file_path), size, [[0, size]] if size else [], complete=True)
+                linked.append((file_path, relative_path, size, digest))
+                continue
+            with transfer.lock:
+                transfer.expected_hashes[relative_path] = digest
+            upload.setdefault(digest, relative_path)
+        
+        for file_path, relative_path, size, digest in linked:
+            record_uploaded_file(transfer, file_path, relative_path,
+                                 os.path.basename(relative_path) if transfer.is_directory else transfer.filename,
+                                 size, digest)
+        
+        logger.info(f'Manifest for transfer {transfer_id}: {len(linked)} files already stored, '
+                    f'{len(upload)} to upload')
+        return jsonify({
+            'success': True,
+            'transfer_id': transfer_id,
+            'upload': list(upload.values()),
+            'linked': len(linked),
+            'linked_bytes': sum(size for _, _, size, _ in linked)
+        })
+        
+    except Exception as e:
+        logger.error(f'Manifest error: {str(e)}', exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Receive many small files of a directory transfer in one request.
+
+    The body is a single line of JSON manifest, ``{"files": [{"relative_path":
+    ..., "size": ..., "hash": ...}, ...]}`` where ``hash`` is optional,
+    followed by the contents of those files concatenated in manifest order.
+    The transfer ID is a query parameter. Files that do not match their
+    declared content hash are not kept and are listed in a 422 response.
+    """
+    try:
+        transfer_id = request.args.get('transfer_id')
+        if not transfer_id:
+            logger.error('No transfer_id in batch upload request')
+            return jsonify({'error': 'No transfer ID'}), 400
+        
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
+            logger.error(f'Transfer {transfer_id} not found. Active transfers: {active_transfers.summary()}')
+            return jsonify({'error': 'Invalid transfer ID'}), 400
+        
+        if transfer.status != 'accepted':
+            logger.error(f'Invalid transfer status for batch upload: {transfer.status}')
+            return jsonify({'error': f'Invalid transfer status: {transfer.status}'}), 400
+        
+        if not transfer.is_directory:
+            logger.error(f'Batch upload for non-directory transfer {transfer_id}')
+            return jsonify({'error': 'Batch uploads are only supported for directories'}), 400
+        
+        try:
+            body = request_body(slot=schedule_request(transfer, transfer.sender))
+        except ValueError as e:
+            logger.error(f'Batch upload with {str(e)}')
+            return jsonify({'error': str(e)}), 415
+        
+        try:
+            manifest_line = body.readline(app.config['BATCH_MAX_BYTES'])
+            manifest = json.loads(manifest_line)
+            entries = [(entry['relative_path'], int(entry['size'])) for entry in manifest['files']]
+            for entry in manifest['files']:
+                if entry.get('hash'):
+                    declare_content_hash(transfer, entry['relative_path'], entry['hash'])
+        except (ValueError, KeyError, TypeError):
+            logger.error('Invalid manifest in batch upload request')
+            return jsonify({'error': 'Invalid batch manifest'}), 400
+        
+        # Resolve every target path before touching the disk
+        transfer_path = Path(app.config['UPLOAD_FOLDER']) / transfer_id
+        targets = []
+        for relative_path, size in entries:
+            file_path = safe_join(str(transfer_path), relative_path)
+            if not relative_path or file_path is None or size < 0:
+                logger.error(f'Invalid batch entry: {relative_path!r} ({size} bytes)')
+                return jsonify({'error': f'Invalid batch entry: {relative_path}'}), 400
+            targets.append((Path(file_path), relative_path, size))
+        
+        # Create the directory tree once for the whole batch
+        for directory in sorted({file_path.parent for file_path, _, _ in targets}):
+            directory.mkdir(parents=True, exist_ok=True)
+        
+        with transfer.lock:
+            already_received = {
+                relative_path for relative_path, received_file in transfer.received_files.items()
+                if received_file.complete
+            }
+            # Reserve each new file once, so a retried batch is not counted twice
+            new_files = [(file_path, relative_path, size) for file_path, relative_path, size in targets
+                         if relative_path not in transfer.received_files]
+        
+        # Making room may purge other transfers, so it happens outside the lock
+        reserve_staging(transfer, sum(size for _, _, size in new_files))
+        with transfer.lock:
+            # Files a concurrent request registered meanwhile keep its reservation
+            raced = [size for _, relative_path, size in new_files if relative_path in transfer.received_files]
+            for file_path, relative_path, size in new_files:
+                if relative_path not in transfer.received_files:
+                    transfer.received_files[relative_path] = ReceivedFile(str(file_path), size)
+        if raced:
+            release_staging(transfer, sum(raced))
+        
+        digests = {}
+        for file_path, relative_path, size in targets:
+            remaining = size
+            hasher = BlockHasher(0, size)
+            # Files already stored by an earlier attempt are read past, not rewritten
+            with open(os.devnull if relative_path in already_received else file_path, 'wb') as f:
+                while remaining:
+                    data = body.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise EOFError(f'Batch payload ended inside {relative_path}')
+                    run_blocking(hasher.write, f, data)
+                    remaining -= len(data)
+            digests[relative_path] = tree_hash(file_path, size, hasher.leaves)
+        transfer.compression['upload'].add(len(manifest_line) + sum(size for _, _, size in targets),
+                                           body.wire_bytes, body.cpu_seconds)
+        count_bytes(transfer, 'received', body.wire_bytes)
+        
+        # Corrupted files stay unreceived, so a retried batch writes them again
+        corrupt = [relative_path for _, relative_path, _ in targets
+                   if relative_path not in already_received
+                   and content_hash_mismatch(transfer, relative_path, digests[relative_path])]
+        
+        # Track batch files like chunked ones so a retried batch is not counted twice
+        newly_received = []
+        with transfer.lock:
+            for file_path, relative_path, size in targets:
+                received_file = transfer.received_files.get(relative_path)
+                if (received_file and received_file.complete) or relative_path in corrupt:
+                    continue
+                transfer.received_files[relative_path] = ReceivedFile(
+                    str(file_path), size, [[0, size]] if size else [], complete=True)
+                newly_received.append((file_path, relative_path, size))
+        
+        for file_path, relative_path, size in newly_received:
+            record_uploaded_file(transfer, file_path, relative_path,
+                                 os.path.basename(relative_path), size, digests[relative_path])
+        
+        if corrupt:
+            return jsonify({'error': 'Content hash mismatch, files discarded', 'corrupt': corrupt}), 422
+        
+        logger.info(f'Batch of {len(targets)} files stored for transfer {transfer_id}')
+        return jsonify({
+            'success': True,
+            'transfer_id': transfer_id,
+            'files': len(targets)
+        })
+        
+    except EOFError as e:
+        # Partially written files are not recorded and get overwritten on retry
+        logger.error(f'Batch upload error: {str(e)}')
+        return jsonify({'error': str(e)}), 400
+    except StagingQuotaExceeded as e:
+        logger.error(f'Batch upload rejected: {str(e)}')
+        return jsonify({'error': str(e)}), 507
+    except SchedulerBusy as e:
+        logger.error(f'Batch upload refused: {str(e)}')
+        return jsonify({'error': str(e), 'position': e.position}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logger.error(f'Batch upload error: {str(e)}', exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/relay/<transfer_id>', methods=['PUT'])
+def relay_upload(transfer_id):
+    """Pipe a single file from the raw request body straight to its recipient."""
+    try:
+        transfer = active_transfers.get(transfer_id)
+        relay = relay_buffers.get(transfer_id)
+        if transfer is None or relay is None:
+            logger.error(f'Relay upload for unknown transfer {transfer_id}')
+            return jsonify({'error': 'Invalid transfer ID'}), 400
+        
+        # The declared size, not MAX_CONTENT_LENGTH, bounds a relayed file
+        if (request.content_length or 0) > int(transfer.filesize):
+            logger.error(f'Relay upload of {request.content_length} bytes exceeds declared size {transfer.filesize}')
+            return jsonify({'error': 'Upload larger than the declared file size'}), 413
+        
+        with transfer.lock:
+            if relay.writer_attached:
+                logger.error(f'Relay {transfer_id} already has a sender')
+                return jsonify({'error': 'Relay upload already in progress'}), 409
+            relay.writer_attached = True
+        
+        logger.info(f'Relaying {transfer.filename} ({transfer.filesize} bytes) for transfer {transfer_id}')
+        
+        relayed = 0
+        try:
+            stream = get_input_stream(request.environ, max_content_length=int(transfer.filesize))
+            while True:
+                data = stream.read(1024 * 1024)
+                if not data:
+                    break
+                relay.write(data)
+                relayed += len(data)
+                count_bytes(transfer, 'received', len(data))
+                transfer.touch()
+        except (TimeoutError, ConnectionError) as e:
+            logger.error(f'Relay {transfer_id} aborted after {relayed} bytes: {str(e)}')
+            relay.abort(str(e))
+            if not relay.reader_attached:
+                # No download will ever run relay_stream's cleanup
+                relay_buffers.pop(transfer_id, None)
+                active_transfers.pop(transfer_id)
+            return jsonify({'error': f'Relay aborted: {str(e)}'}), 409
+        except Exception:
+            relay.abort('Sender upload failed')
+            raise
+        relay.close()
+        
+        return jsonify({
+            'success': True,
+            'transfer_id': transfer_id,
+            'relayed': relayed
+        })
+        
+    except Exception as e:
+        logger.error(f'Relay upload error: {str(e)}', exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/status/<transfer_id>')
+def upload_status(transfer_id):
+    """Report received and missing byte ranges so a client can resume."""
+    transfer = active_transfers.get(transfer_id)
+    if transfer is None:
+        logger.error(f'Status requested for unknown transfer {transfer_id}')
+        return jsonify({'error': 'Invalid transfer ID'}), 404
+    
+    with transfer.lock:
+        files = {
+            relative_path: received_file.to_dict()
+            for relative_path, received_file in transfer.received_files.items()
+        }
+    
+    return jsonify({
+        'transfer_id': transfer_id,
+        'status': transfer.status,
+        'uploaded_files': transfer.uploaded_files,
+        'total_files': transfer.total_files,
+        'compression': transfer.compression_stats(),
+        'recipients': {sid: recipient.to_dict() for sid, recipient in transfer.recipients.items()},
+        'files': files
+    })
+
 @app.route('/download/<transfer_id>')
 def download_file(transfer_id):
     try:
@@ -221,22 +3830,49 @@ def download_file(transfer_id):
             logger.error('No transfer ID provided')
             return jsonify({'error': 'No transfer ID provided'}), 400
             
-        if transfer_id not in active_transfers:
-            logger.error(f'Invalid transfer ID: {transfer_id}. Active transfers: {list(active_transfers.keys())}')
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
+            logger.error(f'Invalid transfer ID: {transfer_id}. Active transfers: {active_transfers.summary()}')
             return jsonify({'error': 'Invalid transfer ID'}), 404
         
-        transfer = active_transfers[transfer_id]
-        logger.info(f'Found transfer: {json.dumps(transfer)}')
+        logger.info(f'Found transfer: {transfer.summary()}')
+        transfer.touch()
+        
+        # Download URLs name the recipient so each one is tracked on its own
+        recipient_sid = request.args.get('recipient')
+        recipient = transfer.recipients.get(recipient_sid)
+        if recipient is not None and recipient.active and recipient.status != 'downloading':
+            update_recipient(transfer, recipient_sid, 'downloading')
+        
+        if transfer.relay:
+            relay = relay_buffers.get(transfer_id)
+            if relay is None:
+                logger.error(f'Relay buffer missing for transfer {transfer_id}')
+                return jsonify({'error': 'Relay not available'}), 404
+            with transfer.lock:
+                if relay.reader_attached:
+                    logger.error(f'Relay {transfer_id} already has a recipient')
+                    return jsonify({'error': 'Relay download already in progress'}), 409
+                relay.reader_attached = True
+            
+            response = Response(relay_stream(transfer, relay), mimetype='application/octet-stream')
+            response.content_length = int(transfer.filesize)
+            set_attachment_header(response, secure_filename(transfer.filename) or 'download')
+            return response
+        
+        # Listed files of a directory may be fetched while the rest is still uploading
+        paths = set(request.args.getlist('path'))
+        progressive = bool(paths) and transfer.is_directory and transfer.status == 'accepted'
         
         # Verify transfer status
-        if transfer['status'] != 'ready_for_download':
-            logger.error(f'Files not ready for download. Current status: {transfer["status"]}')
+        if transfer.status != 'ready_for_download' and not progressive:
+            logger.error(f'Files not ready for download. Current status: {transfer.status}')
             return jsonify({
                 'error': 'Files not ready for download',
-                'status': transfer['status']
+                'status': transfer.status
             }), 400
         
-        base_path = transfer['base_path']
+        base_path = transfer.base_path or str(Path(app.config['UPLOAD_FOLDER']) / transfer_id)
         if not os.path.exists(base_path):
             logger.error(f'Base path not found: {base_path}')
             return jsonify({'error': 'Files not found'}), 404
@@ -246,42 +3882,22 @@ def download_file(transfer_id):
         is_mobile = 'mobile' in user_agent or 'iphone' in user_agent or 'android' in user_agent
         logger.info(f'User agent: {user_agent}, Is mobile: {is_mobile}')
 
-        if transfer.get('is_directory', False) and is_mobile:
-            try:
-                # For mobile devices, always create a zip file
-                import zipfile
-                import io
-                
-                # Create zip file in memory
-                memory_file = io.BytesIO()
-                with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-                    for file_info in transfer['files']:
-                        src_path = file_info['path']
-                        rel_path = file_info['relative_path']
-                        
-                        # Normalize the relative path
-                        rel_path = os.path.normpath(rel_path)
-                        
-                        if os.path.exists(src_path):
-                            logger.info(f'Adding to zip: {src_path} as {rel_path}')
-                            zf.write(src_path, rel_path)
-                
-                memory_file.seek(0)
-                dir_name = os.path.basename(transfer['filename'])
-                return send_file(
-                    memory_file,
-                    mimetype='application/zip',
-                    as_attachment=True,
-                    download_name=f'{dir_name}.zip'
-                )
-                
-            except Exception as e:
-                logger.error(f'Error creating zip file: {str(e)}', exc_info=True)
-                return jsonify({
-                    'error': f'Error creating zip file: {str(e)}'
-                }), 500
-        elif transfer.get('is_directory', False):
-            # Desktop handling remains the same
+        if transfer.is_directory and is_mobile:
+            # For mobile devices, stream a zip file built on the fly
+            with transfer.lock:
+                entries = [
+                    (file_info['path'], os.path.normpath(file_info['relative_path']))
+                    for file_info in transfer.files
+                    if not paths or file_info['relative_path'] in paths
+                ]
+            dir_name = os.path.basename(transfer.filename)
+            slot = schedule_request(transfer, recipient_sid)
+            response = Response(stream_zip(entries, transfer=transfer, slot=slot), mimetype='application/zip')
+            set_attachment_header(response, f'{dir_name}.zip')
+            return response
+        elif transfer.is_directory:
+            # Desktop handling remains the same; files are copied locally, so only the caps apply
+            schedule_request(transfer, recipient_sid)
             try:
                 # Get the download directory from query parameters
                 download_dir = request.args.get('download_dir', '')
@@ -303,64 +3919,85 @@ def download_file(transfer_id):
                 # Create the target directory if it doesn't exist
                 os.makedirs(target_base, exist_ok=True)
                 
-                # Get the directory name from the transfer
-                dir_name = os.path.basename(transfer['filename'])
-                target_dir = os.path.join(target_base, dir_name)
+                # A recipient fetching progressively keeps writing into one directory
+                with transfer.lock:
+                    target_dir = recipient.target_dir if recipient is not None else None
+                    if target_dir is None:
+                        # Get the directory name from the transfer
+                        dir_name = os.path.basename(transfer.filename)
+                        target_dir = os.path.join(target_base, dir_name)
+                        
+                        # Create a unique directory name if it already exists
+                        counter = 1
+                        original_target_dir = target_dir
+                        while os.path.exists(target_dir):
+                            target_dir = f"{original_target_dir}_{counter}"
+                            counter += 1
+                        
+                        logger.info(f'Creating directory: {target_dir}')
+                        os.makedirs(target_dir, exist_ok=True)
+                        if recipient is not None:
+                            recipient.target_dir = target_dir
+                    delivered = recipient.delivered if recipient is not None else set()
+                    files = [
+                        file_info for file_info in transfer.files
+                        if file_info['relative_path'] not in delivered
+                        and (not paths or file_info['relative_path'] in paths)
+                    ]
                 
-                # Create a unique directory name if it already exists
-                counter = 1
-                original_target_dir = target_dir
-                while os.path.exists(target_dir):
-                    target_dir = f"{original_target_dir}_{counter}"
-                    counter += 1
+                # Map the requested staged files to their place in the target directory
+                placements = []
+                placed_paths = []
+                for file_info in files:
+                    src_path = file_info['path']
+                    rel_path = file_info['relative_path']
+                    
+                    # Normalize the relative path based on OS
+                    rel_path = os.path.normpath(rel_path)
+                    if os.name == 'nt':  # Windows
+                        rel_path = rel_path.replace('/', '\\')
+                    else:  # Unix-like
+                        rel_path = rel_path.replace('\\', '/')
+                    
+                    # Calculate the target path relative to the new directory
+                    rel_parts = rel_path.split(os.sep)
+                    if len(rel_parts) > 1:
+                        # Skip the first component (original dir name)
+                        rel_path = os.path.join(*rel_parts[1:])
+                    
+                    if os.path.exists(src_path):
+                        placements.append((src_path, os.path.join(target_dir, rel_path)))
+                        placed_paths.append(file_info['relative_path'])
+                    else:
+                        logger.error(f'Source file not found: {src_path}')
                 
-                logger.info(f'Creating directory: {target_dir}')
-                os.makedirs(target_dir, exist_ok=True)
+                # Create the directory tree once, then move or copy the files
+                for directory in sorted({os.path.dirname(target_path) for _, target_path in placements}):
+                    os.makedirs(directory, exist_ok=True)
                 
-                # Copy all files maintaining directory structure
-                files_copied = []
-                for file_info in transfer['files']:
-                    try:
-                        src_path = file_info['path']
-                        rel_path = file_info['relative_path']
-                        
-                        # Normalize the relative path based on OS
-                        rel_path = os.path.normpath(rel_path)
-                        if os.name == 'nt':  # Windows
-                            rel_path = rel_path.replace('/', '\\')
-                        else:  # Unix-like
-                            rel_path = rel_path.replace('\\', '/')
-                        
-                        # Calculate the target path relative to the new directory
-                        rel_parts = rel_path.split(os.sep)
-                        if len(rel_parts) > 1:
-                            # Skip the first component (original dir name)
-                            rel_path = os.path.join(*rel_parts[1:])
-                        target_path = os.path.join(target_dir, rel_path)
-                        
-                        # Create parent directories
-                        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                        
-                        # Copy the file with error handling
-                        logger.info(f'Copying file: {src_path} -> {target_path}')
-                        if os.path.exists(src_path):
-                            shutil.copy2(src_path, target_path)
-                            files_copied.append(target_path)
-                        else:
-                            logger.error(f'Source file not found: {src_path}')
-                    except Exception as e:
-                        logger.error(f'Error copying file {src_path}: {str(e)}')
-                        continue
+                same_filesystem = os.stat(base_path).st_dev == os.stat(target_dir).st_dev
+                # Staged files stay put while the upload runs or other recipients need them
+                others = [sid for sid in transfer.active_recipients() if sid != recipient_sid]
+                delivery = deliver_files(placements, same_filesystem, keep_staged=progressive or bool(others))
+                files_copied = delivery['files']
                 
-                if not files_copied:
+                if placements and not files_copied:
                     raise Exception('No files were copied successfully')
                 
-                logger.info(f'Successfully copied {len(files_copied)} files to {target_dir}')
+                with transfer.lock:
+                    delivered.update(placed_paths)
+                count_bytes(transfer, 'sent', delivery['bytes'])
+                logger.info(f'Delivered {files_copied} files ({delivery["bytes"]} bytes) to {target_dir} '
+                            f'using {delivery["strategy"]}')
                 return jsonify({
                     'success': True,
                     'message': 'Directory downloaded successfully',
                     'path': target_dir,
-                    'files_copied': len(files_copied)
+                    'files_copied': files_copied,
+                    'files_delivered': len(delivered) if recipient is not None else files_copied,
+                    'bytes': delivery['bytes'],
+                    'strategy': delivery['strategy'],
+                    'strategies': delivery['strategies']
                 })
                 
             except Exception as e:
@@ -376,103 +4013,171 @@ def download_file(transfer_id):
                     'error': f'Error copying files: {str(e)}',
                     'details': {
                         'target_dir': target_dir if 'target_dir' in locals() else None,
-                        'files_copied': len(files_copied) if 'files_copied' in locals() else 0
+                        'files_copied': files_copied if 'files_copied' in locals() else 0
                     }
                 }), 500
         else:
-            # Single file download
-            file_path = transfer['files'][0]['path']
-            return send_file(
-                file_path,
-                as_attachment=True,
-                download_name=os.path.basename(file_path)
-            )
+            # Single file download, resumable with Range requests
+            file_info = transfer.files[0]
+            file_path = file_info['path']
+            slot = schedule_request(transfer, recipient_sid)
+            return send_staged_file(file_path, os.path.basename(file_path), transfer, slot, file_info['hash'])
         
+    except SchedulerBusy as e:
+        logger.error(f'Download refused: {str(e)}')
+        return jsonify({'error': str(e), 'position': e.position}), 503, {'Retry-After': '5'}
     except Exception as e:
         logger.error(f'Download error: {str(e)}', exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/download/<transfer_id>/file')
+def download_staged_file(transfer_id):
+    """Send one staged file of a directory, also while the rest is uploading."""
+    try:
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None or transfer.relay:
+            logger.error(f'Invalid transfer ID for file download: {transfer_id}')
+            return jsonify({'error': 'Invalid transfer ID'}), 404
+        
+        relative_path = request.args.get('path', '')
+        with transfer.lock:
+            file_info = next((f for f in transfer.files if f['relative_path'] == relative_path), None)
+        if file_info is None or not os.path.exists(file_info['path']):
+            logger.error(f'File {relative_path!r} is not staged for transfer {transfer_id}')
+            return jsonify({'error': 'File not staged', 'status': transfer.status}), 404
+        
+        transfer.touch()
+        recipient_sid = request.args.get('recipient')
+        recipient = transfer.recipients.get(recipient_sid)
+        if recipient is not None and recipient.active and recipient.status != 'downloading':
+            update_recipient(transfer, recipient_sid, 'downloading')
+        
+        slot = schedule_request(transfer, recipient_sid)
+        return send_staged_file(file_info['path'], os.path.basename(relative_path), transfer, slot,
+                                file_info['hash'])
+    except SchedulerBusy as e:
+        logger.error(f'File download refused: {str(e)}')
+        return jsonify({'error': str(e), 'position': e.position}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logger.error(f'File download error: {str(e)}', exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @socketio.on('connect')
 def handle_connect():
     device_id = request.sid
     device_name = request.args.get('device_name', f'Device_{device_id[:6]}')
     device_ip = get_device_ip(request)
     
-    # Remove any existing connections with the same IP
-    disconnected_ids = []
-    for sid, device in connected_devices.items():
-        if device['ip'] == device_ip and sid != device_id:
-            disconnected_ids.append(sid)
-    
-    for sid in disconnected_ids:
-        del connected_devices[sid]
+    # Replace any existing connection with the same IP
+    evicted, version = connected_devices.add(device_id, device_name, device_ip)
+    if evicted:
+        evicted_device, evicted_version = evicted
+        logger.info(f'Replacing device {evicted_device["name"]} ({evicted_device["id"]}) from IP: {device_ip}')
+        emit('device_left', {'id': evicted_device['id'], 'version': evicted_version},
+             broadcast=True, include_self=False)
     
     logger.info(f'Device connected: {device_name} ({device_id}) from IP: {device_ip}')
     
-    connected_devices[device_id] = {
-        'id': device_id,
-        'name': device_name,
-        'ip': device_ip
-    }
-    
-    emit('device_list', connected_devices, broadcast=True)
+    # The new device gets the full list, everyone else just the delta
+    emit('device_list', connected_devices.snapshot())
+    emit('device_joined', {'device': connected_devices[device_id], 'version': version},
+         broadcast=True, include_self=False)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     device_id = request.sid
-    if device_id in connected_devices:
-        logger.info(f'Device disconnected: {connected_devices[device_id]["name"]} ({device_id})')
-        del connected_devices[device_id]
-        emit('device_list', connected_devices, broadcast=True)
+    device, version = connected_devices.remove(device_id)
+    if device:
+        logger.info(f'Device disconnected: {device["name"]} ({device_id})')
+        emit('device_left', {'id': device_id, 'version': version}, broadcast=True, include_self=False)
+
+@socketio.on('device_rename')
+def handle_device_rename(data):
+    name = (data.get('name') or '').strip()
+    if not name:
+        logger.error('Empty name in device rename request')
+        return
+    
+    version = connected_devices.rename(request.sid, name)
+    if version is None:
+        logger.error(f'Rename requested by unknown device {request.sid}')
+        return
+    
+    logger.info(f'Device {request.sid} renamed to {name}')
+    emit('device_renamed', {'id': request.sid, 'name': name, 'version': version}, broadcast=True)
+
+@socketio.on('device_list_request')
+def handle_device_list_request(data=None):
+    # Sent by clients that missed a delta event
+    emit('device_list', connected_devices.snapshot())
 
 @socketio.on('file_transfer_request')
 def handle_file_transfer_request(data):
     try:
         logger.info(f'Received file transfer request: {json.dumps(data)}')
-        if 'target' not in data:
+        # ``targets`` lists several recipients; a single ``target`` is still accepted
+        targets = data.get('targets') or data.get('target')
+        if not targets:
             logger.error('No target specified in file transfer request')
             return
-            
-        if data['target'] not in connected_devices:
-            logger.error(f'Target device {data["target"]} not found in connected devices')
+        if isinstance(targets, str):
+            targets = [targets]
+        
+        targets = list(dict.fromkeys(sid for sid in targets if sid != request.sid))
+        missing = [sid for sid in targets if sid not in connected_devices]
+        if missing or not targets:
+            logger.error(f'Target devices {missing} not found in connected devices')
             emit('file_transfer_error', {
                 'error': 'Target device not found'
             }, room=request.sid)
             return
+        
+        # A relay is bounded by the declared size, so it needs a valid one
+        filesize = data.get('filesize', 0)
+        try:
+            filesize = int(filesize)
+            valid_size = filesize >= 0
+        except (TypeError, ValueError):
+            valid_size = False
+        if data.get('relay') and not valid_size:
+            logger.error(f'Invalid file size {filesize!r}, staging the transfer instead of relaying it')
             
-        transfer_id = os.urandom(16).hex()
-        active_transfers[transfer_id] = {
-            'sender': request.sid,
-            'recipient_sid': data['target'],
-            'filename': data.get('filename', 'unknown'),
-            'filesize': data.get('filesize', 0),
-            'status': 'pending',
-            'is_directory': data.get('isDirectory', False),
-            'total_files': data.get('total_files', 1),
-            'uploaded_files': 0,
-            'files': [],
-            'created_at': datetime.now().isoformat()
-        }
+        transfer = active_transfers.create(
+            sender=request.sid,
+            recipients=[(sid, connected_devices[sid]['name']) for sid in targets],
+            filename=data.get('filename', 'unknown'),
+            filesize=filesize,
+            is_directory=data.get('isDirectory', False),
+            # A live relay streams to exactly one reader, which has to be in the sender's process
+            relay=(bool(data.get('relay', False)) and not data.get('isDirectory', False)
+                   and len(targets) == 1 and shared_state is None and valid_size),
+            total_files=data.get('total_files', 1)
+        )
+        transfer_id = transfer.transfer_id
         
-        logger.info(f'Created transfer {transfer_id} from {connected_devices[request.sid]["name"]} to {connected_devices[data["target"]]["name"]}')
-        logger.info(f'Transfer data: {json.dumps(active_transfers[transfer_id])}')
+        target_names = ', '.join(connected_devices[sid]['name'] for sid in targets)
+        logger.info(f'Created transfer {transfer_id} from {connected_devices[request.sid]["name"]} to {target_names}')
+        logger.info(f'Transfer data: {transfer.summary()}')
         
-        # Notify recipient about the transfer request
+        # Notify recipients about the transfer request
         transfer_request = {
             'transfer_id': transfer_id,
             'from': request.sid,
             'from_name': connected_devices[request.sid]['name'],
             'filename': data.get('filename', 'unknown'),
             'filesize': data.get('filesize', 0),
-            'is_directory': data.get('isDirectory', False)
+            'is_directory': data.get('isDirectory', False),
+            'relay': transfer.relay
         }
-        logger.info(f'Sending transfer request to recipient: {json.dumps(transfer_request)}')
-        emit('file_transfer_request', transfer_request, room=data['target'])
+        logger.info(f'Sending transfer request to recipients: {json.dumps(transfer_request)}')
+        for sid in targets:
+            emit('file_transfer_request', transfer_request, room=sid)
         
         # Also notify sender that request was sent
         emit('file_transfer_request_sent', {
             'transfer_id': transfer_id,
-            'target': data['target']
+            'target': targets[0],
+            'targets': targets
         }, room=request.sid)
         
     except Exception as e:
@@ -491,35 +4196,88 @@ def handle_file_transfer_accept(data):
             logger.error('No transfer_id in accept request')
             return
             
-        if transfer_id not in active_transfers:
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
             logger.error(f'Transfer {transfer_id} not found in active transfers')
             emit('file_transfer_error', {
                 'error': 'Transfer not found'
             }, room=request.sid)
             return
             
-        transfer = active_transfers[transfer_id]
-        if transfer['sender'] not in connected_devices:
-            logger.error(f'Sender {transfer["sender"]} not connected')
+        recipient = transfer.recipients.get(request.sid)
+        if recipient is None or recipient.status != 'pending':
+            logger.error(f'{request.sid} cannot accept transfer {transfer_id}')
+            emit('file_transfer_error', {
+                'error': 'Transfer not offered to this device'
+            }, room=request.sid)
+            return
+        
+        if transfer.status != 'ready_for_download' and transfer.sender not in connected_devices:
+            logger.error(f'Sender {transfer.sender} not connected')
             emit('file_transfer_error', {
                 'error': 'Sender disconnected'
             }, room=request.sid)
             return
-            
-        # Don't override the recipient_sid that was set during request
-        active_transfers[transfer_id].update({
-            'status': 'accepted',
-            'accepted_at': datetime.now().isoformat()
-        })
-        logger.info(f'Transfer {transfer_id} accepted by {connected_devices[request.sid]["name"]}')
-        logger.info(f'Updated transfer data: {json.dumps(active_transfers[transfer_id])}')
         
-        # Send upload URL to sender
+        with transfer.lock:
+            recipient.status = 'accepted'
+            first_accept = transfer.accepted_at is None
+            if first_accept:
+                transfer.accepted_at = datetime.now().isoformat()
+            notify_now = transfer.status == 'ready_for_download' and not recipient.notified
+            if notify_now:
+                recipient.notified = True
+        logger.info(f'Transfer {transfer_id} accepted by {recipient.name}')
+        update_recipient(transfer, request.sid, 'accepted')
+        
+        if not first_accept:
+            # The upload is already under way; this recipient joins it
+            if notify_now:
+                notify_ready(transfer, request.sid)
+            elif transfer.is_directory and transfer.status == 'accepted' and transfer.files:
+                notify_staged(transfer, request.sid, staged_manifest(transfer))
+            return
+        
+        active_transfers.set_status(transfer, 'accepted')
+        logger.info(f'Updated transfer data: {transfer.summary()}')
+        
+        # The relay has to exist before the sender learns where to upload
+        if transfer.relay:
+            relay_buffers[transfer_id] = RelayBuffer(app.config['RELAY_BUFFER_SIZE'],
+                                                     app.config['RELAY_TIMEOUT'])
+        
+        # Send upload URL to sender, once for all recipients
         emit('file_transfer_accepted', {
             'transfer_id': transfer_id,
             'upload_url': f'/upload',
-            'recipient_name': connected_devices[request.sid]['name']
-        }, room=transfer['sender'])
+            'chunk_upload_url': '/upload/chunk',
+            'raw_upload_url': '/upload/raw',
+            'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+            'parallel_chunks': app.config['UPLOAD_PARALLEL_CHUNKS'],
+            'batch_upload_url': '/upload/batch',
+            'batch_file_limit': app.config['BATCH_FILE_LIMIT'],
+            'batch_max_bytes': app.config['BATCH_MAX_BYTES'],
+            'batch_max_files': app.config['BATCH_MAX_FILES'],
+            'manifest_url': '/upload/manifest',
+            'probe_url': '/upload/probe',
+            'probe_size': app.config['COMPRESSION_PROBE_SIZE'],
+            'hash_chunk_size': HASH_CHUNK_SIZE,
+            'relay': transfer.relay,
+            'relay_upload_url': f'/relay/{transfer_id}',
+            'recipient_name': recipient.name,
+            'recipient_count': len(transfer.recipients)
+        }, room=transfer.sender)
+        
+        # In relay mode the recipient starts downloading right away and
+        # receives bytes as the sender uploads them
+        if transfer.relay:
+            emit('file_ready_for_download', {
+                'transfer_id': transfer_id,
+                'filename': transfer.filename,
+                'download_url': f'/download/{transfer_id}?{urlencode({"recipient": request.sid})}',
+                'is_directory': False,
+                'relay': True
+            }, room=request.sid)
         
     except Exception as e:
         logger.error(f'Error in file transfer accept: {str(e)}', exc_info=True)
@@ -535,20 +4293,14 @@ def handle_file_transfer_reject(data):
             logger.error('No transfer_id in reject request')
             return
             
-        if transfer_id not in active_transfers:
+        transfer = active_transfers.get(transfer_id)
+        if transfer is None:
             logger.error(f'Transfer {transfer_id} not found in active transfers')
             return
-            
-        transfer = active_transfers[transfer_id]
-        if transfer['sender'] in connected_devices:
-            logger.info(f'File transfer rejected by {connected_devices[request.sid]["name"]}')
-            emit('file_transfer_rejected', {
-                'transfer_id': transfer_id
-            }, room=transfer['sender'])
-            
-        # Clean up the transfer
-        del active_transfers[transfer_id]
-        logger.info(f'Transfer {transfer_id} cleaned up after rejection')
+        
+        # The transfer is dropped once every recipient has rejected it
+        if not update_recipient(transfer, request.sid, 'rejected'):
+            logger.error(f'{request.sid} is not a recipient of transfer {transfer_id}')
         
     except Exception as e:
         logger.error(f'Error in file transfer reject: {str(e)}', exc_info=True)
@@ -556,34 +4308,211 @@ def handle_file_transfer_reject(data):
 @socketio.on('file_transfer_complete')
 def handle_file_transfer_complete(data):
     transfer_id = data['transfer_id']
-    if transfer_id in active_transfers:
-        # Clean up the transfer
-        transfer_path = Path(app.config['UPLOAD_FOLDER']) / transfer_id
-        if transfer_path.exists():
-            shutil.rmtree(transfer_path)
-        del active_transfers[transfer_id]
-        logger.info(f'File transfer completed and cleaned up: {transfer_id}')
+    if transfer_id in relay_buffers:
+        # A relay cleans up after itself once the stream has ended
+        logger.info(f'Ignoring completion of relay {transfer_id} while it is streaming')
+        return
+    transfer = active_transfers.get(transfer_id)
+    if transfer is None:
+        return
+    # Staged files are cleaned up after the last recipient completes
+    if not update_recipient(transfer, request.sid, 'completed'):
+        logger.error(f'{request.sid} is not a recipient of transfer {transfer_id}')
+
+def use_shared_state(path, message_queue=None, reset=False):
+    """Keep devices, transfers and blobs in a database that worker processes share.
+
+    Socket.IO events reach clients of other workers through ``message_queue``
+    (a Redis or RabbitMQ URL, as Flask-SocketIO takes it) or, without one,
+    through the database. Live relays are turned off: both of their sides
+    have to meet in one process.
+    """
+    global shared_state, connected_devices, active_transfers, blob_store
+    shared_state = SharedState(path)
+    if reset:
+        shared_state.reset()
+    connected_devices = SharedDeviceRegistry(shared_state)
+    active_transfers = SharedTransferStore(shared_state)
+    blob_store = SharedBlobStore(shared_state, blob_store.root)
+    
+    if message_queue:
+        options = {'message_queue': message_queue}
+    else:
+        options = {'client_manager': SQLiteQueueManager(shared_state)}
+    # init_app builds a new server and wraps app.wsgi_app again; keep the
+    # event handlers registered on the old server and drop the old wrapper
+    handlers = socketio.server.handlers
+    app.wsgi_app = socketio.sockio_mw.wsgi_app
+    socketio.init_app(app, transports=['websocket'], **options)
+    socketio.server.handlers = handlers
+
+def serve_worker(listener, run_options):
+    """Serve the app in a worker process on the socket inherited from the parent.
+
+    ``run_options`` are those ``socketio.run`` would get, which binds a
+    socket of its own.
+    """
+    if ASYNC_MODE == 'eventlet':
+        eventlet.wsgi.server(listener, app, log_output=False, max_size=run_options['max_size'])
+        return
+    from gevent import pywsgi
+    options = {'log': None, 'spawn': run_options['spawn']}
+    try:
+        from geventwebsocket.handler import WebSocketHandler
+        options['handler_class'] = WebSocketHandler
+    except ImportError:  # engineio falls back to simple-websocket
+        pass
+    pywsgi.WSGIServer(listener, app, **options).serve_forever()
+
+def run_workers(args, port):
+    """Run ``args.workers`` worker processes accepting on one listening socket.
+
+    Workers are fresh interpreters started with this command line; they find
+    the socket, upload folder and staging quota in the environment. A worker
+    that dies is replaced and its devices leave the shared registry.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, port))
+    listener.listen(socket.SOMAXCONN)
+    
+    command = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    env = dict(os.environ,
+               LOCALSHARE_LISTEN_FD=str(listener.fileno()),
+               LOCALSHARE_UPLOAD_FOLDER=app.config['UPLOAD_FOLDER'],
+               LOCALSHARE_STAGING_QUOTA=str(staging_quota()))
+    
+    def start_worker(index):
+        return subprocess.Popen(command, env=dict(env, LOCALSHARE_WORKER=str(index)),
+                                pass_fds=(listener.fileno(),))
+    
+    workers = [start_worker(index) for index in range(args.workers)]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(1)
+            for index, worker in enumerate(workers):
+                if worker.poll() is None:
+                    continue
+                logger.error(f'Worker {index} (pid {worker.pid}) exited with status {worker.returncode}, restarting it')
+                for device, version in connected_devices.remove_worker(worker.pid):
+                    socketio.emit('device_left', {'id': device['id'], 'version': version})
+                workers[index] = start_worker(index)
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+def parse_args(argv=None):
+    """Parse the server command line."""
+    parser = argparse.ArgumentParser(description='LocalShare file sharing server')
+    parser.add_argument('--server', choices=SERVER_MODES, default='auto',
+                        help='async backend: eventlet, gevent or threading (Werkzeug dev server); '
+                             'auto picks the first one installed')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, help='port to listen on (default: first free port from 5000)')
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help='concurrent connections served by eventlet/gevent')
+    parser.add_argument('--io-workers', type=int, default=20,
+                        help='native threads doing blocking file I/O under eventlet/gevent')
+    parser.add_argument('--staging-quota-mb', type=int,
+                        help='disk space for staged uploads (default: 90%% of free space at startup)')
+    parser.add_argument('--max-active-requests', type=int,
+                        help=f'upload and download requests moving data at once per process '
+                             f'(default: {app.config["MAX_ACTIVE_REQUESTS"]})')
+    parser.add_argument('--max-device-requests', type=int,
+                        help=f'such requests per device at once (default: {app.config["MAX_DEVICE_REQUESTS"]})')
+    parser.add_argument('--rate-limit-mbps', type=float,
+                        help='MB/s all transfers may move together per process (default: unlimited)')
+    parser.add_argument('--device-rate-limit-mbps', type=float,
+                        help='MB/s each device may move (default: unlimited)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port (eventlet/gevent); more than one '
+                             'keeps devices and transfers in the --state-db database')
+    parser.add_argument('--state-db', help='SQLite database for state shared by workers '
+                                           '(default: state.sqlite3 in the upload folder)')
+    parser.add_argument('--message-queue', help='Redis or RabbitMQ URL passing Socket.IO events between '
+                                                'workers (default: the state database)')
+    parser.add_argument('--debug', action='store_true', help='enable Flask debug mode and the reloader')
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
     try:
+        args = parse_args()
+        worker_index = os.environ.get('LOCALSHARE_WORKER')  # Set in worker processes
+        main_process = not os.environ.get('WERKZEUG_RUN_MAIN') and worker_index is None
+        if args.workers > 1 and (ASYNC_MODE == 'threading' or args.debug):
+            raise ValueError('--workers needs the eventlet or gevent server and no --debug')
+        
         # Only find port in the main process
-        if not os.environ.get('WERKZEUG_RUN_MAIN'):
-            port = find_available_port()
+        if main_process:
+            port = args.port or find_available_port()
             os.environ['SERVER_PORT'] = str(port)
         else:
             port = int(os.environ.get('SERVER_PORT'))
             
-        if not os.environ.get('WERKZEUG_RUN_MAIN'):
-            logger.info(f"Starting server on port {port}")
-            print(f"\n* Server is running on port {port}")
+        if main_process:
+            workers = f', {args.workers} workers' if args.workers > 1 else ''
+            logger.info(f"Starting server on port {port} using {ASYNC_MODE}{workers}")
+            print(f"\n* Server is running on port {port} ({ASYNC_MODE}{workers})")
             print(f"* Access URLs:")
-            for ip in get_ip_addresses():
+            for ip in network_snapshot.addresses():
                 print(f"*   http://{ip}:{port}")
             print("\n* Press Ctrl+C to quit\n")
             
         # Set the port in app config so it's accessible everywhere
         app.config['SERVER_PORT'] = port
-        socketio.run(app, host='0.0.0.0', port=port, debug=True)
+        if args.staging_quota_mb is not None:
+            app.config['STAGING_QUOTA_BYTES'] = args.staging_quota_mb * 1024 * 1024
+        if os.environ.get('LOCALSHARE_STAGING_QUOTA'):
+            # Workers share the quota their parent worked out
+            app.config['STAGING_QUOTA_BYTES'] = int(os.environ['LOCALSHARE_STAGING_QUOTA'])
+        if worker_index is None:
+            logger.info(f'Staging quota: {staging_quota()} bytes')
+        if args.max_active_requests is not None:
+            app.config['MAX_ACTIVE_REQUESTS'] = args.max_active_requests
+        if args.max_device_requests is not None:
+            app.config['MAX_DEVICE_REQUESTS'] = args.max_device_requests
+        if args.rate_limit_mbps:
+            app.config['RATE_LIMIT_BYTES'] = args.rate_limit_mbps * 1e6
+        if args.device_rate_limit_mbps:
+            app.config['DEVICE_RATE_LIMIT_BYTES'] = args.device_rate_limit_mbps * 1e6
+        
+        if args.workers > 1 or args.state_db:
+            state_db = args.state_db or os.path.join(app.config['UPLOAD_FOLDER'], 'state.sqlite3')
+            use_shared_state(state_db, args.message_queue, reset=worker_index is None)
+            if worker_index is None:
+                logger.info(f'Shared state in {state_db}')
+        if args.workers > 1 and worker_index is None:
+            run_workers(args, port)
+            sys.exit(0)
+        
+        run_options = {'debug': args.debug, 'use_reloader': args.debug, 'log_output': args.debug}
+        if ASYNC_MODE == 'eventlet':
+            eventlet.tpool.set_num_threads(args.io_workers)
+            run_options['max_size'] = args.max_connections
+        elif ASYNC_MODE == 'gevent':
+            from gevent.pool import Pool
+            gevent.get_hub().threadpool.maxsize = args.io_workers
+            run_options['spawn'] = Pool(args.max_connections)
+        else:
+            logger.warning('Using the Werkzeug development server; '
+                           '--max-connections and --io-workers have no effect')
+            run_options['allow_unsafe_werkzeug'] = True
+        
+        # With several workers only the first one sweeps and watches the network
+        if worker_index in (None, '0'):
+            if app.config['NETWORK_REFRESH_INTERVAL']:
+                socketio.start_background_task(watch_network, app.config['NETWORK_REFRESH_INTERVAL'])
+            if app.config['REAPER_INTERVAL']:
+                socketio.start_background_task(run_reaper, app.config['REAPER_INTERVAL'])
+        if worker_index is not None:
+            logger.info(f'Worker {worker_index} (pid {os.getpid()}) started')
+            serve_worker(socket.socket(fileno=int(os.environ['LOCALSHARE_LISTEN_FD'])), run_options)
+        else:
+            socketio.run(app, host=args.host, port=port, **run_options)
     except Exception as e:
         logger.error(f"Failed to start server: {str(e)}")
-        print(f"\nError: {str(e)}") 
\ No newline at end of file
+        print(f"\nError: {str(e)}")
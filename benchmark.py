@@ -0,0 +1,408 @@
+"""Load benchmark for LocalShare.
+
+Starts app.py on a free local port and pairs up N simulated devices
+(python-socketio clients). Each sender pushes a synthetic workload to its
+recipient through the same flow the web page uses: file_transfer_request,
+file_transfer_accept, chunked/batched upload, file_ready_for_download,
+download and file_transfer_complete.
+
+Results are printed as JSON so runs on different commits can be compared:
+
+    python benchmark.py --devices 8 --workloads huge tiny --output before.json
+"""
+
+# Standard library imports
+import argparse
+import json
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from queue import Queue, Empty
+
+# Third-party imports
+import requests
+import socketio
+
+WORKLOADS = ('huge', 'tiny', 'deep', 'mixed')
+MOBILE_USER_AGENT = 'Mozilla/5.0 (Linux; Android 14) LocalShareBenchmark'
+
+def parse_args(argv=None):
+    """Parse the benchmark command line."""
+    parser = argparse.ArgumentParser(description='LocalShare load benchmark')
+    parser.add_argument('--devices', type=int, default=4,
+                        help='simulated devices; they are paired into senders and recipients')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS),
+                        help='synthetic workloads to run, one after another')
+    parser.add_argument('--rounds', type=int, default=1, help='transfers per device pair and workload')
+    parser.add_argument('--huge-mb', type=int, default=256, help='size of the single file of the huge workload')
+    parser.add_argument('--tiny-files', type=int, default=2000, help='number of 1-4 KiB files of the tiny workload')
+    parser.add_argument('--deep-levels', type=int, default=32, help='directory depth of the deep workload')
+    parser.add_argument('--mixed-mb', type=int, default=128, help='total size of the mixed workload')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic file contents')
+    parser.add_argument('--server', default='auto', help='backend passed to app.py --server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes passed to app.py --workers; server metrics then cover '
+                             'whichever worker answers')
+    parser.add_argument('--url', help='benchmark a server that is already running instead of starting one')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for any one event')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    return parser.parse_args(argv)
+
+# Workload generation
+def write_random_file(path, size, rng):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = rng.randbytes(min(remaining, 4 * 1024 * 1024))
+            f.write(block)
+            remaining -= len(block)
+
+def build_workload(name, root, args):
+    """Create the files of a workload under ``root``.
+
+    Returns ``(label, is_directory, files)`` where ``files`` lists
+    ``(path, relative_path)`` pairs, relative paths as the browser sends them.
+    """
+    rng = random.Random(f'{args.seed}-{name}')
+    base = root / name
+    files = []
+
+    if name == 'huge':
+        path = base / 'huge.bin'
+        write_random_file(path, args.huge_mb * 1024 * 1024, rng)
+        return 'huge.bin', False, [(path, 'huge.bin')]
+
+    if name == 'tiny':
+        for i in range(args.tiny_files):
+            relative_path = f'tiny/{i % 50:02d}/file_{i:05d}.txt'
+            files.append((base / relative_path, relative_path))
+            write_random_file(base / relative_path, rng.randint(1024, 4096), rng)
+    elif name == 'deep':
+        parts = ['deep']
+        for level in range(args.deep_levels):
+            parts.append(f'level_{level:02d}')
+            for i in range(3):
+                relative_path = '/'.join(parts + [f'file_{i}.dat'])
+                files.append((base / relative_path, relative_path))
+                write_random_file(base / relative_path, rng.randint(512, 256 * 1024), rng)
+    elif name == 'mixed':
+        # Log-uniform sizes from 1 KiB to 16 MiB
+        total, i = 0, 0
+        while total < args.mixed_mb * 1024 * 1024:
+            size = int(2 ** rng.uniform(10, 24))
+            relative_path = f'mixed/dir_{i % 8}/file_{i:04d}.bin'
+            files.append((base / relative_path, relative_path))
+            write_random_file(base / relative_path, size, rng)
+            total += size
+            i += 1
+    return name, True, files
+
+# Measurements
+class Recorder:
+    """Latency samples per phase and byte counts, shared by all device threads."""
+
+    def __init__(self):
+        self.samples = {}
+        self.bytes = 0
+        self.transfers = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            self.samples.setdefault(phase, []).append(seconds)
+
+    def add_transfer(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+            self.transfers += 1
+
+    def error(self, message):
+        with self._lock:
+            self.errors.append(message)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.5), 6),
+        'p99': round(percentile(values, 0.99), 6),
+        'max': round(max(values), 6)
+    }
+
+# Simulated devices
+class Device:
+    """One simulated browser: a Socket.IO client plus an HTTP session."""
+
+    EVENTS = ('file_transfer_request', 'file_transfer_accepted', 'file_ready_for_download',
+              'file_transfer_rejected', 'transfer_expired')
+
+    def __init__(self, url, name, ip, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.http.headers['X-Forwarded-For'] = ip
+        self.queues = {event: Queue() for event in self.EVENTS}
+        self.sio = socketio.Client(reconnection=False)
+        for event in self.EVENTS:
+            self.sio.on(event, self.queues[event].put)
+        # A distinct forwarded address keeps devices on one host from replacing each other.
+        # WebSocket only, as a multi-worker server keeps each session in one process
+        self.sio.connect(f'{url}?device_name={name}', headers={'X-Forwarded-For': ip},
+                         transports=['websocket'], wait_timeout=timeout)
+
+    @property
+    def sid(self):
+        return self.sio.get_sid()
+
+    def wait(self, event):
+        try:
+            data = self.queues[event].get(timeout=self.timeout)
+        except Empty:
+            raise TimeoutError(f'No {event} within {self.timeout} seconds') from None
+        return data
+
+    def close(self):
+        self.sio.disconnect()
+        self.http.close()
+
+def upload_jobs(files, is_directory, options):
+    """Split files into batch and chunk jobs the way the web page does."""
+    batch_limit = options['batch_file_limit'] if is_directory else 0
+    jobs, batch = [], None
+    for path, relative_path in files:
+        size = path.stat().st_size
+        if size < batch_limit:
+            if (batch is None or batch['size'] + size > options['batch_max_bytes']
+                    or len(batch['files']) >= options['batch_max_files']):
+                batch = {'type': 'batch', 'files': [], 'size': 0}
+                jobs.append(batch)
+            batch['files'].append((path, relative_path, size))
+            batch['size'] += size
+            continue
+        offsets = range(0, size, options['chunk_size']) if size else [0]
+        for offset in offsets:
+            jobs.append({'type': 'chunk', 'path': path, 'relative_path': relative_path, 'size': size,
+                         'offset': offset, 'length': min(options['chunk_size'], size - offset)})
+    return jobs
+
+def send_job(device, transfer_id, job):
+    if job['type'] == 'batch':
+        manifest = {'files': [{'relative_path': relative_path, 'size': size}
+                              for _, relative_path, size in job['files']]}
+        body = bytearray(json.dumps(manifest).encode() + b'\n')
+        for path, _, _ in job['files']:
+            body += path.read_bytes()
+        response = device.http.post(f'{device.url}/upload/batch', params={'transfer_id': transfer_id},
+                                    data=bytes(body))
+    else:
+        with open(job['path'], 'rb') as f:
+            f.seek(job['offset'])
+            data = f.read(job['length'])
+        response = device.http.put(f'{device.url}/upload/chunk', data=data, params={
+            'transfer_id': transfer_id,
+            'relative_path': job['relative_path'],
+            'offset': job['offset'],
+            'filesize': job['size']
+        })
+    response.raise_for_status()
+
+def run_transfer(sender, recipient, workload, recorder):
+    """Run one transfer through the full flow and record its phases."""
+    label, is_directory, files = workload
+    total_size = sum(path.stat().st_size for path, _ in files)
+    started = time.perf_counter()
+
+    sender.sio.emit('file_transfer_request', {
+        'target': recipient.sid,
+        'filename': label,
+        'filesize': total_size,
+        'isDirectory': is_directory,
+        'total_files': len(files)
+    })
+    request = recipient.wait('file_transfer_request')
+    recipient.sio.emit('file_transfer_accept', {'transfer_id': request['transfer_id']})
+    options = sender.wait('file_transfer_accepted')
+    transfer_id = options['transfer_id']
+    recorder.observe('negotiate', time.perf_counter() - started)
+
+    # Upload with as many requests in flight as the server suggests
+    upload_started = time.perf_counter()
+    jobs = upload_jobs(files, is_directory, options)
+    jobs_lock = threading.Lock()
+    failures = []
+
+    def worker():
+        while True:
+            with jobs_lock:
+                if not jobs or failures:
+                    return
+                job = jobs.pop(0)
+            job_started = time.perf_counter()
+            try:
+                send_job(sender, transfer_id, job)
+            except Exception as e:
+                failures.append(e)
+                return
+            recorder.observe(f'upload_{job["type"]}', time.perf_counter() - job_started)
+
+    workers = [threading.Thread(target=worker) for _ in range(options['parallel_chunks'])]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if failures:
+        raise failures[0]
+    recorder.observe('upload', time.perf_counter() - upload_started)
+
+    ready = recipient.wait('file_ready_for_download')
+    recorder.observe('ready', time.perf_counter() - upload_started)
+
+    # Directories are fetched as the streamed ZIP the mobile page receives
+    download_started = time.perf_counter()
+    headers = {'User-Agent': MOBILE_USER_AGENT} if is_directory else {}
+    with recipient.http.get(f'{recipient.url}{ready["download_url"]}', headers=headers, stream=True) as response:
+        response.raise_for_status()
+        downloaded = sum(len(block) for block in response.iter_content(1024 * 1024))
+    recorder.observe('download', time.perf_counter() - download_started)
+    if not is_directory and downloaded != total_size:
+        raise ValueError(f'Downloaded {downloaded} of {total_size} bytes')
+
+    recipient.sio.emit('file_transfer_complete', {'transfer_id': transfer_id})
+    recorder.observe('transfer', time.perf_counter() - started)
+    recorder.add_transfer(total_size)
+
+def run_pair(sender, recipient, workload, rounds, recorder):
+    for _ in range(rounds):
+        try:
+            run_transfer(sender, recipient, workload, recorder)
+        except Exception as e:
+            recorder.error(f'{workload[0]}: {type(e).__name__}: {e}')
+            return
+
+def run_workload(url, devices, workload, rounds):
+    recorder = Recorder()
+    pairs = [(devices[i], devices[i + 1]) for i in range(0, len(devices) - 1, 2)]
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_pair, args=(sender, recipient, workload, rounds, recorder))
+               for sender, recipient in pairs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'files_per_transfer': len(workload[2]),
+        'transfers': recorder.transfers,
+        'bytes': recorder.bytes,
+        'seconds': round(elapsed, 3),
+        'throughput_mbps': round(recorder.bytes / elapsed / 1e6, 3) if elapsed else None,
+        'transfers_per_second': round(recorder.transfers / elapsed, 3) if elapsed else None,
+        'latency_seconds': {phase: summarize(values) for phase, values in sorted(recorder.samples.items())},
+        'errors': recorder.errors
+    }
+
+# Server lifecycle
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(args, log_file):
+    port = free_port()
+    app_path = Path(__file__).resolve().parent / 'app.py'
+    process = subprocess.Popen(
+        [sys.executable, str(app_path), '--host', '127.0.0.1', '--port', str(port), '--server', args.server,
+         '--workers', str(args.workers)],
+        stdout=log_file, stderr=subprocess.STDOUT
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}, see {log_file.name}')
+        try:
+            requests.get(f'{url}/metrics', timeout=1)
+            return process, url
+        except (requests.ConnectionError, requests.Timeout):
+            # Worker processes may still be starting behind an accepting socket
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Server did not start within 30 seconds')
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.devices < 2:
+        raise SystemExit('At least two devices are needed')
+
+    work_dir = Path(tempfile.mkdtemp(prefix='localshare-bench-'))
+    process = None
+    devices = []
+    try:
+        workloads = {name: build_workload(name, work_dir / 'data', args) for name in args.workloads}
+
+        if args.url:
+            url = args.url.rstrip('/')
+        else:
+            log_file = open(work_dir / 'server.log', 'wb')
+            process, url = start_server(args, log_file)
+
+        devices = [Device(url, f'bench-{i}', f'10.77.{i // 250}.{i % 250 + 1}', args.timeout)
+                   for i in range(args.devices)]
+
+        results = {}
+        for name, workload in workloads.items():
+            results[name] = run_workload(url, devices, workload, args.rounds)
+
+        server_metrics = requests.get(f'{url}/metrics', params={'format': 'json'}).json()
+        report = {
+            'commit': git_commit(),
+            'started_server': process is not None,
+            'config': vars(args),
+            'workloads': results,
+            'server': {
+                'peak_rss_bytes': server_metrics.get('peak_rss_bytes'),
+                'peak_staged_bytes': server_metrics['staging'].get('peak_staged_bytes'),
+                'bytes_received': server_metrics['bytes_received'],
+                'bytes_sent': server_metrics['bytes_sent'],
+                'socketio_emits': server_metrics['socketio_emits']
+            }
+        }
+    finally:
+        for device in devices:
+            try:
+                device.close()
+            except Exception:
+                pass
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+    return 1 if any(result['errors'] for result in results.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,677 @@
+"""Command-line client for LocalShare.
+
+Joins a running LocalShare server as a device, the way the web page does,
+so transfers can be scripted without a browser:
+
+    python localshare.py --url http://192.168.1.10:5000 send ./dataset --to lab-3
+    python localshare.py --url http://192.168.1.10:5000 receive --dir ~/incoming --auto-accept
+
+Directories are walked one folder at a time while they upload. Several
+threads share one pooled keep-alive HTTP session: small files of a
+directory go in batches, larger ones are streamed from disk with
+``/upload/raw``, and files over ``PART_SIZE`` are sent in parts side by
+side. Files carry their content hash both ways and are sent or fetched
+again if they arrive corrupted.
+"""
+
+# Standard library imports
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Queue, Empty
+from urllib.parse import urlencode
+
+# Third-party imports
+import requests
+import socketio
+from requests.adapters import HTTPAdapter
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024  # Block size of content hashes, as in app.py
+PART_SIZE = 8 * HASH_CHUNK_SIZE  # Larger files are uploaded in parts of this size at once
+READ_SIZE = 1024 * 1024
+RETRIES = 3
+
+class TransferError(Exception):
+    """A transfer was refused or failed for good."""
+
+def parse_args(argv=None):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description='Send and receive files through a LocalShare server')
+    parser.add_argument('--url', default=os.environ.get('LOCALSHARE_URL', 'http://localhost:5000'),
+                        help='address of the LocalShare server (default: $LOCALSHARE_URL or http://localhost:5000)')
+    parser.add_argument('--name', default=socket.gethostname(), help='device name shown to others')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for a device, an answer or a stalled request')
+    parser.add_argument('--parallel', type=int,
+                        help='requests in flight at once (default: what the server suggests, 4 when receiving)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    send = commands.add_parser('send', help='offer files or directories to other devices')
+    send.add_argument('paths', nargs='+', metavar='path', help='file or directory; each one is a transfer')
+    send.add_argument('--to', action='append', required=True, metavar='device',
+                      help='name or ID of a recipient; repeat for several')
+    send.add_argument('--no-verify', action='store_true',
+                      help='do not hash files before sending, which saves reading them twice')
+
+    receive = commands.add_parser('receive', help='wait for transfers and save them')
+    receive.add_argument('--dir', default='.', help='directory to save received files in')
+    receive.add_argument('--auto-accept', action='store_true', help='accept offers without asking')
+    receive.add_argument('--from', dest='senders', action='append', metavar='device',
+                         help='only accept offers from this device; repeat for several')
+    receive.add_argument('--once', action='store_true', help='exit after the first accepted transfer')
+    return parser.parse_args(argv)
+
+# Content hashes
+class TreeHasher:
+    """Content hash as the server computes it: SHA-256 over the SHA-256 of each block."""
+
+    def __init__(self):
+        self._tree = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), HASH_CHUNK_SIZE - self._filled)
+            self._block.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == HASH_CHUNK_SIZE:
+                self._tree.update(self._block.digest())
+                self._block = hashlib.sha256()
+                self._filled = 0
+
+    def hexdigest(self):
+        tree = self._tree.copy()
+        if self._filled:
+            tree.update(self._block.digest())
+        return tree.hexdigest()
+
+def file_hash(path):
+    hasher = TreeHasher()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return hasher.hexdigest()
+            hasher.update(data)
+
+# Progress and throughput
+def format_bytes(nbytes):
+    return f'{nbytes / 1e6:.1f} MB'
+
+class Progress:
+    """Bytes and files moved by all threads of one transfer, shown as a status line on a terminal."""
+
+    def __init__(self, label, total_bytes):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.files = 0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if sys.stderr.isatty():
+            threading.Thread(target=self._show, daemon=True).start()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+
+    def file_done(self):
+        with self._lock:
+            self.files += 1
+
+    def _show(self):
+        while not self._stop.wait(1):
+            elapsed = time.perf_counter() - self.started
+            sys.stderr.write(f'\r{self.label}: {format_bytes(self.bytes)} of {format_bytes(self.total_bytes)}, '
+                             f'{self.files} files, {self.bytes / elapsed / 1e6:.1f} MB/s ')
+            sys.stderr.flush()
+
+    def finish(self):
+        """Stop the status line and return a summary with the average throughput."""
+        self._stop.set()
+        if sys.stderr.isatty():
+            sys.stderr.write('\r\033[K')
+        elapsed = time.perf_counter() - self.started
+        return (f'{self.label}: {self.files} files, {format_bytes(self.bytes)} in {elapsed:.1f} s '
+                f'({self.bytes / elapsed / 1e6:.1f} MB/s)')
+
+# The device
+class Device:
+    """This host as a LocalShare device: a Socket.IO client plus a pooled HTTP session.
+
+    Transfer events are queued as ``(event, data)`` for whichever thread
+    drives the transfers; the device list is kept up to date on the side.
+    """
+
+    EVENTS = ('file_transfer_request', 'file_transfer_request_sent', 'file_transfer_accepted',
+              'file_transfer_rejected', 'file_transfer_error', 'files_staged',
+              'file_ready_for_download', 'transfer_expired')
+
+    def __init__(self, url, name, timeout):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.events = Queue()
+        self.devices = {}
+        self._devices_changed = threading.Condition()
+        self.sio = socketio.Client()
+        for event in self.EVENTS:
+            self.sio.on(event, lambda data, event=event: self.events.put((event, data)))
+        self.sio.on('device_list', self._on_device_list)
+        self.sio.on('device_joined', self._on_device_joined)
+        self.sio.on('device_left', self._on_device_left)
+        self.sio.on('device_renamed', self._on_device_renamed)
+        # WebSocket only, as a multi-worker server keeps each session in one process
+        self.sio.connect(f'{self.url}?{urlencode({"device_name": name})}', transports=['websocket'],
+                         wait_timeout=timeout)
+
+    @property
+    def sid(self):
+        return self.sio.get_sid()
+
+    def pool(self, size):
+        """Keep up to ``size`` connections to the server alive for reuse."""
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+    def _on_device_list(self, data):
+        with self._devices_changed:
+            self.devices = data['devices']
+            self._devices_changed.notify_all()
+
+    def _on_device_joined(self, data):
+        with self._devices_changed:
+            self.devices[data['device']['id']] = data['device']
+            self._devices_changed.notify_all()
+
+    def _on_device_left(self, data):
+        with self._devices_changed:
+            self.devices.pop(data['id'], None)
+
+    def _on_device_renamed(self, data):
+        with self._devices_changed:
+            if data['id'] in self.devices:
+                self.devices[data['id']]['name'] = data['name']
+                self._devices_changed.notify_all()
+
+    def find_device(self, name):
+        """Return the ID of the device called ``name`` (or with that ID), waiting for it to connect."""
+        deadline = time.monotonic() + self.timeout
+        with self._devices_changed:
+            while True:
+                matches = [sid for sid, device in self.devices.items()
+                           if sid != self.sid and name in (sid, device['name'])]
+                if len(matches) > 1:
+                    raise TransferError(f'Several devices are called {name}; use a device ID')
+                if matches:
+                    return matches[0]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TransferError(f'No device called {name} is connected')
+                self._devices_changed.wait(remaining)
+
+    def wait(self, events, transfer_id=None):
+        """Return the next of ``events`` (for ``transfer_id`` if given) as ``(event, data)``."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                event, data = self.events.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
+                raise TransferError(f'No answer within {self.timeout:.0f} seconds') from None
+            if event in events and (transfer_id is None or data.get('transfer_id') == transfer_id):
+                return event, data
+
+    def close(self):
+        self.sio.disconnect()
+        self.http.close()
+
+def check(response):
+    """Raise ``TransferError`` with the server's message if a request failed."""
+    if response.ok:
+        return response
+    try:
+        message = response.json()['error']
+    except (ValueError, KeyError, TypeError):
+        message = response.reason
+    raise TransferError(f'{response.request.method} {response.url.split("?")[0]} failed: '
+                        f'{response.status_code} {message}')
+
+def busy(response):
+    """Wait as long as the server asks if it queued the request, and say whether it did."""
+    if response.status_code != 503:
+        return False
+    time.sleep(int(response.headers.get('Retry-After', 5)))
+    return True
+
+# Sending
+def walk(root):
+    """Yield ``(path, relative_path, size)`` for the files under ``root``, one folder at a time.
+
+    Relative paths start with the name of ``root``, as the browser sends them.
+    Symbolic links to directories are not followed.
+    """
+    folders = [(root, os.path.basename(os.path.abspath(root)))]
+    while folders:
+        folder, prefix = folders.pop()
+        with os.scandir(folder) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name, reverse=True)
+        for entry in entries:
+            relative_path = f'{prefix}/{entry.name}'
+            if entry.is_dir(follow_symlinks=False):
+                folders.append((entry.path, relative_path))
+            elif entry.is_file():
+                yield entry.path, relative_path, entry.stat().st_size
+
+class LocalFile:
+    """A file being sent. Its hash is computed once, by the first part that needs it."""
+
+    def __init__(self, path, relative_path, size, verify):
+        self.path = path
+        self.relative_path = relative_path
+        self.size = size
+        self.verify = verify
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def digest(self):
+        with self._lock:
+            if self.verify and self._digest is None:
+                self._digest = file_hash(self.path)
+            return self._digest
+
+class FileRange:
+    """The bytes ``[start, end)`` of a file as a request body that requests streams from disk."""
+
+    def __init__(self, path, start, end, progress):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._progress = progress
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        # Larger reads than the HTTP client asks for keep the per-call overhead down
+        data = self._file.read(min(max(size, READ_SIZE), self._remaining))
+        self._remaining -= len(data)
+        self._progress.add(len(data))
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+def upload_jobs(files, options, is_directory):
+    """Turn files into batches of small ones and parts of larger ones, as they come."""
+    batch_limit = options['batch_file_limit'] if is_directory else 0
+    batch, batch_size = [], 0
+    for file in files:
+        if file.size >= batch_limit:
+            for start in range(0, file.size, PART_SIZE) or [0]:
+                yield send_part, file, start, min(start + PART_SIZE, file.size)
+            continue
+        if batch and (batch_size + file.size > options['batch_max_bytes']
+                      or len(batch) >= options['batch_max_files']):
+            yield send_batch, batch
+            batch, batch_size = [], 0
+        batch.append(file)
+        batch_size += file.size
+    if batch:
+        yield send_batch, batch
+
+def missing_in(device, transfer_id, file, start, end):
+    """Return the ranges of ``[start, end)`` of a file the server has not received."""
+    status = check(device.http.get(f'{device.url}/upload/status/{transfer_id}', timeout=device.timeout)).json()
+    received_file = status['files'].get(file.relative_path)
+    if received_file is None:
+        return [(start, end)]
+    return [(max(missing_start, start), min(missing_end, end))
+            for missing_start, missing_end in received_file['missing']
+            if missing_start < end and missing_end > start]
+
+def send_part(device, transfer_id, progress, file, start, end):
+    """Stream ``[start, end)`` of a file with ``/upload/raw``, resuming after broken connections."""
+    ranges = [(start, end)]
+    failures = 0
+    while ranges:
+        range_start, range_end = ranges[0]
+        params = {'transfer_id': transfer_id, 'relative_path': file.relative_path,
+                  'offset': range_start, 'filesize': file.size}
+        if file.digest():
+            params['hash'] = file.digest()
+        try:
+            with FileRange(file.path, range_start, range_end, progress) as body:
+                response = device.http.put(f'{device.url}/upload/raw', params=params, data=body,
+                                           timeout=device.timeout)
+        except requests.RequestException:
+            failures += 1
+            if failures > RETRIES:
+                raise
+            ranges = missing_in(device, transfer_id, file, start, end)
+            continue
+        if busy(response):
+            continue
+        if response.status_code == 422:
+            # The server threw the whole file away; send it again in one go
+            failures += 1
+            if failures > RETRIES:
+                raise TransferError(f'{file.relative_path} keeps arriving corrupted; is it being written to?')
+            ranges = [(0, file.size)]
+            continue
+        if not check(response).json()['missing']:
+            progress.file_done()
+        ranges.pop(0)
+
+def send_batch(device, transfer_id, progress, files):
+    """Send small files of a directory in one ``/upload/batch`` request, resending corrupted ones."""
+    failures = 0
+    while files:
+        contents = []
+        for file in files:
+            with open(file.path, 'rb') as f:
+                contents.append(f.read())
+        manifest = {'files': []}
+        for file, data in zip(files, contents):
+            entry = {'relative_path': file.relative_path, 'size': len(data)}
+            if file.verify:
+                hasher = TreeHasher()
+                hasher.update(data)
+                entry['hash'] = hasher.hexdigest()
+            manifest['files'].append(entry)
+        body = json.dumps(manifest).encode() + b'\n' + b''.join(contents)
+        try:
+            response = device.http.post(f'{device.url}/upload/batch', params={'transfer_id': transfer_id},
+                                        data=body, timeout=device.timeout)
+        except requests.RequestException:
+            failures += 1
+            if failures > RETRIES:
+                raise
+            continue
+        if busy(response):
+            continue
+        if response.status_code == 422:
+            failures += 1
+            corrupt = set(response.json()['corrupt'])
+            if failures > RETRIES:
+                raise TransferError(f'{len(corrupt)} files keep arriving corrupted, '
+                                    f'such as {min(corrupt)}; are they being written to?')
+            for file, data in zip(files, contents):
+                if file.relative_path not in corrupt:
+                    progress.add(len(data))
+                    progress.file_done()
+            files = [file for file in files if file.relative_path in corrupt]
+            continue
+        check(response)
+        progress.add(sum(len(data) for data in contents))
+        for _ in files:
+            progress.file_done()
+        return
+
+def send(device, path, targets, args):
+    """Offer ``path`` to the target devices and upload it once the first of them accepts."""
+    if not os.path.exists(path):
+        raise TransferError(f'{path} does not exist')
+    is_directory = os.path.isdir(path)
+    filename = os.path.basename(os.path.abspath(path))
+    if is_directory:
+        # A first pass over the metadata only; the upload walks the tree again
+        total_files = total_size = 0
+        for _, _, size in walk(path):
+            total_files += 1
+            total_size += size
+        if not total_files:
+            raise TransferError(f'{path} contains no files')
+    else:
+        total_files, total_size = 1, os.path.getsize(path)
+
+    device.sio.emit('file_transfer_request', {
+        'targets': targets,
+        'filename': filename,
+        'filesize': total_size,
+        'isDirectory': is_directory,
+        'total_files': total_files
+    })
+    event, data = device.wait(('file_transfer_request_sent', 'file_transfer_error'))
+    if event == 'file_transfer_error':
+        raise TransferError(data['error'])
+    transfer_id = data['transfer_id']
+    print(f'Offered {filename} ({total_files} files, {format_bytes(total_size)}), waiting for an answer')
+    event, options = device.wait(('file_transfer_accepted', 'file_transfer_rejected', 'transfer_expired'),
+                                 transfer_id)
+    if event == 'file_transfer_rejected':
+        raise TransferError(f'{filename} was rejected')
+    if event == 'transfer_expired':
+        raise TransferError(f'{filename} was not accepted in time')
+    print(f'Accepted by {options["recipient_name"]}, sending')
+
+    parallel = args.parallel or options['parallel_chunks']
+    device.pool(parallel)
+    progress = Progress(f'Sent {filename}', total_size)
+    if is_directory:
+        entries = walk(path)
+    else:
+        entries = [(path, filename, total_size)]
+    files = [0]
+
+    def local_files():
+        for file_path, relative_path, size in entries:
+            files[0] += 1
+            yield LocalFile(file_path, relative_path, size, not args.no_verify)
+
+    # Jobs are made as workers free up, so huge trees are never listed in memory
+    jobs = Queue(maxsize=parallel * 2)
+    failures = []
+
+    def worker():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if failures:
+                continue
+            send_job, *job_args = job
+            try:
+                send_job(device, transfer_id, progress, *job_args)
+            except Exception as e:
+                failures.append(e)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(parallel)]
+    for thread in workers:
+        thread.start()
+    try:
+        for job in upload_jobs(local_files(), options, is_directory):
+            if failures:
+                break
+            jobs.put(job)
+    finally:
+        for _ in workers:
+            jobs.put(None)
+        for thread in workers:
+            thread.join()
+    summary = progress.finish()
+    if failures:
+        raise TransferError(f'Sending {filename} failed: {failures[0]}')
+    if files[0] != total_files:
+        raise TransferError(f'{path} changed while it was sent: {files[0]} files instead of {total_files}')
+    print(summary)
+
+# Receiving
+def local_path(root, relative_path):
+    """Join a path the server sent onto ``root``, refusing anything that would leave it."""
+    parts = [part for part in relative_path.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        raise TransferError(f'Refusing to save {relative_path!r}')
+    return os.path.join(root, *parts)
+
+def download(device, url, params, target, progress, digest=None):
+    """Fetch one file into ``target`` through a temporary file, checking its content hash.
+
+    Without ``digest`` the hash in the ``X-Content-Hash`` header is checked.
+    """
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    partial = f'{target}.part'
+    failures = 0
+    while True:
+        try:
+            with device.http.get(url, params=params, stream=True, timeout=device.timeout) as response:
+                if busy(response):
+                    continue
+                check(response)
+                expected = digest or response.headers.get('X-Content-Hash')
+                hasher = TreeHasher()
+                with open(partial, 'wb') as f:
+                    for block in response.iter_content(READ_SIZE):
+                        f.write(block)
+                        hasher.update(block)
+                        progress.add(len(block))
+            if not expected or hasher.hexdigest() == expected:
+                os.replace(partial, target)
+                progress.file_done()
+                return
+            problem = f'{os.path.basename(target)} arrived corrupted'
+        except requests.RequestException as e:
+            problem = str(e)
+        failures += 1
+        if failures > RETRIES:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise TransferError(problem)
+
+class Incoming:
+    """A transfer this device accepted, with the files of a directory fetched so far."""
+
+    def __init__(self, offer, root):
+        self.transfer_id = offer['transfer_id']
+        self.filename = offer['filename']
+        self.is_directory = offer['is_directory']
+        self.root = root
+        self.progress = Progress(f'Received {self.filename}', offer['filesize'])
+        self.fetches = {}  # relative path -> future of its download
+        self._lock = threading.Lock()
+
+    def fetch(self, device, pool, files):
+        """Start downloading the listed files of a directory that are not under way yet."""
+        url = f'{device.url}/download/{self.transfer_id}/file'
+        with self._lock:
+            for entry in files:
+                relative_path = entry['relative_path']
+                if relative_path in self.fetches:
+                    continue
+                params = {'path': relative_path, 'recipient': device.sid}
+                self.fetches[relative_path] = pool.submit(
+                    download, device, url, params, local_path(self.root, relative_path),
+                    self.progress, entry.get('hash'))
+
+    def finish(self, device, pool, ready):
+        """Fetch what is left once the upload is done, then tell the server the transfer is complete."""
+        try:
+            if self.is_directory:
+                self.fetch(device, pool, ready['manifest'])
+                with self._lock:
+                    fetches = list(self.fetches.values())
+                wait(fetches)
+                for future in fetches:
+                    future.result()
+            else:
+                download(device, f'{device.url}{ready["download_url"]}', None,
+                         local_path(self.root, os.path.basename(self.filename)), self.progress)
+            device.sio.emit('file_transfer_complete', {'transfer_id': self.transfer_id})
+            print(self.progress.finish())
+            succeeded = True
+        except Exception as e:
+            self.progress.finish()
+            print(f'Receiving {self.filename} failed: {e}', file=sys.stderr)
+            succeeded = False
+        device.events.put(('transfer_finished', {'transfer_id': self.transfer_id, 'succeeded': succeeded}))
+
+def accept_offer(offer, args):
+    """Decide on an offer: by the command line, or by asking on the terminal."""
+    print(f'{offer["from_name"]} offers {offer["filename"]} ({format_bytes(offer["filesize"])})')
+    if args.senders and offer['from_name'] not in args.senders and offer['from'] not in args.senders:
+        print('Rejected: not from an allowed device')
+        return False
+    if args.auto_accept:
+        return True
+    try:
+        return input('Accept? [y/N] ').strip().lower() in ('y', 'yes')
+    except EOFError:
+        return False
+
+def receive(device, args):
+    """Answer offers and save accepted transfers until interrupted, or after one with ``--once``.
+
+    Returns whether every finished transfer succeeded.
+    """
+    parallel = args.parallel or 4
+    device.pool(parallel)
+    pool = ThreadPoolExecutor(parallel)
+    incoming = {}
+    succeeded = True
+    print(f'Waiting for transfers to {os.path.abspath(args.dir)}')
+    try:
+        while True:
+            event, data = device.events.get()
+            transfer = incoming.get(data.get('transfer_id'))
+            if event == 'file_transfer_request':
+                # With --once, offers that come in after the accepted one are turned down
+                if not (args.once and incoming) and accept_offer(data, args):
+                    incoming[data['transfer_id']] = Incoming(data, args.dir)
+                    device.sio.emit('file_transfer_accept', {'transfer_id': data['transfer_id']})
+                else:
+                    device.sio.emit('file_transfer_reject', {'transfer_id': data['transfer_id']})
+            elif transfer is None:
+                continue
+            elif event == 'files_staged':
+                # Directory files can be fetched while the rest is still uploading
+                transfer.fetch(device, pool, data['files'])
+            elif event == 'file_ready_for_download':
+                threading.Thread(target=transfer.finish, args=(device, pool, data), daemon=True).start()
+            elif event == 'transfer_expired':
+                transfer.progress.finish()
+                print(f'{transfer.filename} expired: {data.get("reason")}', file=sys.stderr)
+                del incoming[transfer.transfer_id]
+                succeeded = False
+            elif event == 'transfer_finished':
+                del incoming[transfer.transfer_id]
+                succeeded = succeeded and data['succeeded']
+            if args.once and event in ('transfer_expired', 'transfer_finished'):
+                return succeeded
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        device = Device(args.url, args.name, args.timeout)
+    except socketio.exceptions.ConnectionError as e:
+        sys.exit(f'Cannot connect to {args.url}: {e}')
+    try:
+        if args.command == 'send':
+            targets = [device.find_device(name) for name in args.to]
+            for path in args.paths:
+                send(device, path, targets, args)
+        elif not receive(device, args):
+            sys.exit(1)
+    except TransferError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        device.close()
+
+if __name__ == '__main__':
+    main()